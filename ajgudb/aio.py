@@ -0,0 +1,220 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""asyncio facade of AjguDB.
+
+Every storage call is executed on a dedicated thread, methods return
+futures that can be awaited from the event loop. Under python 2 trollius
+and futures are required, they are installed with ``pip install
+ajgudb[async]``, and coroutines use ``yield From(future)`` instead of
+``await`` and ``async for``.
+"""
+from collections import deque
+from functools import partial
+from itertools import islice
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .ajgudb import AjguDB
+from .leveldb import LevelDBStorage
+from .utils import AjguDBException
+
+
+try:
+    StopAsyncIteration
+except NameError:
+    # python 2
+    class StopAsyncIteration(Exception):
+        pass
+
+
+class AsyncQuery(object):
+    """Asynchronous iterator over the results of a gremlin query.
+
+    Results are computed by chunks on the executor."""
+
+    def __init__(self, database, steps, start=None, chunk=100, **options):
+        self._database = database
+        self._steps = steps
+        self._start = start
+        self._options = options
+        self._chunk = chunk
+        self._iterator = None
+        self._buffer = deque()
+        self._exhausted = False
+
+    def _execute(self):
+        # options and the query cache are handled by AjguDB.query
+        graphdb = self._database._graphdb
+        return graphdb.query(*self._steps, **self._options)(self._start)
+
+    def _results(self):
+        out = self._execute()
+        if isinstance(out, (list, tuple)) or hasattr(out, 'next'):
+            return out
+        # final steps like count return a single value
+        return [out]
+
+    def _fetch(self):
+        if self._iterator is None:
+            self._iterator = iter(self._results())
+        return list(islice(self._iterator, self._chunk))
+
+    def _fetched(self, future, out):
+        if out.cancelled():
+            return
+        if future.exception() is not None:
+            out.set_exception(future.exception())
+            return
+        chunk = future.result()
+        if len(chunk) < self._chunk:
+            self._exhausted = True
+        self._buffer.extend(chunk)
+        if self._buffer:
+            out.set_result(self._buffer.popleft())
+        else:
+            out.set_exception(StopAsyncIteration())
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        out = asyncio.Future(loop=self._database._loop)
+        if self._buffer:
+            out.set_result(self._buffer.popleft())
+        elif self._exhausted:
+            out.set_exception(StopAsyncIteration())
+        else:
+            future = self._database._run(self._fetch)
+            future.add_done_callback(partial(self._fetched, out=out))
+        return out
+
+    def all(self):
+        """Return a future of the query result"""
+        def run():
+            out = self._execute()
+            if hasattr(out, 'next'):
+                return list(out)
+            return out
+        return self._database._run(run)
+
+
+class AsyncAjguDB(object):
+    """Same as ``AjguDB`` except methods return futures. ``options`` are
+    the ones of ``AjguDB`` eg. ``cache``"""
+
+    def __init__(
+        self, path, storage_class=LevelDBStorage, loop=None, **options
+    ):
+        self._loop = loop or asyncio.get_event_loop()
+        # storages are not thread safe, every call happens in the same thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._graphdb = AjguDB(path, storage_class, **options)
+        self._pending = dict()
+
+    def _run(self, func, *args, **kwargs):
+        if kwargs:
+            func = partial(func, **kwargs)
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        future = self._run(self._graphdb.close)
+        self._executor.shutdown(wait=False)
+        return future
+
+    def get(self, uid):
+        """Retrieve ``Vertex`` or ``Edge`` with ``uid`` as identifier.
+
+        Lookups done during the same iteration of the event loop are
+        executed as one ``AjguDB.get_many``."""
+        future = asyncio.Future(loop=self._loop)
+        if not self._pending:
+            self._loop.call_soon(self._flush)
+        self._pending.setdefault(uid, list()).append(future)
+        return future
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = dict()
+        uids = list(pending.keys())
+
+        def done(future):
+            if future.exception() is not None:
+                for uid in uids:
+                    for waiter in pending[uid]:
+                        if not waiter.cancelled():
+                            waiter.set_exception(future.exception())
+                return
+            for uid, element in zip(uids, future.result()):
+                for waiter in pending[uid]:
+                    if waiter.cancelled():
+                        continue
+                    elif element is None:
+                        exception = AjguDBException('not found %s' % uid)
+                        waiter.set_exception(exception)
+                    else:
+                        waiter.set_result(element)
+
+        self._run(self._graphdb.get_many, uids).add_done_callback(done)
+
+    def vertex(self, **properties):
+        return self._run(self._graphdb.vertex, **properties)
+
+    def get_or_create(self, defaults=None, **properties):
+        return self._run(
+            self._graphdb.get_or_create, defaults, **properties
+        )
+
+    def one(self, **properties):
+        return self._run(self._graphdb.one, **properties)
+
+    def save(self, element):
+        return self._run(element.save)
+
+    def delete(self, element):
+        return self._run(element.delete)
+
+    def link(self, start, end, **properties):
+        return self._run(start.link, end, **properties)
+
+    def query(self, *steps, **options):
+        """Return a function that returns a future of the query result, see
+        ``AjguDB.query`` for ``options``"""
+        def run(iterator=None):
+            return AsyncQuery(self, steps, iterator, **options).all()
+        return run
+
+    def aquery(self, *steps, **options):
+        """Asynchronous iterator over the results of the query. With
+        trollius::
+
+            iterator = db.aquery(select(label='test'), get)
+            while True:
+                try:
+                    vertex = yield From(iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+                print(vertex)
+
+        Use ``start`` keyword argument to pass an element to the query,
+        other ``options`` are the ones of ``AjguDB.query``."""
+        start = options.pop('start', None)
+        return AsyncQuery(self, steps, start, **options)
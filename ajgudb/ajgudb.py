@@ -15,15 +15,35 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301  USA
+from contextlib import contextmanager
+from itertools import islice
+
 from utils import AjguDBException
 
+from packing import pack
+from packing import unpack
 from leveldb import LevelDBStorage
+from fulltext import FullTextIndex
+from geo import GeoIndex
+from composite import CompositeIndex
+from degree import DegreeIndex
+from degree import increment
+from label import LabelIndex
+from unique import UniqueIndex
+from spill import BUDGET
+
+
+# number of elements deleted per batch by ``AjguDB.delete_many``
+DELETE_CHUNK = 1000
+
+# key of the meta keyspace incremented when an index is declared
+INDICES_VERSION = pack('indices')
 
 
 class Base(dict):
 
     def delete(self):
-        self._graphdb._tuples.delete(self.uid)
+        self._graphdb._delete(self.uid)
 
     def __eq__(self, other):
         if isinstance(other, Base):
@@ -59,8 +79,12 @@ class Vertex(Base):
     def outgoings(self):
         return self._iter_edges('start')
 
+    def degree(self, direction='both'):
+        """Return the number of ``out``, ``in`` or ``both`` edges"""
+        return self._graphdb._degree(self.uid, direction)
+
     def save(self):
-        self._graphdb._tuples.update(
+        self._graphdb._update(
             self.uid,
             _meta_type='vertex',
             **self
@@ -68,18 +92,10 @@ class Vertex(Base):
         return self
 
     def link(self, end, **properties):
-        properties['_meta_start'] = self.uid
-        properties['_meta_end'] = end.uid
-        uid = self._graphdb._uid()
-        self._graphdb._tuples.add(uid, _meta_type='edge', **properties)
-        return Edge(self._graphdb, uid, properties)
+        return self._graphdb.link_many([(self, end, properties)])[0]
 
     def delete(self):
-        for incoming in self.incomings():
-            incoming.delete()
-        for outgoing in self.outgoings():
-            outgoing.delete()
-        super(Vertex, self).delete()
+        self._graphdb.delete_many([self.uid])
 
 
 class Edge(Base):
@@ -100,7 +116,7 @@ class Edge(Base):
         return Vertex(self._graphdb, self._end, properties)
 
     def save(self):
-        self._graphdb._tuples.update(
+        self._graphdb._update(
             self.uid,
             _meta_type='edge',
             _meta_start=self._start,
@@ -112,49 +128,499 @@ class Edge(Base):
 
 class AjguDB(object):
 
-    def __init__(self, path, storage_class=LevelDBStorage):
-        self._tuples = storage_class(path)
+    def __init__(
+        self, path, storage_class=LevelDBStorage, metrics=False,
+        compression=None, cache=0,
+    ):
+        if compression is None:
+            self._tuples = storage_class(path)
+        else:
+            self._tuples = storage_class(path, compression=compression)
+        if metrics:
+            from metrics import Metrics
+            from metrics import MeteredStorage
+            self._metrics = Metrics()
+            self._tuples = MeteredStorage(self._tuples, self._metrics)
+        else:
+            self._metrics = None
+        if cache:
+            if hasattr(self._tuples, 'uid'):
+                # writes of other clients can't be seen
+                self._tuples.close()
+                message = 'storage does not support the query cache'
+                raise AjguDBException(message)
+            from cache import QueryCache
+            from cache import VersionedStorage
+            self._tuples = VersionedStorage(self._tuples)
+            self._cache = QueryCache(self._tuples, cache)
+        else:
+            self._cache = None
+        self._load_indices()
 
     def close(self):
         self._tuples.close()
 
-    def _uid(self):
+    @contextmanager
+    def snapshot(self):
+        """Return a context manager of a read only view of the database
+        as of now. Elements and queries of the view don't see the writes
+        done after it's created"""
+        if not hasattr(self._tuples, 'snapshot'):
+            raise AjguDBException('storage does not support snapshots')
+        snapshot = Snapshot(self, self._tuples.snapshot())
+        try:
+            yield snapshot
+        finally:
+            snapshot.close()
+
+    def metrics(self):
+        """Return storage metrics, the database must be opened with
+        ``metrics=True``"""
+        if self._metrics is None:
+            raise AjguDBException('metrics are not enabled')
+        return self._metrics.snapshot()
+
+    def export_metrics(self, target):
+        """Write metrics using prometheus text format to ``target`` which
+        is a filename or a callable"""
+        from metrics import prometheus
+        text = prometheus(self.metrics())
+        if callable(target):
+            target(text)
+        else:
+            with open(target, 'w') as f:
+                f.write(text)
+
+    def train_dictionary(self, key, size=16384, samples=1024):
+        """Train a zstd dictionary for the values of ``key`` using the
+        first ``samples`` values found in the index. Values written
+        afterwards are compressed with it when the database is opened with
+        ``compression='zstd'``"""
+        compressor = getattr(self._tuples, 'compressor', None)
+        if compressor is None:
+            raise AjguDBException('storage does not compress values')
+        values = list()
+        for _, value, _ in self._tuples.query(key):
+            values.append(pack(value))
+            if len(values) == samples:
+                break
+        return compressor.train(key, values, size)
+
+    def _load_indices(self):
+        # secondary indices are declared in the meta keyspace so that every
+        # process that opens the database maintains them
+        self._indices = dict()
+        meta = self._tuples.keyspace('meta')
+        # the version is read first, an index declared meanwhile is loaded
+        # by the next refresh
+        self._indices_version = meta.get(INDICES_VERSION)
+        for _, value in meta.iterator(prefix=pack('index')):
+            value = unpack(value)
+            kind, name, args = value[0], value[1], value[2:]
+            self._indices[name] = INDICES[kind](self, *args)
+
+    def _refresh_indices(self):
+        """Load the indices again when another client of the storage
+        server declared one since they were loaded"""
+        if not hasattr(self._tuples, 'uid'):
+            # no other process can open the database
+            return
+        meta = self._tuples.keyspace('meta')
+        if meta.get(INDICES_VERSION) != self._indices_version:
+            self._load_indices()
+
+    def _create_index(self, kind, name, *args):
+        meta = self._tuples.keyspace('meta')
+        key = pack('index', name)
+        if meta.get(key) is not None:
+            raise AjguDBException('index %s already exists' % name)
+        index = INDICES[kind](self, *args)
+        index.backfill()
+        # arguments are packed one by one to keep str and unicode apart
+        meta.put(key, pack(kind, name, *args))
+        if hasattr(self._tuples, 'increment'):
+            # other clients might increment it at the same time
+            self._tuples.increment('meta', [(INDICES_VERSION, 1)])
+        else:
+            increment(meta, [(INDICES_VERSION, 1)])
+        self._indices[name] = index
+        return index
+
+    def _index(self, name):
+        if name not in self._indices:
+            # another client might have declared it
+            self._refresh_indices()
+        try:
+            return self._indices[name]
+        except KeyError:
+            raise AjguDBException('there is no index %s' % name)
+
+    def create_fulltext_index(self, key):
+        """Index the words of ``key`` values, see ``gremlin.search``"""
+        self._create_index('fulltext', 'fulltext:%s' % key, key)
+
+    def create_geo_index(self, name, lat='lat', lon='lon'):
+        """Index the coordinates stored in ``lat`` and ``lon`` keys, see
+        ``gremlin.within`` and ``gremlin.bbox``"""
+        self._create_index('geo', 'geo:%s' % name, name, lat, lon)
+
+    def create_index(self, *keys):
+        """Index elements that have all ``keys`` on their values, ``select``
+        use it when it's given those keys"""
+        if len(keys) < 2:
+            raise AjguDBException('every key is already indexed')
+        name = 'composite:%s' % ','.join(keys)
+        self._create_index('composite', name, *keys)
+
+    def create_degree_index(self):
+        """Maintain the number of outgoing and incoming edges of every
+        vertex, see ``Vertex.degree``"""
+        self._create_index('degree', 'degree')
+
+    def rebuild_degree_index(self):
+        """Count the edges of every vertex again. Counters are only written
+        in the same batch as edges with ``LevelDBStorage``, with other
+        storages a crash between both writes leaves them wrong"""
+        self._index('degree').rebuild()
+
+    def create_label_index(self):
+        """Store the edges that have a ``label`` by label for both of
+        their vertices, see ``outgoings`` and ``incomings`` steps"""
+        self._create_index('label', 'label')
+
+    def _degree(self, uid, direction='both'):
+        if direction == 'both':
+            return self._degree(uid, 'out') + self._degree(uid, 'in')
+        if direction not in ('out', 'in'):
+            raise AjguDBException('unknown direction %s' % direction)
+        index = self._indices.get('degree')
+        if index is not None:
+            return index.degree(uid, direction)
+        # count the edges using the index
+        key = '_meta_start' if direction == 'out' else '_meta_end'
+        return sum(1 for _ in self._tuples.query(key, uid))
+
+    def unique(self, key):
+        """Declare that no two elements have the same value of ``key``,
+        writes that break it raise ``AjguDBException``. ``get_or_create``
+        looks up elements by ``key`` with a single read"""
+        self._create_index('unique', 'unique:%s' % key, key)
+
+    def _unique_index(self, keys):
+        """Return a unique index on one of ``keys`` or ``None``"""
+        for key in keys:
+            index = self._indices.get('unique:%s' % key)
+            if index is not None:
+                return index
+        return None
+
+    def _check(self, elements):
+        for index in self._indices.values():
+            if isinstance(index, UniqueIndex):
+                index.check(elements)
+
+    def _unique_keys(self):
+        """Return the unique keys checked by the storage server when
+        elements are added, see ``StorageServer.add_unique``"""
+        if not hasattr(self._tuples, 'add_unique'):
+            return []
+        return [
+            index.key for index in self._indices.values()
+            if isinstance(index, UniqueIndex)
+        ]
+
+    def _add_unique(self, elements, keys):
+        """Add ``elements`` with a single call to the storage server that
+        checks the unique ``keys`` and writes their rows. Return the
+        ``[key, value, uid]`` of a value that belongs to another element or
+        ``None``"""
+        out = self._tuples.add_unique(elements, keys)
+        if out is None:
+            indices = [
+                index for index in self._indices.values()
+                if not isinstance(index, UniqueIndex)
+            ]
+            self._index_many(indices, elements)
+        return out
+
+    def _composite_index(self, keys):
+        """Return the composite index with the most keys among ``keys``"""
+        keys = set(keys)
+        out = None
+        for index in self._indices.values():
+            if not isinstance(index, CompositeIndex):
+                continue
+            if not keys.issuperset(index.keys):
+                continue
+            if out is None or len(index.keys) > len(out.keys):
+                out = index
+        return out
+
+    def _add(self, uid, **properties):
+        self._refresh_indices()
+        if self._unique_keys():
+            self._add_many([(uid, properties)])
+            return
+        self._check([(uid, properties)])
+        self._tuples.add(uid, **properties)
+        for index in self._indices.values():
+            index.add(uid, properties)
+
+    def _batched(self):
+        """Return the degree index when its rows can be written in the
+        batches of the storage, see ``LevelDBStorage.add_many``"""
+        if getattr(self._tuples, 'keyspace_rows', False):
+            return self._indices.get('degree')
+        return None
+
+    def _add_many(self, elements):
+        self._refresh_indices()
+        keys = self._unique_keys()
+        if keys:
+            taken = self._add_unique(elements, keys)
+            if taken is not None:
+                message = '%s %r already exists' % tuple(taken[:2])
+                raise AjguDBException(message)
+            return
+        self._check(elements)
+        indices = self._indices.values()
+        degree = self._batched()
+        if degree is None:
+            self._tuples.add_many(elements)
+        else:
+            # counters are written atomically with the edges
+            rows = degree.rows(added=elements)
+            rows = [('degree', key, value) for key, value in rows]
+            self._tuples.add_many(elements, rows=rows)
+            indices = [index for index in indices if index is not degree]
+        self._index_many(indices, elements)
+
+    def _index_many(self, indices, elements):
+        for index in indices:
+            if hasattr(index, 'add_many'):
+                index.add_many(elements)
+                continue
+            for uid, properties in elements:
+                index.add(uid, properties)
+
+    def _ingest(self, elements, budget=BUDGET):
+        """Add ``(uid, properties)`` of ``elements`` using the sorted
+        ingest of the storage if it has one. It's meant for initial loads,
+        rows are only readable once every element is written"""
+        self._refresh_indices()
+        if self._indices:
+            elements = self._indexing(elements)
+        if hasattr(self._tuples, 'ingest'):
+            self._tuples.ingest(elements, budget)
+        else:
+            while True:
+                batch = list(islice(elements, 1000))
+                if not batch:
+                    break
+                self._tuples.add_many(batch)
+
+    def _indexing(self, elements):
+        for uid, properties in elements:
+            self._check([(uid, properties)])
+            for index in self._indices.values():
+                index.add(uid, properties)
+            yield uid, properties
+
+    def _update(self, uid, **properties):
+        self._refresh_indices()
+        self._check([(uid, properties)])
+        previous = self._tuples.get(uid) if self._indices else None
+        for index in self._indices.values():
+            if not hasattr(index, 'update'):
+                index.delete(uid, previous)
+        self._tuples.update(uid, **properties)
+        for index in self._indices.values():
+            if hasattr(index, 'update'):
+                # indices that can are changed once, after the write
+                index.update(uid, previous, properties)
+            else:
+                index.add(uid, properties)
+
+    def _delete(self, uid):
+        self._delete_many([uid])
+
+    def _delete_many(self, uids):
+        self._refresh_indices()
+        indices = self._indices.values()
+        degree = self._batched()
+        if degree is not None:
+            indices = [index for index in indices if index is not degree]
+        deleted = list()
+        if self._indices:
+            for uid in uids:
+                previous = self._tuples.get(uid)
+                deleted.append((uid, previous))
+                for index in indices:
+                    index.delete(uid, previous)
+        if degree is not None:
+            # counters are written atomically with the edges
+            rows = degree.rows(deleted=deleted)
+            rows = [('degree', key, value) for key, value in rows]
+            self._tuples.delete_many(uids, rows=rows)
+        elif hasattr(self._tuples, 'delete_many'):
+            self._tuples.delete_many(uids)
+        else:
+            for uid in uids:
+                self._tuples.delete(uid)
+
+    def _cascade(self, uids):
+        """Return the uids of the edges of the vertices of ``uids`` followed
+        by ``uids``, edges are found using the index only"""
+        seen = set(uids)
+        edges = list()
+        for uid in uids:
+            for key in ('_meta_start', '_meta_end'):
+                for _, _, edge in self._tuples.query(key, uid):
+                    if edge not in seen:
+                        seen.add(edge)
+                        edges.append(edge)
+        return edges + list(uids)
+
+    def delete_many(self, uids, chunk=DELETE_CHUNK):
+        """Delete the elements of ``uids`` and the edges of the vertices
+        among them. Elements are deleted by atomic batches of ``chunk``
+        elements, edges first"""
+        uids = self._cascade(uids)
+        for start in range(0, len(uids), chunk):
+            self._delete_many(uids[start:start + chunk])
+
+    def _uid(self, count=1):
+        """Allocate ``count`` consecutive identifiers and return the first"""
+        if hasattr(self._tuples, 'uid'):
+            # the storage is shared, let it allocate the identifiers
+            return self._tuples.uid(count)
         try:
             counter = self._tuples.get(0)['counter']
         except KeyError:
-            self._tuples.add(0, counter=1)
+            self._tuples.add(0, counter=count)
             return 1
         else:
-            counter += 1
-            self._tuples.update(0, counter=counter)
-            return counter
+            self._tuples.update(0, counter=counter + count)
+            return counter + 1
+
+    def _element(self, uid, properties):
+        meta_type = properties.pop('_meta_type')
+        if meta_type == 'vertex':
+            return Vertex(self, uid, properties)
+        else:
+            return Edge(self, uid, properties)
 
     def get(self, uid):
         properties = self._tuples.get(uid)
         if properties:
-            meta_type = properties.pop('_meta_type')
-            if meta_type == 'vertex':
-                return Vertex(self, uid, properties)
-            else:
-                return Edge(self, uid, properties)
+            return self._element(uid, properties)
         else:
             raise AjguDBException('not found %s' % uid)
 
+    def get_many(self, uids):
+        """Retrieve several elements at once, missing elements are ``None``"""
+        if hasattr(self._tuples, 'get_many'):
+            many = self._tuples.get_many(uids)
+        else:
+            many = [self._tuples.get(uid) for uid in uids]
+        out = list()
+        for uid, properties in zip(uids, many):
+            if properties:
+                out.append(self._element(uid, properties))
+            else:
+                out.append(None)
+        return out
+
     def vertex(self, **properties):
         uid = self._uid()
-        self._tuples.add(uid, _meta_type='vertex', **properties)
+        self._add(uid, _meta_type='vertex', **properties)
         return Vertex(self, uid, properties)
 
-    def get_or_create(self, **properties):
-        element = self.one(**properties)
+    def link_many(self, links):
+        """Create the edges ``(start, end, properties)`` of ``links`` in one
+        batch, ``start`` and ``end`` are vertices or uids. Return the edges"""
+        links = list(links)
+        if not links:
+            return list()
+        uid = self._uid(len(links))
+        elements = list()
+        edges = list()
+        for index, (start, end, properties) in enumerate(links):
+            properties = dict(properties or ())
+            properties['_meta_start'] = getattr(start, 'uid', start)
+            properties['_meta_end'] = getattr(end, 'uid', end)
+            edges.append(Edge(self, uid + index, dict(properties)))
+            properties['_meta_type'] = 'edge'
+            elements.append((uid + index, properties))
+        self._add_many(elements)
+        return edges
+
+    def get_or_create(self, defaults=None, **properties):
+        """Return the element matching ``properties`` or create a vertex
+        with ``properties`` and ``defaults``. When one of ``properties`` is
+        a unique key the element is looked up with a single read"""
+        index = self._unique_index(properties.keys())
+        if index is None:
+            element = self.one(**properties)
+        else:
+            uid = index.lookup(properties[index.key])
+            element = self._matching(uid, properties)
         if element:
             return element
-        else:
-            return self.vertex(**properties)
-
-    def query(self, *steps):
+        values = dict(defaults or ())
+        values.update(properties)
+        keys = self._unique_keys()
+        if index is None or not keys:
+            return self.vertex(**values)
+        # another client can create it between the lookup and the write,
+        # the server checks and writes the vertex at once
+        uid = self._uid()
+        elements = [(uid, dict(values, _meta_type='vertex'))]
+        taken = self._add_unique(elements, keys)
+        if taken is None:
+            return Vertex(self, uid, values)
+        key, value, other = taken
+        element = None
+        if key == index.key:
+            element = self._matching(other, properties)
+        if element is None:
+            raise AjguDBException('%s %r already exists' % (key, value))
+        return element
+
+    def _matching(self, uid, properties):
+        """Return the element ``uid`` if it has ``properties``, otherwise
+        ``None``"""
+        element = None if uid is None else self.get(uid)
+        if element is not None:
+            for key, value in properties.items():
+                if element.get(key) != value:
+                    # creating it will raise because of the unique key
+                    return None
+        return element
+
+    def query(self, *steps, **options):
+        """Return a function that executes the query, see ``gremlin.query``
+        for ``options``. When the database is opened with a ``cache``, the
+        result is read from the cache unless ``cache=False``"""
         from gremlin import query
-        return lambda iterator=None: query(*steps)(self, iterator)
+        composed = query(*steps, **options)
+        if self._cache is None or not options.get('cache', True):
+            return lambda iterator=None: composed(self, iterator)
+        return lambda iterator=None: self._cache.execute(
+            composed, steps, options, self, iterator,
+        )
+
+    def explain(self, *steps):
+        """Return a function that describes how the query is executed"""
+        from profiling import explain
+        return lambda iterator=None: explain(self, steps, iterator is None)
+
+    def profile(self, *steps, **options):
+        """Return a function that executes the query and returns per step
+        statistics along the result"""
+        from profiling import profile
+        paths = options.get('paths')
+        return lambda iterator=None: profile(self, steps, iterator, paths)
 
     def one(self, **properties):
         from gremlin import select
@@ -166,3 +632,33 @@ class AjguDB(object):
             return None
         else:
             return element
+
+
+class Snapshot(AjguDB):
+    """Read only view of ``graphdb`` using the storage snapshot
+    ``tuples``, see ``AjguDB.snapshot``"""
+
+    def __init__(self, graphdb, tuples):
+        self._tuples = tuples
+        self._metrics = graphdb._metrics
+        self._cache = None
+        self._load_indices()
+
+    def _read_only(self, *args, **kwargs):
+        # indices are written before the storage, writes are rejected
+        # before anything is done
+        raise AjguDBException('snapshots are read only')
+
+    _uid = _add = _add_many = _ingest = _update = _read_only
+    _delete = _delete_many = _create_index = _read_only
+    rebuild_degree_index = train_dictionary = _read_only
+
+
+INDICES = dict(
+    fulltext=FullTextIndex,
+    geo=GeoIndex,
+    composite=CompositeIndex,
+    degree=DegreeIndex,
+    label=LabelIndex,
+    unique=UniqueIndex,
+)
@@ -0,0 +1,64 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Out of line storage of large values.
+
+Values bigger than ``THRESHOLD`` once packed are stored once in the
+``blobs`` keyspace as ``(uid, key) -> value``. The tuples row and the index
+key hold a fixed size reference made of the beginning of the value and its
+hash instead. Storages replace references with the actual value when they
+read them and check the value when it's looked up in the index in case of
+hash collision.
+"""
+from hashlib import sha1
+
+from packing import pack
+from packing import unpack_value
+
+
+THRESHOLD = 1024
+
+# size of the beginning of the value kept in the reference
+PREFIX = 16
+
+MARKER = '\0ajgudb:blob'
+
+
+def reference(packed):
+    """Return the value stored in place of the large value ``packed``"""
+    # msgpack strings are decoded as utf-8, binary data is stored as hex
+    return [MARKER, packed[:PREFIX].encode('hex'), sha1(packed).hexdigest()]
+
+
+def is_reference(value):
+    return type(value) is list and len(value) == 3 and value[0] == MARKER
+
+
+def is_packed_reference(packed):
+    """Return ``True`` if ``packed`` is a packed reference, only small
+    msgpack values that contain the marker are decoded"""
+    if packed[0] != '4' or MARKER not in packed[:32]:
+        return False
+    return is_reference(unpack_value(packed))
+
+
+def indexed(value):
+    """Return the value of the index key of ``value``"""
+    packed = pack(value)
+    if len(packed) > THRESHOLD:
+        return reference(packed)
+    return value
@@ -15,27 +15,98 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA  02110-1301  USA
+from contextlib import contextmanager
+from itertools import islice
+
 from bsddb3.db import DB
 from bsddb3.db import DBEnv
+from bsddb3.db import DB_AUTO_COMMIT
 from bsddb3.db import DB_BTREE
 from bsddb3.db import DB_CREATE
+from bsddb3.db import DB_INIT_LOCK
+from bsddb3.db import DB_INIT_LOG
 from bsddb3.db import DB_INIT_MPOOL
+from bsddb3.db import DB_INIT_TXN
 from bsddb3.db import DB_LOG_AUTO_REMOVE
+from bsddb3.db import DB_MULTIVERSION
+from bsddb3.db import DB_THREAD
+from bsddb3.db import DB_TXN_SNAPSHOT
+from bsddb3.db import DB_TXN_WRITE_NOSYNC
 
+from blobs import THRESHOLD
+from blobs import indexed
+from blobs import is_packed_reference
+from blobs import is_reference
+from blobs import reference
+from compression import Compressor
+from compression import check
 from packing import pack
-from packing import unpack
+from packing import unpack_index
+from packing import unpack_tuple
+from packing import unpack_value
+from spill import BUDGET
+from spill import Runs
+from utils import AjguDBException
+from utils import ReadOnly
+
+
+# number of rows put in each transaction by ingest
+INGEST_BATCH = 10000
+
+
+class BSDDBKeyspace(object):
+    """Ordered key/value store with a subset of plyvel's API"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        if self.db.has_key(key):
+            self.db.delete(key)
+
+    def iterator(self, start=None, stop=None, prefix=None):
+        if prefix is not None:
+            start = prefix
+        cursor = self.db.cursor()
+        try:
+            record = cursor.set_range(start) if start else cursor.first()
+            while record:
+                key, value = record
+                if prefix is not None and not key.startswith(prefix):
+                    break
+                if stop is not None and key >= stop:
+                    break
+                yield key, value
+                record = cursor.next()
+        finally:
+            cursor.close()
 
 
 class BSDDBStorage(object):
     """Generic database"""
 
-    def __init__(self, path):
+    def __init__(self, path, compression=None):
+        check(compression)
         self.env = DBEnv()
         self.env.set_cache_max(10, 0)
         self.env.set_cachesize(5, 0)
+        # transactions are required by snapshots, readers see the previous
+        # versions of pages. Writes are grouped in transactions whose log is
+        # written but not flushed on commit, like leveldb's default writes
+        self.env.set_flags(DB_TXN_WRITE_NOSYNC, True)
         flags = (
             DB_CREATE
             | DB_INIT_MPOOL
+            | DB_INIT_TXN
+            | DB_INIT_LOCK
+            | DB_INIT_LOG
+            | DB_THREAD
         )
         self.env.log_set_config(DB_LOG_AUTO_REMOVE, True)
         self.env.set_lg_max(1024**2)
@@ -45,138 +116,304 @@ class BSDDBStorage(object):
             0
         )
 
-        # create vertices and edges k/v stores
-        def new_store(name):
-            flags = DB_CREATE
-            elements = DB(self.env)
-            elements.open(
-                name,
-                None,
-                DB_BTREE,
-                flags,
-                0,
-            )
-            return elements
-
-        self.index = new_store('index')
-        self.tuples = new_store('tuples')
+        self.index = self._new_store('index')
+        self.tuples = self._new_store('tuples')
+        self._keyspaces = dict()
+        self.blobs = self.keyspace('blobs')
+        self.compressor = Compressor(self.keyspace('meta'), compression)
+
+    def _new_store(self, name):
+        flags = DB_CREATE | DB_AUTO_COMMIT | DB_MULTIVERSION | DB_THREAD
+        elements = DB(self.env)
+        elements.open(
+            name,
+            None,
+            DB_BTREE,
+            flags,
+            0,
+        )
+        return elements
+
+    @contextmanager
+    def _transaction(self):
+        """Yield a transaction committed on success, aborted otherwise"""
+        txn = self.env.txn_begin()
+        try:
+            yield txn
+        except:
+            txn.abort()
+            raise
+        else:
+            txn.commit()
 
     def close(self):
+        for keyspace in self._keyspaces.values():
+            keyspace.db.close()
         self.tuples.close()
         self.index.close()
         self.env.close()
 
+    def snapshot(self):
+        """Return a read only view of the database as of now"""
+        return BSDDBSnapshot(self)
+
+    def keyspace(self, name):
+        """Return the ordered key/value store called ``name``"""
+        try:
+            return self._keyspaces[name]
+        except KeyError:
+            store = self._new_store('keyspace_%s' % name)
+            keyspace = self._keyspaces[name] = BSDDBKeyspace(store)
+            return keyspace
+
+    def _packed(self, key, data):
+        """Return the packed value of the tuple ``key`` stored as
+        ``data``"""
+        packed = self.compressor.decode(data)
+        if is_packed_reference(packed):
+            packed = self.compressor.decode(self.blobs.get(key))
+        return packed
+
+    def _value(self, key, data):
+        """Return the value of the tuple ``key`` stored as ``data``"""
+        return unpack_value(self._packed(key, data))
+
     def ref(self, uid, key):
-        cursor = self.tuples.cursor()
-        query = pack(uid, key)
-        record = cursor.set_range(query)
-        if not record:
-            cursor.close()
-            return
-        key, value = record
-        if key == query:
-            value = unpack(value)[0]
-            cursor.close()
-            return value
-        else:
-            cursor.close()
+        key = pack(uid, key)
+        value = self.tuples.get(key)
+        if value is None:
             return None
+        return self._value(key, value)
 
-    def get(self, uid):
+    def get_packed(self, uid):
+        """Return the list of ``(key, packed value)`` of ``uid``, values
+        are not decoded"""
         cursor = self.tuples.cursor()
+        prefix = pack(uid)
 
         def __get():
-            record = cursor.set_range(pack(uid, ''))
+            record = cursor.set_range(prefix)
             if not record:
                 return
-            key, value = record
+            packed, value = record
             while True:
-                other, key = unpack(key)
-                if other == uid:
-                    value = unpack(value)[0]
-                    yield key, value
+                if packed.startswith(prefix):
+                    key = unpack_tuple(packed)[1]
+                    yield key, self._packed(packed, value)
                     record = cursor.next()
                     if record:
-                        key, value = record
+                        packed, value = record
                         continue
                     else:
                         break
                 else:
                     break
 
-        tuples = dict(__get())
+        rows = list(__get())
         cursor.close()
-        return tuples
+        return rows
 
-    def add(self, uid, **properties):
+    def get(self, uid):
+        return dict(
+            (key, unpack_value(packed)) for key, packed in self.get_packed(uid)
+        )
+
+    def _rows(self, uid, properties):
+        """Iterate ``(store, key, value)`` rows of an element"""
         for key, value in properties.items():
-            self.tuples.put(pack(uid, key), pack(value))
-            self.index.put(pack(key, value, uid), '')
+            packed = pack(value)
+            if len(packed) > THRESHOLD:
+                blob = self.compressor.encode(key, packed)
+                yield self.blobs.db, pack(uid, key), blob
+                value = reference(packed)
+                packed = pack(value)
+            packed = self.compressor.encode(key, packed)
+            yield self.tuples, pack(uid, key), packed
+            yield self.index, pack(key, value, uid), ''
+
+    def add_many(self, elements):
+        """Add every ``(uid, properties)`` of ``elements`` in one
+        transaction"""
+        with self._transaction() as txn:
+            for uid, properties in elements:
+                self._add(uid, properties, txn)
+
+    def add(self, uid, **properties):
+        with self._transaction() as txn:
+            self._add(uid, properties, txn)
+
+    def _add(self, uid, properties, txn):
+        for store, key, value in self._rows(uid, properties):
+            store.put(key, value, txn=txn)
+
+    def ingest(self, elements, budget=BUDGET):
+        """Add every ``(uid, properties)`` of ``elements``. Rows are sorted
+        on disk and put in key order so that btree pages are filled
+        sequentially instead of being split at random"""
+        stores = (self.blobs.db, self.tuples, self.index)
+        with Runs(budget) as runs:
+            for uid, properties in elements:
+                for store, key, value in self._rows(uid, properties):
+                    # the first byte tells which store the row belongs to
+                    runs.add(chr(stores.index(store)) + key, value)
+            runs = iter(runs)
+            while True:
+                batch = list(islice(runs, INGEST_BATCH))
+                if not batch:
+                    break
+                with self._transaction() as txn:
+                    for key, value in batch:
+                        stores[ord(key[0])].put(key[1:], value, txn=txn)
+
+    def delete_many(self, uids):
+        """Delete every element of ``uids`` in one transaction"""
+        with self._transaction() as txn:
+            for uid in uids:
+                self._delete(uid, txn)
 
     def delete(self, uid):
+        # stores are transactional, cursor writes must be done in a
+        # transaction that is aborted if anything goes wrong
+        with self._transaction() as txn:
+            self._delete(uid, txn)
+
+    def _delete(self, uid, txn):
         # delete item from main table and index
-        cursor = self.tuples.cursor()
-        index = self.index.cursor()
-        record = cursor.set_range(pack(uid, ''))
-        if record:
+        cursor = self.tuples.cursor(txn=txn)
+        index = self.index.cursor(txn=txn)
+        prefix = pack(uid)
+        try:
+            record = cursor.set_range(prefix)
+            if not record:
+                raise AjguDBException('not found')
             key, value = record
-        else:
-            cursor.close()
-            raise AjguDBException('not found')
-        while True:
-            other, key = unpack(key)
-            if other == uid:
+            while key.startswith(prefix):
+                name = unpack_tuple(key)[1]
                 # remove tuple from main index
                 cursor.delete()
 
-                # remove it from index
-                value = unpack(value)[0]
-                index.set(pack(key, value, uid))
+                # remove it from index, the index key of large values
+                # holds the reference
+                value = unpack_value(self.compressor.decode(value))
+                index.set(pack(name, value, uid))
                 index.delete()
+                if is_reference(value):
+                    self.blobs.db.delete(key, txn=txn)
 
                 # continue
                 record = cursor.next()
-                if record:
-                    key, value = record
-                    continue
-                else:
+                if not record:
                     break
-            else:
-                break
-        cursor.close()
+                key, value = record
+        finally:
+            index.close()
+            cursor.close()
 
     def update(self, uid, **properties):
-        self.delete(uid)
-        self.add(uid, **properties)
+        with self._transaction() as txn:
+            self._delete(uid, txn)
+            self._add(uid, properties, txn)
 
     def debug(self):
-        for key, value in self.tuples.items():
-            uid, key = unpack(key)
-            value = unpack(value)[0]
+        for packed, value in self.tuples.items():
+            uid, key = unpack_tuple(packed)
+            value = self._value(packed, value)
             print(uid, key, value)
 
     def query(self, key, value=''):
         cursor = self.index.cursor()
-        match = (key, value) if value else (key,)
-
-        record = cursor.set_range(pack(key, value))
+        match = (key, indexed(value)) if value else (key,)
+        # packed values are prefix free, rows matching every value of
+        # ``match`` are the rows that start with its packed bytes
+        prefix = pack(*match)
+        record = cursor.set_range(prefix)
         if not record:
             cursor.close()
             return
 
         while True:
             key, _ = record
-            other = unpack(key)
-            ok = reduce(
-                lambda previous, x: (cmp(*x) == 0) and previous,
-                zip(match, other),
-                True
-            )
-            if ok:
-                yield other
+            if key.startswith(prefix):
+                other = unpack_index(key)
+                if is_reference(other[1]):
+                    other[1] = self.ref(other[2], other[0])
+                if not value or other[1] == value:
+                    # otherwise it's a hash collision
+                    yield other
                 record = cursor.next()
                 if not record:
                     break
             else:
                 break
         cursor.close()
+
+    def query_many(self, key, values):
+        """Iterate the index rows of ``key`` and every value of ``values``
+        in the order of ``values``. A single cursor moves forward when
+        values are sorted"""
+        cursor = self.index.cursor()
+        try:
+            for value in values:
+                prefix = pack(key, indexed(value))
+                record = cursor.set_range(prefix)
+                while record and record[0].startswith(prefix):
+                    other = unpack_index(record[0])
+                    if is_reference(other[1]):
+                        other[1] = self.ref(other[2], other[0])
+                    if other[1] == value:
+                        # otherwise it's a hash collision
+                        yield other
+                    record = cursor.next()
+        finally:
+            cursor.close()
+
+
+class BSDDBSnapshotStore(object):
+    """Read only view of ``db`` in the transaction ``txn``"""
+
+    def __init__(self, db, txn):
+        self.db = db
+        self.txn = txn
+
+    def get(self, key):
+        return self.db.get(key, txn=self.txn)
+
+    def cursor(self):
+        return self.db.cursor(txn=self.txn)
+
+    def items(self):
+        cursor = self.cursor()
+        try:
+            record = cursor.first()
+            while record:
+                yield record
+                record = cursor.next()
+        finally:
+            cursor.close()
+
+
+class BSDDBSnapshot(ReadOnly, BSDDBStorage):
+    """Read only view of ``storage``, every store is read in the same
+    snapshot transaction"""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.env = storage.env
+        self.txn = storage.env.txn_begin(flags=DB_TXN_SNAPSHOT)
+        self.tuples = BSDDBSnapshotStore(storage.tuples, self.txn)
+        self.index = BSDDBSnapshotStore(storage.index, self.txn)
+        self._keyspaces = dict()
+        self.blobs = self.keyspace('blobs')
+        self.compressor = storage.compressor
+
+    def close(self):
+        self.txn.commit()
+
+    def keyspace(self, name):
+        try:
+            return self._keyspaces[name]
+        except KeyError:
+            db = self._storage.keyspace(name).db
+            store = BSDDBSnapshotStore(db, self.txn)
+            keyspace = self._keyspaces[name] = BSDDBKeyspace(store)
+            return keyspace
@@ -0,0 +1,285 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Query result cache.
+
+``VersionedStorage`` wraps the storage and counts writes: ``version`` is
+bumped by every write and ``versions[key]`` by every write of an element
+that has or had ``key``. ``QueryCache`` keeps the results of queries by
+their steps and input. A result is valid as long as the versions of the
+keys read by its steps didn't change, or the store-wide version when the
+steps might read any key, eg. ``get`` or steps given a function like
+``each``, ``filter`` or ``sort(key=...)``. It's only used when the database
+is opened with ``AjguDB(path, cache=size)``.
+"""
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import chain
+
+from ajgudb import Edge
+from ajgudb import Vertex
+from gremlin import _STEPS
+from gremlin import spec
+
+
+# results with more items are not cached
+LIMIT = 10000
+
+
+# keys read by steps, steps that are not listed might read any key
+READS = dict(
+    select=lambda args, kwargs: kwargs.keys(),
+    search=lambda args, kwargs: args[:1],
+    key=lambda args, kwargs: args,
+    keys=lambda args, kwargs: args,
+    vertices=lambda args, kwargs: ('_meta_type',),
+    edges=lambda args, kwargs: ('_meta_type',),
+    outgoings=lambda args, kwargs: ('_meta_start', 'label'),
+    incomings=lambda args, kwargs: ('_meta_end', 'label'),
+    start=lambda args, kwargs: ('_meta_start',),
+    end=lambda args, kwargs: ('_meta_end',),
+    degree=lambda args, kwargs: ('_meta_start', '_meta_end'),
+)
+
+# steps that don't read the storage unless they are given a function
+PURE = frozenset((
+    'skip', 'limit', 'paginator', 'count', 'value', 'sort', 'unique',
+    'back', 'path', 'mean', 'group_count', 'spilled_group_count', 'scatter',
+))
+
+
+def canonical(steps):
+    """Return a hashable description of ``steps`` or ``None`` if the query
+    can't be cached"""
+    out = list()
+    for step in steps:
+        name, args, kwargs = spec(step)
+        if _STEPS.get(name) is None or name == 'link':
+            # it can't be described or it writes
+            return None
+        kwargs = tuple(sorted(kwargs.items())) if kwargs else None
+        out.append((name, tuple(args) if args else args, kwargs))
+    out = tuple(out)
+    try:
+        hash(out)
+    except TypeError:
+        return None
+    return out
+
+
+def _calls(args, kwargs):
+    """Return ``True`` if ``args`` or ``kwargs`` of ``canonical`` hold a
+    function"""
+    values = list(args or ()) + [value for _, value in kwargs or ()]
+    return any(callable(value) for value in values)
+
+
+def reads(steps):
+    """Return the keys read by ``steps`` of ``canonical`` or ``None`` if
+    they might read any key"""
+    keys = set()
+    for name, args, kwargs in steps:
+        if _calls(args, kwargs):
+            # functions are given the database, they can read anything
+            return None
+        if name in PURE:
+            continue
+        try:
+            read = READS[name]
+        except KeyError:
+            return None
+        keys.update(read(args or (), dict(kwargs or ())))
+    return frozenset(keys)
+
+
+class VersionedStorage(object):
+    """Wrap ``storage`` to count its writes"""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.version = 0
+        self.versions = dict()
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if name == 'ingest':
+            # it's only available when the storage has it
+            return self._ingest(attr)
+        return attr
+
+    def _bump(self, keys):
+        self.version += 1
+        for key in keys:
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _keys(self, uid):
+        return [key for key, _ in self._storage.get_packed(uid)]
+
+    def _ingest(self, ingest):
+        def wrapper(elements, *args):
+            keys = set()
+
+            def record():
+                for uid, properties in elements:
+                    keys.update(properties)
+                    yield uid, properties
+
+            try:
+                ingest(record(), *args)
+            finally:
+                self._bump(keys)
+        return wrapper
+
+    def close(self):
+        self._storage.close()
+
+    def add(self, uid, **properties):
+        self._storage.add(uid, **properties)
+        self._bump(properties)
+
+    def add_many(self, elements, **kwargs):
+        self._storage.add_many(elements, **kwargs)
+        keys = set()
+        for _, properties in elements:
+            keys.update(properties)
+        self._bump(keys)
+
+    def update(self, uid, **properties):
+        keys = set(self._keys(uid))
+        keys.update(properties)
+        self._storage.update(uid, **properties)
+        self._bump(keys)
+
+    def delete(self, uid):
+        keys = self._keys(uid)
+        self._storage.delete(uid)
+        self._bump(keys)
+
+    def delete_many(self, uids, **kwargs):
+        uids = list(uids)
+        keys = set()
+        for uid in uids:
+            keys.update(self._keys(uid))
+        self._storage.delete_many(uids, **kwargs)
+        self._bump(keys)
+
+
+def copy(value):
+    """Return a copy of ``value`` that doesn't share anything mutable with
+    it, elements keep their database"""
+    if isinstance(value, Edge):
+        properties = deepcopy(dict(value))
+        properties['_meta_start'] = value._start
+        properties['_meta_end'] = value._end
+        return Edge(value._graphdb, value.uid, properties)
+    elif isinstance(value, Vertex):
+        return Vertex(value._graphdb, value.uid, deepcopy(dict(value)))
+    elif isinstance(value, tuple) and hasattr(value, '_fields'):
+        # eg. GremlinResult
+        return type(value)(*[copy(x) for x in value])
+    elif isinstance(value, (list, tuple)):
+        return type(value)(copy(x) for x in value)
+    elif isinstance(value, dict):
+        out = type(value)()
+        for key, other in value.items():
+            out[key] = copy(other)
+        return out
+    return deepcopy(value)
+
+
+def _weight(item):
+    """Number of values held by the result ``item``"""
+    if isinstance(item, dict) and not isinstance(item, (Edge, Vertex)):
+        # eg. the Counter of group_count
+        return max(len(item), 1)
+    return 1
+
+
+class QueryCache(object):
+    """Least recently used cache of ``size`` query results of
+    ``storage`` which is a ``VersionedStorage``. Results with more than
+    ``limit`` items are not cached"""
+
+    def __init__(self, storage, size, limit=LIMIT):
+        self._storage = storage
+        self.size = size
+        self.limit = limit
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _versions(self, keys):
+        if keys is None:
+            return self._storage.version
+        versions = self._storage.versions
+        return tuple(versions.get(key, 0) for key in sorted(keys))
+
+    def execute(self, query, steps, options, graphdb, iterator):
+        """Return the result of ``query`` of ``steps`` and ``options``
+        executed with ``iterator`` from the cache or execute it and cache
+        it"""
+        if iterator is None:
+            uid = None
+        elif hasattr(iterator, 'uid'):
+            uid = iterator.uid
+        else:
+            # the input can't be compared
+            return query(graphdb, iterator)
+        description = canonical(steps)
+        if description is None:
+            return query(graphdb, iterator)
+        key = (description, options.get('paths'), uid)
+        try:
+            keys, versions, result, lazy = self._entries.pop(key)
+        except KeyError:
+            pass
+        else:
+            if versions == self._versions(keys):
+                self.hits += 1
+                self._entries[key] = (keys, versions, result, lazy)
+                return self._result(result, lazy)
+        self.misses += 1
+        keys = reads(description)
+        versions = self._versions(keys)
+        result = query(graphdb, iterator)
+        lazy = hasattr(result, 'next')
+        if lazy:
+            # items are read until the result is known to be too big
+            items = list()
+            weight = 0
+            for item in result:
+                items.append(item)
+                weight += _weight(item)
+                if weight > self.limit:
+                    return chain(items, result)
+            result = items
+        elif isinstance(result, (list, dict)):
+            if sum(_weight(item) for item in result) > self.limit:
+                return result
+        # the caller can modify the result, the cache keeps a copy
+        self._store(key, (keys, versions, copy(result), lazy))
+        return iter(result) if lazy else result
+
+    def _result(self, result, lazy):
+        # cached values are never given away
+        result = copy(result)
+        return iter(result) if lazy else result
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
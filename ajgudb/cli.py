@@ -0,0 +1,135 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""ajgudb command line interface"""
+import os
+from argparse import ArgumentParser
+from importlib import import_module
+
+
+STORAGES = dict(
+    leveldb=('ajgudb.leveldb', 'LevelDBStorage'),
+    bsddb=('ajgudb.bsddb', 'BSDDBStorage'),
+    wiredtiger=('ajgudb.wt', 'WiredTigerStorage'),
+)
+
+
+def storage_class(name):
+    """Import the storage class called ``name``, backends are optional"""
+    module, name = STORAGES[name]
+    return getattr(import_module(module), name)
+
+
+def serve(args):
+    from .remote import StorageServer
+
+    server = StorageServer(
+        args.path,
+        storage_class(args.storage),
+        args.socket,
+        args.compression,
+    )
+    print('serving %s on %s' % (args.path, server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def import_(args):
+    from .ajgudb import AjguDB
+    from .importer import Importer
+
+    if not os.path.exists(args.path):
+        os.makedirs(args.path)
+    graphdb = AjguDB(args.path, storage_class(args.storage))
+    try:
+        importer = Importer(
+            graphdb,
+            workers=args.workers,
+            batch=args.batch,
+            key=args.id,
+            start=args.start,
+            end=args.end,
+            sort=args.sort,
+            budget=args.budget * 2**20,
+        )
+        count = importer.run(args.vertices, args.edges)
+    finally:
+        graphdb.close()
+    print('imported %d records' % count)
+    if importer.skipped:
+        print('skipped %d edges with unknown vertices' % importer.skipped)
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='ajgudb')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser(
+        'serve',
+        help='share the database with other processes over a unix socket',
+    )
+    command.add_argument('path')
+    command.add_argument('--socket', help='default: PATH/ajgudb.sock')
+    command.add_argument(
+        '--storage', choices=sorted(STORAGES.keys()), default='leveldb'
+    )
+    command.add_argument(
+        '--compression', choices=('zlib', 'zstd', 'lz4'),
+        help='codec of the values written, default: no compression',
+    )
+    command.set_defaults(func=serve)
+
+    command = commands.add_parser(
+        'import',
+        help='import vertices and edges from CSV or JSON lines files',
+    )
+    command.add_argument('path')
+    command.add_argument(
+        '--vertices', action='append', default=[], metavar='FILE',
+    )
+    command.add_argument(
+        '--edges', action='append', default=[], metavar='FILE',
+    )
+    command.add_argument(
+        '--storage', choices=sorted(STORAGES.keys()), default='leveldb'
+    )
+    command.add_argument(
+        '--workers', type=int, help='parser processes, default: cpu count',
+    )
+    command.add_argument('--batch', type=int, default=1000)
+    command.add_argument('--id', default='id', help='vertex identifier')
+    command.add_argument('--start', default='start', help='edge start')
+    command.add_argument('--end', default='end', help='edge end')
+    command.add_argument(
+        '--sort', action='store_true',
+        help='sort rows on disk and write them in key order',
+    )
+    command.add_argument(
+        '--budget', type=int, default=64, help='sort memory in MB',
+    )
+    command.set_defaults(func=import_)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Composite index.
+
+Rows are stored in the ``composite`` keyspace as
+``(name, key1, value1, key2, value2, ..., uid)`` so that elements matching
+all the values are found with a single prefix scan.
+"""
+from packing import pack
+from packing import unpack_value
+
+
+class CompositeIndex(object):
+
+    def __init__(self, graphdb, *keys):
+        self._graphdb = graphdb
+        self._rows = graphdb._tuples.keyspace('composite')
+        self.keys = keys
+        self.name = ','.join(keys)
+
+    def _prefix(self, values):
+        items = list()
+        for key, value in zip(self.keys, values):
+            items.append(key)
+            items.append(value)
+        return pack(self.name, *items)
+
+    def _values(self, properties):
+        try:
+            return [properties[key] for key in self.keys]
+        except KeyError:
+            return None
+
+    def add(self, uid, properties):
+        values = self._values(properties)
+        if values is not None:
+            self._rows.put(self._prefix(values) + pack(uid), '')
+
+    def delete(self, uid, properties):
+        values = self._values(properties)
+        if values is not None:
+            self._rows.delete(self._prefix(values) + pack(uid))
+
+    def backfill(self):
+        tuples = self._graphdb._tuples
+        for _, value, uid in tuples.query(self.keys[0]):
+            properties = {self.keys[0]: value}
+            for key in self.keys[1:]:
+                other = tuples.ref(uid, key)
+                if other is None:
+                    break
+                properties[key] = other
+            else:
+                self.add(uid, properties)
+
+    def query(self, **properties):
+        """Iterate uids of the elements matching ``properties`` on the
+        keys of the index"""
+        prefix = self._prefix([properties[key] for key in self.keys])
+        for key, _ in self._rows.iterator(prefix=prefix):
+            yield unpack_value(key[len(prefix):])
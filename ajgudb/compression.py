@@ -0,0 +1,181 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Compression of the values of the tuples keyspace.
+
+Packed values start with a type byte between ``1`` and ``4``, compressed
+values start with the byte of the codec that compressed them, so that
+values written with any codec or without compression can be read back
+whatever the codec the database is opened with. Values compressed with a
+zstd dictionary are followed by the identifier of the dictionary.
+Dictionaries are stored in the ``meta`` keyspace as
+``(dictionary, identifier, key) -> dictionary``.
+"""
+import struct
+import zlib
+
+from packing import pack
+from packing import unpack
+from utils import AjguDBException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+# smaller values are not worth compressing
+THRESHOLD = 64
+
+RAW = '1234'
+
+ZLIB = 'z'
+ZSTD = 's'
+LZ4 = 'l'
+DICTIONARY = 'd'
+
+CODECS = dict(zlib=ZLIB, zstd=ZSTD, lz4=LZ4)
+
+
+def available(codec):
+    """Return ``True`` if the python module of ``codec`` is installed"""
+    if codec == 'zlib':
+        return True
+    elif codec == 'zstd':
+        return zstandard is not None
+    elif codec == 'lz4':
+        return lz4 is not None
+    return False
+
+
+def check(codec, python=True):
+    """Raise ``AjguDBException`` if values can't be written with ``codec``.
+    When ``python`` is false the codec isn't used from python, eg. by the
+    block compressor of WiredTiger, only its name is checked"""
+    if codec is not None and codec not in CODECS:
+        raise AjguDBException('unknown codec %s' % codec)
+    if python and codec is not None and not available(codec):
+        raise AjguDBException('codec %s is not installed' % codec)
+
+
+class Compressor(object):
+    """Encode and decode packed values of the tuples keyspace.
+
+    ``meta`` is the keyspace where dictionaries are stored, ``codec`` is
+    the name of the codec used to write values, when it's ``None`` values
+    are written as is."""
+
+    def __init__(self, meta, codec=None, threshold=THRESHOLD):
+        check(codec)
+        self._meta = meta
+        self.codec = codec
+        self.threshold = threshold
+        # identifier -> dictionary
+        self._dictionaries = dict()
+        # key -> identifier of its latest dictionary
+        self._keys = dict()
+        self._compressors = dict()
+        self._decompressors = dict()
+        for key, data in meta.iterator(prefix=pack('dictionary')):
+            _, identifier, name = unpack(key)
+            self._dictionaries[identifier] = data
+            self._keys[name] = max(identifier, self._keys.get(name, 0))
+
+    def _compressor(self, identifier):
+        try:
+            return self._compressors[identifier]
+        except KeyError:
+            data = self._dictionaries[identifier]
+            data = zstandard.ZstdCompressionDict(data)
+            compressor = zstandard.ZstdCompressor(dict_data=data)
+            self._compressors[identifier] = compressor
+            return compressor
+
+    def _decompressor(self, identifier):
+        try:
+            return self._decompressors[identifier]
+        except KeyError:
+            try:
+                data = self._dictionaries[identifier]
+            except KeyError:
+                raise AjguDBException('unknown dictionary %s' % identifier)
+            data = zstandard.ZstdCompressionDict(data)
+            decompressor = zstandard.ZstdDecompressor(dict_data=data)
+            self._decompressors[identifier] = decompressor
+            return decompressor
+
+    def train(self, key, samples, size=16384):
+        """Train a zstd dictionary of ``size`` bytes for the values of
+        ``key`` using ``samples`` packed values, it's used to compress the
+        values written afterwards"""
+        if zstandard is None:
+            raise AjguDBException('codec zstd is not installed')
+        try:
+            data = zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError as exc:
+            raise AjguDBException('dictionary training failed: %s' % exc)
+        identifier = max(self._dictionaries.keys() or [0]) + 1
+        # dictionaries are binary, they can't be packed
+        self._meta.put(pack('dictionary', identifier, key), data)
+        self._dictionaries[identifier] = data
+        self._keys[key] = identifier
+        return identifier
+
+    def encode(self, key, packed):
+        """Return the value of ``key`` as stored in the tuples keyspace"""
+        if self.codec is None or len(packed) < self.threshold:
+            return packed
+        if self.codec == 'zstd' and key in self._keys:
+            identifier = self._keys[key]
+            data = self._compressor(identifier).compress(packed)
+            data = DICTIONARY + struct.pack('>I', identifier) + data
+        elif self.codec == 'zstd':
+            data = ZSTD + zstandard.ZstdCompressor().compress(packed)
+        elif self.codec == 'lz4':
+            data = LZ4 + lz4.compress(packed)
+        else:
+            data = ZLIB + zlib.compress(packed)
+        # incompressible values are stored as is
+        return data if len(data) < len(packed) else packed
+
+    def decode(self, data):
+        """Return the packed value of ``data``"""
+        header = data[0]
+        if header in RAW:
+            return data
+        elif header == ZLIB:
+            return zlib.decompress(data[1:])
+        elif header == ZSTD:
+            if zstandard is None:
+                raise AjguDBException('codec zstd is not installed')
+            return zstandard.ZstdDecompressor().decompress(data[1:])
+        elif header == DICTIONARY:
+            if zstandard is None:
+                raise AjguDBException('codec zstd is not installed')
+            identifier = struct.unpack('>I', data[1:5])[0]
+            return self._decompressor(identifier).decompress(data[5:])
+        elif header == LZ4:
+            if lz4 is None:
+                raise AjguDBException('codec lz4 is not installed')
+            return lz4.decompress(data[1:])
+        else:
+            raise AjguDBException('unknown codec header %r' % header)
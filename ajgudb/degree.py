@@ -0,0 +1,150 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Degree counters.
+
+The number of outgoing and incoming edges of every vertex is stored in the
+``degree`` keyspace as ``(uid, direction) -> count`` where direction is
+``out`` or ``in``, so that the degree of a vertex is read with a single
+lookup instead of a scan of its edges. Vertices without edges have no row.
+
+When the storage has ``keyspace_rows``, eg. ``LevelDBStorage``, counters
+are written in the same atomic batch as the edges, see ``AjguDB._add_many``
+and ``AjguDB._delete_many``. Otherwise they are written right after the
+edges and a crash in between leaves them wrong, ``rebuild`` counts them
+again. With ``RemoteStorage`` the counters are read and written by the
+server under its lock, see ``StorageServer.increment``, so that clients
+don't lose each other increments.
+"""
+from itertools import groupby
+from itertools import islice
+
+from packing import pack
+from packing import unpack_value
+
+
+DIRECTIONS = (('_meta_start', 'out'), ('_meta_end', 'in'))
+
+# number of rows deleted at once by ``rebuild``
+CHUNK = 1000
+
+
+def counts(rows, deltas):
+    """Return the ``(key, value)`` rows of the counters of the keyspace
+    ``rows`` once the ``(key, delta)`` of ``deltas`` are added, ``value``
+    is ``None`` when the row must be deleted"""
+    out = list()
+    for key, delta in deltas:
+        count = rows.get(key)
+        count = (0 if count is None else unpack_value(count)) + delta
+        out.append((key, pack(count) if count > 0 else None))
+    return out
+
+
+def increment(rows, deltas):
+    """Add the ``(key, delta)`` of ``deltas`` to the counters of the
+    keyspace ``rows``"""
+    for key, value in counts(rows, deltas):
+        if value is None:
+            rows.delete(key)
+        else:
+            rows.put(key, value)
+
+
+class DegreeIndex(object):
+
+    def __init__(self, graphdb):
+        self._graphdb = graphdb
+        self._rows = graphdb._tuples.keyspace('degree')
+        self.name = 'degree'
+
+    def _counters(self, properties):
+        """Return the counters changed by the edge ``properties``"""
+        try:
+            return [
+                (properties[key], direction) for key, direction in DIRECTIONS
+            ]
+        except KeyError:
+            # it's a vertex
+            return []
+
+    def deltas(self, added=(), deleted=()):
+        """Return the ``(key, delta)`` of the counters changed by the
+        ``(uid, properties)`` of ``added`` and ``deleted``"""
+        # counters are written once per batch
+        deltas = dict()
+        for elements, delta in ((added, 1), (deleted, -1)):
+            for _, properties in elements:
+                for counter in self._counters(properties):
+                    deltas[counter] = deltas.get(counter, 0) + delta
+        return [
+            (pack(uid, direction), delta)
+            for (uid, direction), delta in deltas.items()
+            if delta != 0
+        ]
+
+    def rows(self, added=(), deleted=()):
+        """Return the ``(key, value)`` rows of the counters changed by the
+        ``(uid, properties)`` of ``added`` and ``deleted``, ``value`` is
+        ``None`` when the row must be deleted"""
+        return counts(self._rows, self.deltas(added, deleted))
+
+    def _write(self, deltas):
+        tuples = self._graphdb._tuples
+        if hasattr(tuples, 'increment'):
+            # the counters are read and written in a single call
+            tuples.increment('degree', deltas)
+        else:
+            increment(self._rows, deltas)
+
+    def degree(self, uid, direction):
+        """Return the number of ``out`` or ``in`` edges of ``uid``"""
+        count = self._rows.get(pack(uid, direction))
+        return 0 if count is None else unpack_value(count)
+
+    def add(self, uid, properties):
+        self.add_many([(uid, properties)])
+
+    def add_many(self, elements):
+        self._write(self.deltas(added=elements))
+
+    def update(self, uid, previous, properties):
+        # edges keep their vertices, it doesn't change anything
+        self._write(self.deltas([(uid, properties)], [(uid, previous)]))
+
+    def delete(self, uid, properties):
+        self._write(self.deltas(deleted=[(uid, properties)]))
+
+    def backfill(self):
+        tuples = self._graphdb._tuples
+        for key, direction in DIRECTIONS:
+            # index rows of a vertex are next to each other
+            rows = groupby(tuples.query(key), lambda row: row[1])
+            for uid, edges in rows:
+                count = sum(1 for _ in edges)
+                self._rows.put(pack(uid, direction), pack(count))
+
+    def rebuild(self):
+        """Delete every counter and count the edges again"""
+        while True:
+            # rows are not deleted while they are iterated
+            keys = [key for key, _ in islice(self._rows.iterator(), CHUNK)]
+            if not keys:
+                break
+            for key in keys:
+                self._rows.delete(key)
+        self.backfill()
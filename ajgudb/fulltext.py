@@ -0,0 +1,144 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Full-text index.
+
+Postings are stored in the ``fulltext`` keyspace as
+``(key, term, uid) -> term frequency``. Since uids are packed as big endian
+integers the postings of a term are sorted by uid, so that ``and`` and
+``or`` searches are sorted merges of postings.
+"""
+import re
+from collections import Counter
+from heapq import merge
+from unicodedata import category
+from unicodedata import normalize
+
+from packing import pack
+from packing import unpack_value
+from utils import AjguDBException
+
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the list of normalized terms of ``text``"""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, unicode):
+        return list()
+    # lower case and strip accents
+    text = normalize('NFKD', text.lower())
+    text = u''.join(char for char in text if category(char) != 'Mn')
+    return WORD.findall(text)
+
+
+def _check(mode):
+    if mode not in ('and', 'or'):
+        raise AjguDBException('mode must be "and" or "or"')
+
+
+class FullTextIndex(object):
+
+    def __init__(self, graphdb, key):
+        self._graphdb = graphdb
+        self._postings = graphdb._tuples.keyspace('fulltext')
+        self.key = key
+
+    def add(self, uid, properties):
+        try:
+            value = properties[self.key]
+        except KeyError:
+            return
+        for term, frequency in Counter(tokenize(value)).items():
+            self._postings.put(pack(self.key, term, uid), pack(frequency))
+
+    def delete(self, uid, properties):
+        try:
+            value = properties[self.key]
+        except KeyError:
+            return
+        for term in set(tokenize(value)):
+            self._postings.delete(pack(self.key, term, uid))
+
+    def backfill(self):
+        for _, value, uid in self._graphdb._tuples.query(self.key):
+            self.add(uid, {self.key: value})
+
+    def postings(self, term):
+        """Iterate ``(uid, frequency)`` of ``term`` sorted by uid"""
+        prefix = pack(self.key, term)
+        for key, value in self._postings.iterator(prefix=prefix):
+            uid = unpack_value(key[len(prefix):])
+            yield uid, unpack_value(value)
+
+    def _and(self, terms):
+        iterators = [self.postings(term) for term in terms]
+        try:
+            heads = [next(iterator) for iterator in iterators]
+        except StopIteration:
+            return
+        while True:
+            uids = [uid for uid, _ in heads]
+            target = max(uids)
+            if target == min(uids):
+                yield target, sum(frequency for _, frequency in heads)
+                target += 1
+            try:
+                # advance every postings list that is behind ``target``
+                for index, iterator in enumerate(iterators):
+                    while heads[index][0] < target:
+                        heads[index] = next(iterator)
+            except StopIteration:
+                return
+
+    def _or(self, terms):
+        uid, score = None, 0
+        for other, frequency in merge(*[self.postings(x) for x in terms]):
+            if other == uid:
+                score += frequency
+            else:
+                if uid is not None:
+                    yield uid, score
+                uid, score = other, frequency
+        if uid is not None:
+            yield uid, score
+
+    def search(self, text, mode='and'):
+        """Iterate ``(uid, score)`` of the elements matching ``text``
+        sorted by uid. The score is the sum of term frequencies"""
+        _check(mode)
+        terms = sorted(set(tokenize(text)))
+        if not terms:
+            return iter([])
+        if mode == 'and':
+            return self._and(terms)
+        else:
+            return self._or(terms)
+
+    def match(self, value, text, mode='and'):
+        """Return ``True`` if ``value`` matches ``text``"""
+        _check(mode)
+        terms = set(tokenize(text))
+        if not terms:
+            return False
+        words = set(tokenize(value))
+        if mode == 'and':
+            return terms.issubset(words)
+        else:
+            return bool(terms.intersection(words))
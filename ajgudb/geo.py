@@ -0,0 +1,200 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Geographic index.
+
+Coordinates are quantized on 31 bits and interleaved into a Z-order key,
+rows are stored in the ``geo`` keyspace as ``(name, z, uid) -> (lat, lon)``.
+Points that are close share a long prefix of their Z-order key, so a region
+is covered by a small set of key ranges. Candidates found in those ranges
+are refined with the exact coordinates stored in the row.
+"""
+from math import asin
+from math import cos
+from math import degrees
+from math import radians
+from math import sin
+from math import sqrt
+
+from packing import pack
+from packing import unpack
+
+
+BITS = 31
+
+SCALE = 2**BITS - 1
+
+EARTH_RADIUS = 6371008.8  # meters
+
+# maximum number of cells used to cover a bounding box
+MAX_CELLS = 16
+
+
+def _quantize(value, minimum, maximum):
+    value = min(max(value, minimum), maximum)
+    return int(float(value - minimum) / (maximum - minimum) * SCALE)
+
+
+def interleave(x, y):
+    """Interleave the bits of ``x`` and ``y``, ``x`` bits are odd bits"""
+    z = 0
+    for bit in range(BITS):
+        z |= ((y >> bit) & 1) << (2 * bit)
+        z |= ((x >> bit) & 1) << (2 * bit + 1)
+    return z
+
+
+def zorder(lat, lon):
+    return interleave(_quantize(lon, -180, 180), _quantize(lat, -90, 90))
+
+
+def distance(lat, lon, other_lat, other_lon):
+    """Haversine distance in meters"""
+    lat, lon = radians(lat), radians(lon)
+    other_lat, other_lon = radians(other_lat), radians(other_lon)
+    a = (
+        sin((other_lat - lat) / 2) ** 2
+        + cos(lat) * cos(other_lat) * sin((other_lon - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(a)))
+
+
+def cover(south, west, north, east):
+    """Return sorted ``(start, stop)`` Z-order ranges covering the box"""
+    x0, x1 = _quantize(west, -180, 180), _quantize(east, -180, 180)
+    y0, y1 = _quantize(south, -90, 90), _quantize(north, -90, 90)
+
+    def count(shift):
+        width = (x1 >> shift) - (x0 >> shift) + 1
+        height = (y1 >> shift) - (y0 >> shift) + 1
+        return width * height
+
+    # find the smallest cells such that the box is covered by few of them
+    shift = 0
+    while count(shift) > MAX_CELLS:
+        shift += 1
+    cells = list()
+    for x in range(x0 >> shift, (x1 >> shift) + 1):
+        for y in range(y0 >> shift, (y1 >> shift) + 1):
+            cells.append(interleave(x, y))
+    cells.sort()
+    ranges = list()
+    for cell in cells:
+        start, stop = cell << (2 * shift), (cell + 1) << (2 * shift)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+
+def _boxes(south, west, north, east):
+    """Split boxes that cross the antimeridian"""
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180), (south, -180, north, east)]
+
+
+def inside(lat, lon, south, west, north, east):
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lon <= east
+    return lon >= west or lon <= east
+
+
+def around(lat, lon, radius):
+    """Return the bounding box of the circle of ``radius`` meters"""
+    delta = degrees(radius / EARTH_RADIUS)
+    south, north = max(lat - delta, -90), min(lat + delta, 90)
+    if south == -90 or north == 90 or cos(radians(lat)) < 1e-9:
+        return (south, -180, north, 180)
+    delta = delta / cos(radians(lat))
+    if delta >= 180:
+        return (south, -180, north, 180)
+    west, east = lon - delta, lon + delta
+    if west < -180:
+        west += 360
+    if east > 180:
+        east -= 360
+    return (south, west, north, east)
+
+
+class GeoIndex(object):
+
+    def __init__(self, graphdb, name, lat, lon):
+        self._graphdb = graphdb
+        self._rows = graphdb._tuples.keyspace('geo')
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+
+    def _coordinates(self, properties):
+        try:
+            lat, lon = properties[self.lat], properties[self.lon]
+        except KeyError:
+            return None
+        if not isinstance(lat, (int, long, float)):
+            return None
+        if not isinstance(lon, (int, long, float)):
+            return None
+        return lat, lon
+
+    def add(self, uid, properties):
+        coordinates = self._coordinates(properties)
+        if coordinates:
+            key = pack(self.name, zorder(*coordinates), uid)
+            self._rows.put(key, pack(*coordinates))
+
+    def delete(self, uid, properties):
+        coordinates = self._coordinates(properties)
+        if coordinates:
+            self._rows.delete(pack(self.name, zorder(*coordinates), uid))
+
+    def backfill(self):
+        for _, lat, uid in self._graphdb._tuples.query(self.lat):
+            lon = self._graphdb._tuples.ref(uid, self.lon)
+            self.add(uid, {self.lat: lat, self.lon: lon})
+
+    def coordinates(self, uid):
+        properties = dict()
+        properties[self.lat] = self._graphdb._tuples.ref(uid, self.lat)
+        properties[self.lon] = self._graphdb._tuples.ref(uid, self.lon)
+        return self._coordinates(properties)
+
+    def _scan(self, south, west, north, east):
+        prefix = len(pack(self.name))
+        for box in _boxes(south, west, north, east):
+            for start, stop in cover(*box):
+                start = pack(self.name, start)
+                stop = pack(self.name, stop)
+                for key, value in self._rows.iterator(start=start, stop=stop):
+                    _, uid = unpack(key[prefix:])
+                    lat, lon = unpack(value)
+                    yield uid, lat, lon
+
+    def bbox(self, south, west, north, east):
+        """Iterate uids inside the box"""
+        for uid, lat, lon in self._scan(south, west, north, east):
+            if inside(lat, lon, south, west, north, east):
+                yield uid
+
+    def within(self, lat, lon, radius):
+        """Iterate uids at less than ``radius`` meters"""
+        for uid, other_lat, other_lon in self._scan(*around(lat, lon, radius)):
+            if distance(lat, lon, other_lat, other_lon) <= radius:
+                yield uid
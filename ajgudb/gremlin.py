@@ -18,27 +18,188 @@
 from collections import namedtuple
 from collections import Counter
 
+from functools import wraps
+from itertools import chain
+from itertools import groupby
 from itertools import imap
+from itertools import islice
 
 from .ajgudb import Base
+from .geo import distance
+from .geo import inside
+from .serialize import write_msgpack
+from .serialize import write_ndjson
+from .spill import Reverse
+from .spill import Spool
+from .utils import AjguDBException
 
 
 GremlinResult = namedtuple('GremlinResult', ('value', 'parent', 'step'))
 
+# number of edges created per batch by ``link``
+LINK_BATCH = 1000
+
+# number of input vertices sorted together by ``incomings`` and ``outgoings``
+EXPAND_CHUNK = 1000
+
+
+def _factory(func):
+    """Remember how a step was built so that it can be described later"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        step = func(*args, **kwargs)
+        step.spec = (func.__name__, args, kwargs)
+        return step
+    return wrapper
+
+
+def spec(step):
+    """Return ``(name, args, kwargs)`` describing ``step``.
+
+    ``args`` and ``kwargs`` are ``None`` when ``step`` is not built by a
+    factory eg. ``count`` or ``get``."""
+    try:
+        return step.spec
+    except AttributeError:
+        return (step.__name__, None, None)
+
+
+def from_spec(name, args, kwargs):
+    """Rebuild the step described by ``spec``"""
+    try:
+        step = _STEPS[name]
+    except KeyError:
+        raise AjguDBException('unknown step %s' % name)
+    if args is None and kwargs is None:
+        return step
+    return step(*args, **(kwargs or dict()))
+
+
+class Compact(GremlinResult):
+    """Result that doesn't keep its parent, see ``query``"""
+
+    __slots__ = ()
+
+
+def _result(value, item):
+    """Return the result with ``value`` computed from ``item``, its parent
+    is only kept when ``item`` keeps its own"""
+    if type(item) is Compact:
+        return Compact(value, None, None)
+    return GremlinResult(value, item, None)
+
+
+def _compact(iterator):
+    for item in iterator:
+        if type(item) is GremlinResult:
+            yield Compact(item.value, None, None)
+        else:
+            yield item
+
+
+def tracks(steps):
+    """Return ``True`` if ``steps`` read the parents of results"""
+    return any(spec(step)[0] in ('back', 'path') for step in steps)
+
+
+def prepare(iterator, paths):
+    """Return the input of the first step of a query, results of queries
+    that don't track ``paths`` don't keep their parent"""
+    if isinstance(iterator, Base):
+        iterator = [GremlinResult(iterator.uid, None, None)]
+    elif isinstance(iterator, GremlinResult):
+        iterator = [iterator]
+    if iterator is None or paths:
+        return iterator
+    if isinstance(iterator, list):
+        return list(_compact(iterator))
+    return _compact(iterator)
+
+
+def query(*steps, **options):
+    """Gremlin pipeline builder and executor.
+
+    Results keep a reference to their parent only when ``paths`` is true,
+    by default when one of ``steps`` is ``back`` or ``path``. Queries with
+    custom functions that read the ``parent`` of results need
+    ``paths=True``"""
+    paths = options.get('paths')
+    if paths is None:
+        paths = tracks(steps)
 
-def query(*steps):
-    """Gremlin pipeline builder and executor"""
     def composed(graphdb, iterator=None):
-        if isinstance(iterator, Base):
-            iterator = [GremlinResult(iterator.uid, None, None)]
-        elif isinstance(iterator, GremlinResult):
-            iterator = [iterator]
-        for step in steps:
+        first = iterator is None
+        iterator = prepare(iterator, paths)
+        for step in plan(steps, first):
             iterator = step(graphdb, iterator)
+            if first and not paths and hasattr(iterator, 'next'):
+                # results of the first step are the roots
+                iterator = _compact(iterator)
+            first = False
         return iterator
     return composed
 
 
+def plan(steps, first=True):
+    """Return the steps that are executed for ``steps``.
+
+    When the query starts without input, ``vertices`` or ``edges``
+    followed by ``key(name)`` and ``group_count`` or ``value`` is replaced
+    by a single step that reads ``name`` values with one scan of the index
+    instead of one ``ref`` per element. Other sources can be selective, a
+    scan of every ``name`` row would be slower than a few ``ref``, they
+    are only replaced when they select on ``name``."""
+    if first and len(steps) >= 3:
+        name, args, _ = spec(steps[1])
+        if name == 'key' and steps[2] in (group_count, value):
+            if _projectable(steps[0], args[0]):
+                step = project(steps[0], args[0], steps[2])
+                return (step,) + tuple(steps[3:])
+    return tuple(steps)
+
+
+def _projectable(source, name):
+    """Return ``True`` if ``name`` values of the elements of ``source``
+    are cheaper to read with ``project`` than with ``key``"""
+    if source in (vertices, edges):
+        return True
+    kind, _, kwargs = spec(source)
+    return kind == 'select' and name in kwargs
+
+
+def _scan(graphdb, name, uids):
+    """Return a dict with ``name`` value of every uid in ``uids`` that
+    has one"""
+    out = dict()
+    if not uids:
+        return out
+    for _, value, uid in graphdb._tuples.query(name):
+        if uid in uids:
+            out[uid] = value
+            if len(out) == len(uids):
+                break
+    return out
+
+
+def project(source, name, aggregate):
+    """Index only equivalent of ``query(source, key(name), aggregate)``"""
+    def step(graphdb, iterator):
+        uids = [item.value for item in source(graphdb, iterator)]
+        kind, _, kwargs = spec(source)
+        if kind == 'select' and name in kwargs:
+            # every selected element has the selected value
+            values = dict((uid, kwargs[name]) for uid in uids)
+        else:
+            values = _scan(graphdb, name, set(uids))
+        items = (GremlinResult(values.get(uid), None, None) for uid in uids)
+        return aggregate(graphdb, items)
+    step.spec = ('project', (name,), None)
+    step.source = source
+    step.aggregate = aggregate
+    return step
+
+
+@_factory
 def select(**kwargs):
     """Iterator that *select* elements based on key value"""
     def step(graphdb, iterator):
@@ -53,10 +214,18 @@ def select(**kwargs):
                 if ok:
                     yield item
         else:
-            items = kwargs.items()
-            for _, _, uid in graphdb._tuples.query(*items[0]):
+            index = graphdb._composite_index(kwargs.keys())
+            if index is None:
+                items = kwargs.items()
+                records = graphdb._tuples.query(*items[0])
+                uids = (uid for _, _, uid in records)
+                items = items[1:]
+            else:
+                uids = index.query(**kwargs)
+                items = [x for x in kwargs.items() if x[0] not in index.keys]
+            for uid in uids:
                 ok = True
-                for key, value in items[1:]:
+                for key, value in items:
                     other = graphdb._tuples.ref(uid, key)
                     if value != other:
                         ok = False
@@ -66,6 +235,66 @@ def select(**kwargs):
     return step
 
 
+@_factory
+def search(key, text, mode='and', rank=False):
+    """Iterator over elements whose ``key`` contains the words of ``text``.
+
+    ``mode`` can be ``'and'`` or ``'or'``. When ``rank`` is true, elements
+    are sorted by decreasing term frequency, otherwise by uid. It requires
+    a full-text index see ``AjguDB.create_fulltext_index``."""
+    def step(graphdb, iterator):
+        index = graphdb._index('fulltext:%s' % key)
+        if iterator:
+            for item in iterator:
+                value = graphdb._tuples.ref(item.value, key)
+                if index.match(value, text, mode):
+                    yield item
+        else:
+            matches = index.search(text, mode)
+            if rank:
+                matches = sorted(matches, key=lambda x: x[1], reverse=True)
+            for uid, _ in matches:
+                yield GremlinResult(uid, None, None)
+    return step
+
+
+@_factory
+def within(name, lat, lon, radius):
+    """Iterator over elements at less than ``radius`` meters of ``lat`` and
+    ``lon``. It requires a geographic index see ``AjguDB.create_geo_index``"""
+    def step(graphdb, iterator):
+        index = graphdb._index('geo:%s' % name)
+        if iterator:
+            for item in iterator:
+                coordinates = index.coordinates(item.value)
+                if coordinates is None:
+                    continue
+                if distance(lat, lon, *coordinates) <= radius:
+                    yield item
+        else:
+            for uid in index.within(lat, lon, radius):
+                yield GremlinResult(uid, None, None)
+    return step
+
+
+@_factory
+def bbox(name, south, west, north, east):
+    """Iterator over elements inside the bounding box. It requires a
+    geographic index see ``AjguDB.create_geo_index``"""
+    def step(graphdb, iterator):
+        index = graphdb._index('geo:%s' % name)
+        if iterator:
+            box = (south, west, north, east)
+            for item in iterator:
+                coordinates = index.coordinates(item.value)
+                if coordinates and inside(*(coordinates + box)):
+                    yield item
+        else:
+            for uid in index.bbox(south, west, north, east):
+                yield GremlinResult(uid, None, None)
+    return step
+
+
 def vertices(graphdb, iterator):
     """Iterator over all vertices"""
     for _, _, uid in graphdb._tuples.query('_meta_type', 'vertex'):
@@ -78,6 +307,7 @@ def edges(graphdb, iterator):
         yield GremlinResult(uid, None, None)
 
 
+@_factory
 def skip(count):
     def step(graphdb, iterator):
         counter = 0
@@ -88,6 +318,7 @@ def skip(count):
     return step
 
 
+@_factory
 def limit(count):
     def step(graphdb, iterator):
         counter = 0
@@ -99,6 +330,7 @@ def limit(count):
     return step
 
 
+@_factory
 def paginator(count):
     def step(graphdb, iterator):
         counter = 0
@@ -118,39 +350,139 @@ def count(graphdb, iterator):
     return reduce(lambda x, y: x + 1, iterator, 0)
 
 
-def _edges(vertex, graphdb, iterator):
+def _bind(step, **kwargs):
+    """Return ``step`` with ``kwargs`` eg. ``outgoings(ordered=True)``"""
+    def bound(graphdb, iterator):
+        return step(graphdb, iterator, **kwargs)
+    bound.spec = (step.__name__, (), kwargs)
+    return bound
+
+
+def _records(graphdb, key, uids):
+    """Iterate the index rows of ``key`` and ``uids``"""
+    if hasattr(graphdb._tuples, 'query_many'):
+        return graphdb._tuples.query_many(key, uids)
+    return (
+        record for uid in uids for record in graphdb._tuples.query(key, uid)
+    )
+
+
+def _labeled(graphdb, key, direction, uids, label):
+    """Iterate the index rows of ``key`` and ``uids`` of the edges with
+    ``label``, see ``AjguDB.create_label_index``"""
+    index = graphdb._indices.get('label')
+    if index is None:
+        for record in _records(graphdb, key, uids):
+            if graphdb._tuples.ref(record[2], 'label') == label:
+                yield record
+    else:
+        for uid in uids:
+            for edge in index.edges(uid, direction, label):
+                yield key, uid, edge
+
+
+def _edges(
+    vertex, graphdb, iterator, ordered=False, max_degree=None, label=None,
+):
+    """Iterate the edges of the vertices of ``iterator``.
+
+    Input is read by chunks sorted by uid so that the index is read with
+    forward seeks. Edges are yielded in uid order of their vertex unless
+    ``ordered`` is true, then they are yielded in input order. Vertices
+    with more than ``max_degree`` edges are not expanded. When ``label``
+    is not ``None`` only edges with that label are yielded, and counted
+    by ``max_degree``"""
     key = '_meta_%s' % vertex
-    for item in iterator:
-        records = graphdb._tuples.query(key, item.value)
-        for _, _, uid in records:
-            yield GremlinResult(uid, item, None)
-
-
-def incomings(graphdb, iterator):
-    return _edges('end', graphdb, iterator)
-
-
-def outgoings(graphdb, iterator):
-    return _edges('start', graphdb, iterator)
+    direction = 'out' if vertex == 'start' else 'in'
+    counters = 'degree' in graphdb._indices and label is None
+    iterator = iter(iterator)
+    while True:
+        items = list(islice(iterator, EXPAND_CHUNK))
+        if not items:
+            break
+        inputs = dict()
+        for item in items:
+            inputs.setdefault(item.value, list()).append(item)
+        uids = sorted(inputs.keys())
+        if max_degree is not None and counters:
+            # hubs are skipped without reading their edges
+            uids = [
+                uid for uid in uids
+                if graphdb._degree(uid, direction) <= max_degree
+            ]
+        if label is None:
+            records = _records(graphdb, key, uids)
+        else:
+            records = _labeled(graphdb, key, direction, uids, label)
+        found = dict()
+        for uid, rows in groupby(records, lambda record: record[1]):
+            if max_degree is None:
+                edges = [edge for _, _, edge in rows]
+            else:
+                edges = [edge for _, _, edge in islice(rows, max_degree + 1)]
+                if len(edges) > max_degree:
+                    continue
+            if ordered:
+                found[uid] = edges
+                continue
+            for item in inputs[uid]:
+                for edge in edges:
+                    yield _result(edge, item)
+        if ordered:
+            for item in items:
+                for edge in found.get(item.value, ()):
+                    yield _result(edge, item)
+
+
+def incomings(graphdb=None, iterator=None, **kwargs):
+    """Iterate incoming edges. ``incomings(ordered=True, max_degree=None,
+    label=None)`` is the step that yields them in input order, doesn't
+    expand vertices with more than ``max_degree`` edges and only yields
+    edges with ``label``"""
+    if graphdb is None:
+        return _bind(incomings, **kwargs)
+    return _edges('end', graphdb, iterator, **kwargs)
+
+
+def outgoings(graphdb=None, iterator=None, **kwargs):
+    """Iterate outgoing edges. ``outgoings(ordered=True, max_degree=None,
+    label=None)`` is the step that yields them in input order, doesn't
+    expand vertices with more than ``max_degree`` edges and only yields
+    edges with ``label``"""
+    if graphdb is None:
+        return _bind(outgoings, **kwargs)
+    return _edges('start', graphdb, iterator, **kwargs)
+
+
+@_factory
+def degree(direction='both'):
+    """Number of ``out``, ``in`` or ``both`` edges of the input vertices,
+    see ``AjguDB.create_degree_index``"""
+    def step(graphdb, iterator):
+        for item in iterator:
+            count = graphdb._degree(item.value, direction)
+            yield _result(count, item)
+    return step
 
 
 def start(graphdb, iterator):
     for item in iterator:
         uid = graphdb._tuples.ref(item.value, '_meta_start')
-        result = GremlinResult(uid, item, None)
+        result = _result(uid, item)
         yield result
 
 
 def end(graphdb, iterator):
     for item in iterator:
         uid = graphdb._tuples.ref(item.value, '_meta_end')
-        result = GremlinResult(uid, item, None)
+        result = _result(uid, item)
         yield result
 
 
+@_factory
 def each(proc):
     def step(graphdb, iterator):
-        return imap(lambda x: GremlinResult(proc(graphdb, x), x, None), iterator)
+        return imap(lambda x: _result(proc(graphdb, x), x), iterator)
     return step
 
 
@@ -162,22 +494,40 @@ def get(graphdb, iterator):
     return list(imap(lambda x: graphdb.get(x.value), iterator))
 
 
-def sort(key=lambda g, x: x, reverse=False):
+def _spilled_sort(graphdb, iterator, key, reverse, budget):
+    order = Reverse if reverse else lambda x: x
+    with Spool(budget) as spool:
+        # the index keeps the sort stable and items are never compared
+        for index, item in enumerate(iterator):
+            spool.add((order(key(graphdb, item)), index, item))
+        for _, _, item in spool:
+            yield item
+
+
+@_factory
+def sort(key=lambda g, x: x, reverse=False, budget=None):
+    """Sort input items. When ``budget`` is not ``None`` at most ``budget``
+    items are kept in memory, others are spilled to sorted runs in
+    temporary files"""
     def step(graphdb, iterator):
+        if budget is not None:
+            return _spilled_sort(graphdb, iterator, key, reverse, budget)
         out = sorted(iterator, key=lambda x: key(graphdb, x), reverse=reverse)
         return iter(out)
     return step
 
 
+@_factory
 def key(name):
     def step(graphdb, iterator):
         for item in iterator:
             value = graphdb._tuples.ref(item.value, name)
-            result = GremlinResult(value, item, None)
+            result = _result(value, item)
             yield result
     return step
 
 
+@_factory
 def keys(*names):
     def step(graphdb, iterator):
         for item in iterator:
@@ -185,39 +535,55 @@ def keys(*names):
             for name in names:
                 value = graphdb._tuples.ref(item.value, name)
                 values.append(value)
-            result = GremlinResult(values, item, None)
+            result = _result(values, item)
             yield result
     return step
 
 
-def unique(graphdb, iterator):
-    # from ActiveState (MIT)
-    #
-    #   Lazy Ordered Unique elements from an iterator
-    #
-    def __unique(iterable, key=None):
-        seen = set()
-
-        if key is None:
-            # Optimize the common case
-            for item in iterable:
-                if item in seen:
-                    continue
-                seen.add(item)
+def _spilled_unique(seen, iterator, budget):
+    with Spool(budget) as values:
+        # values that were already yielded come first in their group
+        for value in seen:
+            values.add((value, -1, None))
+        seen.clear()
+        for index, item in enumerate(iterator):
+            values.add((item.value, index, item))
+        with Spool(budget) as kept:
+            for _, group in groupby(values, lambda x: x[0]):
+                _, index, item = next(group)
+                if index >= 0:
+                    kept.add((index, item))
+            for _, item in kept:
                 yield item
 
-        else:
-            for item in iterable:
-                keyitem = key(item)
-                if keyitem in seen:
-                    continue
-                seen.add(keyitem)
+
+def _unique(iterator, budget=None):
+    seen = set()
+    iterator = iter(iterator)
+    for item in iterator:
+        if item.value in seen:
+            continue
+        if budget is not None and len(seen) >= budget:
+            # the remaining input is deduplicated on disk
+            remaining = _spilled_unique(seen, chain([item], iterator), budget)
+            for item in remaining:
                 yield item
+            return
+        seen.add(item.value)
+        yield item
+
 
-    iterator = __unique(iterator, lambda x: x.value)
-    return iterator
+def unique(graphdb=None, iterator=None, **kwargs):
+    """Iterate input items with a value that wasn't seen before.
+    ``unique(budget=count)`` keeps at most ``budget`` values in memory,
+    past it the remaining input is deduplicated with sorted runs in
+    temporary files and yielded in input order once it's consumed"""
+    if graphdb is None:
+        return _bind(unique, **kwargs)
+    return _unique(iterator, **kwargs)
 
 
+@_factory
 def filter(predicate):
     def step(graphdb, iterator):
         for item in iterator:
@@ -226,6 +592,7 @@ def filter(predicate):
     return step
 
 
+@_factory
 def step(name):
     def step_(graphdb, iterator):
         for item in iterator:
@@ -238,6 +605,7 @@ def back(graphdb, iterator):
     return imap(lambda x: x.parent, iterator)
 
 
+@_factory
 def path(steps):
 
     def path_reducer(previous, _):
@@ -264,20 +632,73 @@ def group_count(graphdb, iterator):
     yield Counter(imap(lambda x: x.value, iterator))
 
 
+@_factory
+def spilled_group_count(budget):
+    """Count input values like ``group_count`` but at most ``budget``
+    distinct values are counted in memory, partial counts are spilled to
+    sorted runs in temporary files. It yields ``(value, count)`` pairs
+    sorted by value instead of a single ``Counter``"""
+    def step(graphdb, iterator):
+        counter = Counter()
+        with Spool(budget) as counts:
+            for item in iterator:
+                counter[item.value] += 1
+                if len(counter) >= budget:
+                    for pair in counter.iteritems():
+                        counts.add(pair)
+                    counter = Counter()
+            for pair in counter.iteritems():
+                counts.add(pair)
+            for value, pairs in groupby(counts, lambda x: x[0]):
+                yield value, sum(count for _, count in pairs)
+    return step
+
+
 def scatter(graphdb, iterator):
     for item in iterator:
         for other in item.value:
-            yield GremlinResult(other, item, None)
-
-
-MockBase = namedtuple('MockBase', ('uid', ))
+            yield _result(other, item)
 
 
+@_factory
 def link(**kwargs):
     def step(graphdb, iterator):
         start = graphdb.get_or_create(**kwargs)
-        for item in iterator:
-            node = MockBase(item.value)
-            start.link(node)
+        iterator = iter(iterator)
+        while True:
+            # edges are created by batches
+            items = list(islice(iterator, LINK_BATCH))
+            if not items:
+                break
+            graphdb.link_many([(start, item.value, None) for item in items])
         yield start
     return step
+
+
+@_factory
+def to_msgpack(stream, fields=None):
+    """Write input elements to ``stream`` as msgpack maps without building
+    them, return the number of elements written"""
+    def step(graphdb, iterator):
+        return write_msgpack(graphdb, iterator, stream, fields)
+    return step
+
+
+@_factory
+def to_ndjson(stream, fields=None):
+    """Write input elements to ``stream`` as JSON lines without building
+    them, return the number of elements written"""
+    def step(graphdb, iterator):
+        return write_ndjson(graphdb, iterator, stream, fields)
+    return step
+
+
+# steps that can be rebuilt with ``from_spec``, steps that write to a
+# stream can't be shipped
+_STEPS = dict((name, globals()[name]) for name in (
+    'select', 'search', 'within', 'bbox', 'vertices', 'edges', 'skip',
+    'limit', 'paginator', 'count', 'incomings', 'outgoings', 'start',
+    'end', 'each', 'value', 'get', 'sort', 'key', 'keys', 'unique',
+    'filter', 'step', 'back', 'path', 'mean', 'group_count', 'scatter',
+    'link', 'degree', 'spilled_group_count',
+))
@@ -0,0 +1,268 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Bulk import of vertices and edges from CSV and JSON lines files.
+
+Files are read by chunks of lines that are parsed by a pool of processes.
+Records are written by a single writer, the current process, by batches
+using ``add_many`` and identifiers allocated by blocks. External
+identifiers are mapped to uids in the ``import`` keyspace so that edges
+can be imported after their vertices, even by another run.
+
+CSV files must have a header and records can't span several lines.
+"""
+import csv
+import json
+import os
+import sys
+from itertools import chain
+from itertools import imap
+from multiprocessing import Pool
+from time import time
+
+from packing import pack
+from packing import unpack
+from spill import BUDGET
+from utils import AjguDBException
+
+
+CHUNK = 1000
+
+
+def _format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    elif extension in ('.json', '.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise AjguDBException('unknown format of %s' % path)
+
+
+def _chunks(path, size=CHUNK):
+    """Iterate ``(format, header, lines, length)`` chunks of ``path``
+    where ``length`` is the number of bytes of ``lines``"""
+    kind = _format(path)
+    with open(path, 'rb') as f:
+        header = next(f) if kind == 'csv' else None
+        if header is not None:
+            yield kind, None, [], len(header)
+        lines = list()
+        length = 0
+        for line in f:
+            lines.append(line)
+            length += len(line)
+            if len(lines) == size:
+                yield kind, header, lines, length
+                lines = list()
+                length = 0
+        if lines:
+            yield kind, header, lines, length
+
+
+def parse(chunk):
+    """Return the records of ``chunk`` with the number of bytes parsed,
+    it's executed by the workers"""
+    kind, header, lines, length = chunk
+    if not lines:
+        return [], length
+    if kind == 'csv':
+        reader = csv.reader(lines)
+        names = next(csv.reader([header]))
+        records = [dict(zip(names, row)) for row in reader if row]
+    else:
+        records = list()
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                # keys are str like everywhere else
+                record = dict((_str(k), v) for k, v in record.items())
+                records.append(record)
+    return records, length
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _external(value):
+    # CSV values are str and JSON values might be unicode or int
+    return str(_str(value))
+
+
+class Progress(object):
+    """Report progress, throughput and ETA to ``output``"""
+
+    def __init__(self, total, output=sys.stderr, interval=1.0):
+        self.total = total
+        self.output = output
+        self.interval = interval
+        self.start = self.last = time()
+        self.done = 0
+        self.records = 0
+
+    def update(self, length, records):
+        self.done += length
+        self.records += records
+        now = time()
+        if self.output is not None and now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time() - self.start, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else 0
+        self.output.write(
+            '\r%5.1f%% %d records %d records/s %.1f MB/s eta %ds' % (
+                100.0 * self.done / self.total if self.total else 100,
+                self.records,
+                self.records / elapsed,
+                rate / 2**20,
+                eta,
+            )
+        )
+        self.output.flush()
+
+
+class Importer(object):
+    """Import files into ``graphdb``.
+
+    ``key`` is the name of the external identifier of vertices, ``start``
+    and ``end`` are the names of the external identifiers of the vertices
+    of edges. External identifiers are not stored as properties.
+
+    When ``sort`` is true, rows are sorted on disk using ``budget`` bytes
+    of memory and written in key order, see ``AjguDB._ingest``."""
+
+    def __init__(
+        self, graphdb, workers=None, batch=CHUNK, key='id', start='start',
+        end='end', output=sys.stderr, sort=False, budget=BUDGET,
+    ):
+        self._graphdb = graphdb
+        self._ids = graphdb._tuples.keyspace('import')
+        self.workers = workers
+        self.batch = batch
+        self.key = key
+        self.start = start
+        self.end = end
+        self.output = output
+        self.sort = sort
+        self.budget = budget
+        self.skipped = 0
+
+    def uid(self, external):
+        """Return the uid of the vertex imported with ``external``
+        identifier or ``None``"""
+        if external is None:
+            return None
+        value = self._ids.get(pack(_external(external)))
+        return None if value is None else unpack(value)[0]
+
+    def _records(self, paths, progress):
+        chunks = (chunk for path in paths for chunk in _chunks(path))
+        if self.workers == 1:
+            results = imap(parse, chunks)
+            pool = None
+        else:
+            pool = Pool(self.workers)
+            results = pool.imap(parse, chunks)
+        try:
+            for records, length in results:
+                progress.update(length, len(records))
+                for record in records:
+                    yield record
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _batches(self, records):
+        batch = list()
+        for record in records:
+            batch.append(record)
+            if len(batch) == self.batch:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+    def _allocate(self, elements):
+        if not elements:
+            return elements
+        uid = self._graphdb._uid(len(elements))
+        return [
+            (uid + index, properties)
+            for index, properties in enumerate(elements)
+        ]
+
+    def vertices(self, records):
+        """Iterate batches of ``(uid, properties)`` of vertices ``records``,
+        their external identifiers are mapped to their uids"""
+        for batch in self._batches(records):
+            elements = list()
+            externals = list()
+            for record in batch:
+                properties = dict(record)
+                externals.append(properties.pop(self.key, None))
+                properties['_meta_type'] = 'vertex'
+                elements.append(properties)
+            elements = self._allocate(elements)
+            for external, (uid, _) in zip(externals, elements):
+                if external is not None:
+                    self._ids.put(pack(_external(external)), pack(uid))
+            yield elements
+
+    def edges(self, records):
+        """Iterate batches of ``(uid, properties)`` of edges ``records``,
+        edges whose vertices are unknown are skipped"""
+        for batch in self._batches(records):
+            elements = list()
+            for record in batch:
+                properties = dict(record)
+                start = self.uid(properties.pop(self.start, None))
+                end = self.uid(properties.pop(self.end, None))
+                if start is None or end is None:
+                    self.skipped += 1
+                    continue
+                properties['_meta_type'] = 'edge'
+                properties['_meta_start'] = start
+                properties['_meta_end'] = end
+                elements.append(properties)
+            yield self._allocate(elements)
+
+    def run(self, vertices=(), edges=()):
+        """Import ``vertices`` files then ``edges`` files, return the
+        number of records imported"""
+        vertices, edges = list(vertices), list(edges)
+        total = sum(os.path.getsize(path) for path in vertices + edges)
+        progress = Progress(total, self.output)
+        # edges are read once every vertex is mapped
+        batches = chain(
+            self.vertices(self._records(vertices, progress)),
+            self.edges(self._records(edges, progress)),
+        )
+        if self.sort:
+            elements = (element for batch in batches for element in batch)
+            self._graphdb._ingest(elements, self.budget)
+        else:
+            for batch in batches:
+                self._graphdb._add_many(batch)
+        if self.output is not None:
+            progress.report()
+            self.output.write('\n')
+        return progress.records - self.skipped
@@ -0,0 +1,76 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Label partitioned adjacency.
+
+Edges that have a ``label`` are stored in the ``labels`` keyspace as
+``(uid, direction, label, edge)`` for both of their vertices, where
+direction is ``out`` for the start vertex and ``in`` for the end vertex.
+The edges of a vertex with a given label are found with a single prefix
+scan whatever the number of edges of the vertex with other labels.
+"""
+from packing import pack
+from packing import unpack_value
+
+
+KEY = 'label'
+
+
+class LabelIndex(object):
+
+    def __init__(self, graphdb):
+        self._graphdb = graphdb
+        self._rows = graphdb._tuples.keyspace('labels')
+        self.name = 'label'
+
+    def _keys(self, uid, properties):
+        try:
+            label = properties[KEY]
+            start = properties['_meta_start']
+            end = properties['_meta_end']
+        except KeyError:
+            # it's a vertex or an edge without label
+            return []
+        return [pack(start, 'out', label, uid), pack(end, 'in', label, uid)]
+
+    def add(self, uid, properties):
+        for key in self._keys(uid, properties):
+            self._rows.put(key, '')
+
+    def delete(self, uid, properties):
+        for key in self._keys(uid, properties):
+            self._rows.delete(key)
+
+    def backfill(self):
+        tuples = self._graphdb._tuples
+        for _, label, uid in tuples.query(KEY):
+            start = tuples.ref(uid, '_meta_start')
+            if start is None:
+                continue
+            properties = {
+                KEY: label,
+                '_meta_start': start,
+                '_meta_end': tuples.ref(uid, '_meta_end'),
+            }
+            self.add(uid, properties)
+
+    def edges(self, uid, direction, label):
+        """Iterate the uids of the ``out`` or ``in`` edges of ``uid`` with
+        ``label``"""
+        prefix = pack(uid, direction, label)
+        for key, _ in self._rows.iterator(prefix=prefix):
+            yield unpack_value(key[len(prefix):])
@@ -17,14 +17,34 @@
 # MA  02110-1301  USA
 from plyvel import DB
 
+from blobs import THRESHOLD
+from blobs import indexed
+from blobs import is_packed_reference
+from blobs import is_reference
+from blobs import reference
+from compression import Compressor
+from compression import check
 from packing import pack
-from packing import unpack
+from packing import unpack_index
+from packing import unpack_tuple
+from packing import unpack_value
+from spill import BUDGET
+from spill import Runs
+from utils import ReadOnly
+
+
+# number of rows written per batch by ``ingest``
+INGEST_BATCH = 10000
 
 
 class LevelDBStorage(object):
     """Generic database"""
 
-    def __init__(self, path):
+    # add_many and delete_many write keyspace rows in their batch
+    keyspace_rows = True
+
+    def __init__(self, path, compression=None):
+        check(compression)
         self.db = DB(
             path,
             create_if_missing=True,
@@ -35,78 +55,250 @@ class LevelDBStorage(object):
         )
         self.tuples = self.db.prefixed_db(b'tuples')
         self.index = self.db.prefixed_db(b'index')
+        self.blobs = self.keyspace('blobs')
+        self.compressor = Compressor(self.keyspace('meta'), compression)
 
     def close(self):
         self.db.close()
 
+    def snapshot(self):
+        """Return a read only view of the database as of now"""
+        return LevelDBSnapshot(self)
+
+    def keyspace(self, name):
+        """Return the ordered key/value store called ``name``.
+
+        It has plyvel's ``get``, ``put``, ``delete`` and ``iterator``
+        methods, it's used by secondary indices."""
+        return self.db.prefixed_db(b'keyspace:%s:' % name)
+
+    def _packed(self, key, data):
+        """Return the packed value of the tuple ``key`` stored as
+        ``data``"""
+        packed = self.compressor.decode(data)
+        if is_packed_reference(packed):
+            packed = self.compressor.decode(self.blobs.get(key))
+        return packed
+
+    def _value(self, key, data):
+        """Return the value of the tuple ``key`` stored as ``data``"""
+        return unpack_value(self._packed(key, data))
+
     def ref(self, uid, key):
-        match = [uid, key]
-        for key, value in self.tuples.iterator(start=pack(uid, key)):
-            other = unpack(key)
-            if other == match:
-                value = unpack(value)[0]
-                return value
-            else:
-                return None
+        key = pack(uid, key)
+        value = self.tuples.get(key)
+        if value is None:
+            return None
+        return self._value(key, value)
 
     def get(self, uid):
         def __get():
-            for key, value in self.tuples.iterator(start=pack(uid)):
-                other, key = unpack(key)
-                if other == uid:
-                    value = unpack(value)[0]
-                    yield key, value
-                else:
-                    break
+            for packed, value in self.tuples.iterator(prefix=pack(uid)):
+                key = unpack_tuple(packed)[1]
+                yield key, self._value(packed, value)
 
         tuples = dict(__get())
         return tuples
 
+    def get_packed(self, uid):
+        """Return the list of ``(key, packed value)`` of ``uid``, values
+        are not decoded"""
+        return [
+            (unpack_tuple(packed)[1], self._packed(packed, value))
+            for packed, value in self.tuples.iterator(prefix=pack(uid))
+        ]
+
     def add(self, uid, **properties):
-        tuples = self.tuples.write_batch(transaction=True)
-        index = self.index.write_batch(transaction=True)
+        self.add_many([(uid, properties)])
+
+    def _rows(self, uid, properties):
+        """Iterate ``(store, key, value)`` rows of an element"""
         for key, value in properties.items():
-            tuples.put(pack(uid, key), pack(value))
-            index.put(pack(key, value, uid), '')
-        tuples.write()
-        index.write()
+            packed = pack(value)
+            if len(packed) > THRESHOLD:
+                blob = self.compressor.encode(key, packed)
+                yield self.blobs, pack(uid, key), blob
+                value = reference(packed)
+                packed = pack(value)
+            packed = self.compressor.encode(key, packed)
+            yield self.tuples, pack(uid, key), packed
+            yield self.index, pack(key, value, uid), ''
 
-    def delete(self, uid):
-        tuples = self.tuples.write_batch(transaction=True)
-        index = self.index.write_batch(transaction=True)
-        for key, value in self.tuples.iterator(start=pack(uid)):
-            other, name = unpack(key)
-            if uid == other:
-                tuples.delete(key)
-                value = unpack(value)[0]
-                index.delete(pack(name, value, uid))
+    def _keyspace_rows(self, batch, rows):
+        """Write the ``(keyspace, key, value)`` of ``rows`` in ``batch``,
+        rows with a ``None`` value are deleted"""
+        for name, key, value in rows:
+            key = self.keyspace(name).prefix + key
+            if value is None:
+                batch.delete(key)
             else:
-                break
-        tuples.write()
-        index.write()
+                batch.put(key, value)
+
+    def add_many(self, elements, rows=()):
+        """Add every ``(uid, properties)`` of ``elements`` in one atomic
+        batch, along the ``(keyspace, key, value)`` of ``rows``"""
+        # keys are prefixed by hand so that every store is in the batch
+        batch = self.db.write_batch(transaction=True)
+        for uid, properties in elements:
+            for store, key, value in self._rows(uid, properties):
+                batch.put(store.prefix + key, value)
+        self._keyspace_rows(batch, rows)
+        batch.write()
+
+    def ingest(self, elements, budget=BUDGET):
+        """Add every ``(uid, properties)`` of ``elements``. Rows are sorted
+        on disk and written in key order by large batches, which avoids
+        the compactions of random writes during initial loads"""
+        with Runs(budget) as runs:
+            for uid, properties in elements:
+                for store, key, value in self._rows(uid, properties):
+                    runs.add(store.prefix + key, value)
+            batch = self.db.write_batch()
+            count = 0
+            for key, value in runs:
+                batch.put(key, value)
+                count += 1
+                if count == INGEST_BATCH:
+                    batch.write()
+                    batch = self.db.write_batch()
+                    count = 0
+            batch.write()
+
+    def delete(self, uid):
+        self.delete_many([uid])
+
+    def delete_many(self, uids, rows=()):
+        """Delete every element of ``uids`` in one atomic batch, along the
+        ``(keyspace, key, value)`` of ``rows``"""
+        # keys are prefixed by hand so that every store is in the batch
+        batch = self.db.write_batch(transaction=True)
+        for uid in uids:
+            for key, value in self.tuples.iterator(prefix=pack(uid)):
+                name = unpack_tuple(key)[1]
+                batch.delete(self.tuples.prefix + key)
+                value = unpack_value(self.compressor.decode(value))
+                # index keys of large values hold the reference
+                index = pack(name, value, uid)
+                batch.delete(self.index.prefix + index)
+                if is_reference(value):
+                    batch.delete(self.blobs.prefix + key)
+        self._keyspace_rows(batch, rows)
+        batch.write()
 
     def update(self, uid, **properties):
         self.delete(uid)
         self.add(uid, **properties)
 
     def debug(self):
-        for key, value in self.tuples.iterator():
-            uid, key = unpack(key)
-            value = unpack(value)[0]
+        for packed, value in self.tuples.iterator():
+            uid, key = unpack_tuple(packed)
+            value = self._value(packed, value)
             print(uid, key, value)
 
     def query(self, key, value=''):
-        match = (key, value) if value else (key,)
-
-        iterator = self.index.iterator(start=pack(key, value))
-        for key, value in iterator:
-            other = unpack(key)
-            ok = reduce(
-                lambda previous, x: (cmp(*x) == 0) and previous,
-                zip(match, other),
-                True
-            )
-            if ok:
-                yield other
-            else:
-                break
+        match = (key, indexed(value)) if value else (key,)
+        # packed values are prefix free, rows matching every value of
+        # ``match`` are the rows that start with its packed bytes
+        for key, _ in self.index.iterator(prefix=pack(*match)):
+            other = unpack_index(key)
+            if is_reference(other[1]):
+                other[1] = self.ref(other[2], other[0])
+                if value and other[1] != value:
+                    # hash collision
+                    continue
+            yield other
+
+    def query_many(self, key, values):
+        """Iterate the index rows of ``key`` and every value of ``values``
+        in the order of ``values``. A single iterator seeks forward when
+        values are sorted"""
+        iterator = self.index.iterator()
+        try:
+            for value in values:
+                prefix = pack(key, indexed(value))
+                iterator.seek(prefix)
+                for packed, _ in iterator:
+                    if not packed.startswith(prefix):
+                        break
+                    other = unpack_index(packed)
+                    if is_reference(other[1]):
+                        other[1] = self.ref(other[2], other[0])
+                        if other[1] != value:
+                            # hash collision
+                            continue
+                    yield other
+        finally:
+            iterator.close()
+
+
+class LevelDBSnapshotStore(object):
+    """Read only view of the prefixed database ``prefix`` in ``snapshot``
+    with the reading methods of plyvel's prefixed databases"""
+
+    def __init__(self, snapshot, prefix):
+        self._snapshot = snapshot
+        self.prefix = prefix
+
+    def get(self, key):
+        return self._snapshot.get(self.prefix + key)
+
+    def iterator(self, start=None, stop=None, prefix=None):
+        return LevelDBSnapshotIterator(self, start, stop, prefix)
+
+
+class LevelDBSnapshotIterator(object):
+    """Iterator of the rows of a ``LevelDBSnapshotStore`` that can seek
+    like plyvel's iterators"""
+
+    def __init__(self, store, start=None, stop=None, prefix=None):
+        self._iterator = store._snapshot.iterator(prefix=store.prefix)
+        self._prefix = store.prefix
+        self._size = len(store.prefix)
+        self._stop = stop
+        self._match = prefix
+        if prefix is not None:
+            self.seek(prefix)
+        elif start is not None:
+            self.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def seek(self, target):
+        self._iterator.seek(self._prefix + target)
+
+    def next(self):
+        key, value = next(self._iterator)
+        key = key[self._size:]
+        if self._stop is not None and key >= self._stop:
+            raise StopIteration
+        if self._match is not None and not key.startswith(self._match):
+            raise StopIteration
+        return key, value
+
+    def close(self):
+        self._iterator.close()
+
+
+class LevelDBSnapshot(ReadOnly, LevelDBStorage):
+    """Read only view of ``storage``, every store is read from the same
+    leveldb snapshot"""
+
+    def __init__(self, storage):
+        self.db = storage.db
+        self._snapshot = storage.db.snapshot()
+        self.tuples = LevelDBSnapshotStore(
+            self._snapshot, storage.tuples.prefix
+        )
+        self.index = LevelDBSnapshotStore(
+            self._snapshot, storage.index.prefix
+        )
+        self.blobs = self.keyspace('blobs')
+        self.compressor = storage.compressor
+
+    def close(self):
+        self._snapshot.close()
+
+    def keyspace(self, name):
+        prefix = b'keyspace:%s:' % name
+        return LevelDBSnapshotStore(self._snapshot, prefix)
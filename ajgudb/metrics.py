@@ -0,0 +1,268 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Storage metrics.
+
+``MeteredStorage`` wraps any storage and records call counts, latency
+histograms, rows scanned by queries and write batch sizes. It's only used
+when the database is opened with ``AjguDB(path, metrics=True)`` so that
+there is no overhead otherwise.
+"""
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from time import time
+
+from . import packing
+
+
+METHODS = ('get', 'ref', 'add', 'update', 'delete', 'query')
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005,
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+# upper bounds in number of tuples
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Return the histogram with cumulative counts"""
+        buckets = list()
+        total = 0
+        for upper, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            buckets.append([upper, total])
+        return dict(buckets=buckets, sum=self.sum, count=self.count)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.calls = Counter()
+        self.latency = dict(
+            (method, Histogram(LATENCY_BUCKETS)) for method in METHODS
+        )
+        self.batch = Histogram(BATCH_BUCKETS)
+        self.scanned = 0
+        # bytes packed and unpacked during storage calls
+        self.bytes = Counter()
+
+    def observe(self, method, elapsed):
+        self.calls[method] += 1
+        self.latency[method].observe(elapsed)
+
+    def snapshot(self):
+        return dict(
+            calls=dict((method, self.calls[method]) for method in METHODS),
+            latency=dict(
+                (method, histogram.snapshot())
+                for method, histogram in self.latency.items()
+            ),
+            batch=self.batch.snapshot(),
+            scanned=self.scanned,
+            packed=self.bytes['packed'],
+            unpacked=self.bytes['unpacked'],
+        )
+
+
+class MeteredStorage(object):
+    """Wrap ``storage`` to record its activity in ``metrics``"""
+
+    def __init__(self, storage, metrics):
+        self._storage = storage
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        # methods that are not measured
+        return getattr(self._storage, name)
+
+    def close(self):
+        self._storage.close()
+
+    def snapshot(self):
+        return MeteredStorage(self._storage.snapshot(), self._metrics)
+
+    def _count(self):
+        """Start counting the bytes packed and unpacked, return what
+        ``_counted`` needs to stop"""
+        # pack and unpack do not know which database they work for, they
+        # are only counted during the calls of this storage
+        previous = packing.stats
+        counter = packing.stats = Counter()
+        return previous, counter
+
+    def _counted(self, previous, counter):
+        packing.stats = previous
+        if previous is not None:
+            # eg. AjguDB.profile is counting them too
+            previous.update(counter)
+        self._metrics.bytes.update(counter)
+
+    @contextmanager
+    def _call(self, method):
+        """Measure the latency of the storage call ``method`` and the bytes
+        it packs and unpacks"""
+        previous, counter = self._count()
+        start = time()
+        try:
+            yield
+            self._metrics.observe(method, time() - start)
+        finally:
+            self._counted(previous, counter)
+
+    def ref(self, uid, key):
+        with self._call('ref'):
+            return self._storage.ref(uid, key)
+
+    def get(self, uid):
+        with self._call('get'):
+            return self._storage.get(uid)
+
+    def get_packed(self, uid):
+        with self._call('get'):
+            return self._storage.get_packed(uid)
+
+    def add(self, uid, **properties):
+        with self._call('add'):
+            self._storage.add(uid, **properties)
+        self._metrics.batch.observe(len(properties))
+
+    def add_many(self, elements, **kwargs):
+        with self._call('add'):
+            self._storage.add_many(elements, **kwargs)
+        self._metrics.batch.observe(
+            sum(len(properties) for _, properties in elements)
+        )
+
+    def update(self, uid, **properties):
+        with self._call('update'):
+            self._storage.update(uid, **properties)
+        self._metrics.batch.observe(len(properties))
+
+    def delete(self, uid):
+        with self._call('delete'):
+            self._storage.delete(uid)
+
+    def delete_many(self, uids, **kwargs):
+        with self._call('delete'):
+            self._storage.delete_many(uids, **kwargs)
+
+    def query(self, key, value=''):
+        return self._measure(self._storage.query(key, value))
+
+    def query_many(self, key, values):
+        return self._measure(self._storage.query_many(key, values))
+
+    def _measure(self, iterator):
+        # only the time spent in the storage iterator is measured
+        elapsed = 0
+        rows = 0
+        try:
+            while True:
+                start = time()
+                previous, counter = self._count()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    self._counted(previous, counter)
+                    elapsed += time() - start
+                rows += 1
+                yield row
+        finally:
+            self._metrics.observe('query', elapsed)
+            self._metrics.scanned += rows
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    labels = ','.join(
+        '%s="%s"' % (key, value) for key, value in sorted(labels.items())
+    )
+    return '{%s}' % labels
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _histogram(name, snapshot, **labels):
+    out = list()
+    for upper, count in snapshot['buckets']:
+        bucket = dict(labels, le=_number(upper))
+        out.append('%s_bucket%s %d' % (name, _labels(**bucket), count))
+    out.append('%s_sum%s %s' % (name, _labels(**labels), snapshot['sum']))
+    out.append('%s_count%s %d' % (name, _labels(**labels), snapshot['count']))
+    return out
+
+
+def prometheus(snapshot):
+    """Format ``Metrics.snapshot()`` using prometheus text format"""
+    out = list()
+
+    out.append('# HELP ajgudb_storage_calls_total Number of storage calls')
+    out.append('# TYPE ajgudb_storage_calls_total counter')
+    for method, count in sorted(snapshot['calls'].items()):
+        labels = _labels(method=method)
+        out.append('ajgudb_storage_calls_total%s %d' % (labels, count))
+
+    name = 'ajgudb_storage_latency_seconds'
+    out.append('# HELP %s Latency of storage calls' % name)
+    out.append('# TYPE %s histogram' % name)
+    for method, histogram in sorted(snapshot['latency'].items()):
+        out.extend(_histogram(name, histogram, method=method))
+
+    name = 'ajgudb_storage_batch_size'
+    out.append('# HELP %s Number of tuples written by add and update' % name)
+    out.append('# TYPE %s histogram' % name)
+    out.extend(_histogram(name, snapshot['batch']))
+
+    for name, key, help in (
+        ('ajgudb_query_rows_scanned_total', 'scanned', 'Rows scanned'),
+        ('ajgudb_packed_bytes_total', 'packed', 'Bytes packed'),
+        ('ajgudb_unpacked_bytes_total', 'unpacked', 'Bytes unpacked'),
+    ):
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s counter' % name)
+        out.append('%s %d' % (name, snapshot[key]))
+
+    return '\n'.join(out) + '\n'
@@ -21,40 +21,91 @@ from msgpack import dumps
 from msgpack import loads
 
 
+# ``collections.Counter`` of ``packed`` and ``unpacked`` bytes, it's
+# ``None`` unless something is measuring them eg. ``AjguDB.profile``
+stats = None
+
+
+INT = struct.Struct('>q')
+
+
+def _pack(value):
+    if type(value) is int:
+        return '1' + INT.pack(value)
+    elif type(value) is unicode:
+        return '2' + value.encode('utf-8') + '\0'
+    elif type(value) is str:
+        return '3' + value + '\0'
+    else:
+        data = dumps(value, encoding='utf-8')
+        return '4' + INT.pack(len(data)) + data
+
+
 def pack(*values):
-    def __pack(value):
-        if type(value) is int:
-            return '1' + struct.pack('>q', value)
-        elif type(value) is unicode:
-            return '2' + value.encode('utf-8') + '\0'
-        elif type(value) is str:
-            return '3' + value + '\0'
-        else:
-            data = dumps(value, encoding='utf-8')
-            return '4' + struct.pack('>q', len(data)) + data
-    return ''.join(map(__pack, values))
+    packed = ''.join(map(_pack, values))
+    if stats is not None:
+        stats['packed'] += len(packed)
+    return packed
 
 
 def unpack(packed):
-    kind = packed[0]
+    if stats is not None:
+        stats['unpacked'] += len(packed)
+    return _unpack(packed)
+
+
+def unpack_value(packed):
+    """Return the first value of ``packed`` eg. the value of a tuple"""
+    if stats is not None:
+        stats['unpacked'] += len(packed)
+    return _value(packed, 0)[0]
+
+
+def unpack_tuple(packed):
+    """Return ``[uid, key]`` of the tuples row key ``packed``"""
+    if stats is not None:
+        stats['unpacked'] += len(packed)
+    if packed[0] == '1' and packed[9] == '3':
+        return [INT.unpack_from(packed, 1)[0], packed[10:-1]]
+    return _unpack(packed)
+
+
+def unpack_index(packed):
+    """Return ``[key, value, uid]`` of the index row key ``packed``"""
+    if stats is not None:
+        stats['unpacked'] += len(packed)
+    if packed[0] == '3':
+        index = packed.index('\0')
+        value, end = _value(packed, index + 1)
+        if end == len(packed) - 9 and packed[end] == '1':
+            uid = INT.unpack_from(packed, end + 1)[0]
+            return [packed[1:index], value, uid]
+    return _unpack(packed)
+
+
+def _value(packed, offset):
+    """Return the value packed at ``offset`` and the offset of the next"""
+    kind = packed[offset]
     if kind == '1':
-        value = struct.unpack('>q', packed[1:9])[0]
-        packed = packed[9:]
+        return INT.unpack_from(packed, offset + 1)[0], offset + 9
     elif kind == '2':
-        index = packed.index('\0')
-        value = packed[1:index].decode('utf-8')
-        packed = packed[index+1:]
+        index = packed.index('\0', offset)
+        return packed[offset + 1:index].decode('utf-8'), index + 1
     elif kind == '3':
-        index = packed.index('\0')
-        value = packed[1:index]
-        packed = packed[index+1:]
-    else:
-        size = struct.unpack('>q', packed[1:9])[0]
-        value = loads(packed[9:9+size], encoding='utf-8')
-        packed = packed[size+9:]
-    if packed:
-        values = unpack(packed)
-        values.insert(0, value)
+        index = packed.index('\0', offset)
+        return packed[offset + 1:index], index + 1
     else:
-        values = [value]
+        size = INT.unpack_from(packed, offset + 1)[0]
+        start = offset + 9
+        value = loads(packed[start:start + size], encoding='utf-8')
+        return value, start + size
+
+
+def _unpack(packed):
+    values = list()
+    offset = 0
+    size = len(packed)
+    while offset < size:
+        value, offset = _value(packed, offset)
+        values.append(value)
     return values
@@ -0,0 +1,306 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Explain and profile gremlin queries.
+
+Both return plain dicts and lists so that they can be logged as json."""
+from collections import Counter
+from copy import copy
+from time import time
+
+from . import packing
+from .ajgudb import AjguDB
+from .gremlin import _compact
+from .gremlin import plan
+from .gremlin import prepare
+from .gremlin import spec
+from .gremlin import tracks
+
+
+STORAGE_METHODS = ('ref', 'get', 'get_packed', 'query', 'query_many')
+
+
+def _describe(step):
+    name, args, kwargs = spec(step)
+    out = dict(step=name)
+    if args:
+        out['args'] = [repr(arg) for arg in args]
+    if kwargs:
+        kwargs = dict((key, repr(value)) for key, value in kwargs.items())
+        out['kwargs'] = kwargs
+    return out
+
+
+def _access(graphdb, step, first):
+    """Return how ``step`` retrieves its data.
+
+    ``first`` is ``True`` when the step has no input"""
+    name, args, kwargs = spec(step)
+    index = None
+    if name == 'select' and first:
+        index = graphdb._composite_index(kwargs.keys())
+    if index is not None:
+        out = dict(
+            access='composite',
+            index=index.name,
+            prefix=[kwargs[key] for key in index.keys],
+        )
+        others = [key for key in kwargs.keys() if key not in index.keys]
+        if others:
+            out['filter'] = others
+        return out
+    elif name == 'select' and first:
+        items = kwargs.items()
+        key, value = items[0]
+        if value:
+            out = dict(access='index', prefix=[key, value])
+        else:
+            # storage query only match the key when value is falsy
+            out = dict(access='scan', prefix=[key])
+        if items[1:]:
+            out['filter'] = [other for other, _ in items[1:]]
+        return out
+    elif name == 'select':
+        return dict(access='ref', keys=kwargs.keys())
+    elif name == 'search' and first:
+        return dict(access='fulltext', prefix=[args[0]])
+    elif name == 'search':
+        return dict(access='ref', keys=[args[0]])
+    elif name in ('within', 'bbox') and first:
+        return dict(access='geo', prefix=[args[0]])
+    elif name in ('within', 'bbox'):
+        return dict(access='ref', index='geo:%s' % args[0])
+    elif name == 'vertices':
+        return dict(access='scan', prefix=['_meta_type', 'vertex'])
+    elif name == 'edges':
+        return dict(access='scan', prefix=['_meta_type', 'edge'])
+    elif name in ('incomings', 'outgoings'):
+        key = '_meta_end' if name == 'incomings' else '_meta_start'
+        kwargs = kwargs or dict()
+        label = kwargs.get('label')
+        if label is not None and 'label' in graphdb._indices:
+            out = dict(access='label', prefix=[key, label], index='label')
+        elif label is not None:
+            out = dict(access='adjacency', prefix=[key], filter=['label'])
+        else:
+            out = dict(access='adjacency', prefix=[key])
+        if kwargs.get('max_degree') is not None:
+            counters = 'degree' in graphdb._indices and label is None
+            out['guard'] = 'counter' if counters else 'adjacency'
+        return out
+    elif name == 'degree':
+        if 'degree' in graphdb._indices:
+            return dict(access='counter', index='degree')
+        return dict(access='adjacency', prefix=['_meta_start', '_meta_end'])
+    elif name == 'start':
+        return dict(access='ref', keys=['_meta_start'])
+    elif name == 'end':
+        return dict(access='ref', keys=['_meta_end'])
+    elif name == 'key':
+        return dict(access='ref', keys=list(args))
+    elif name == 'keys':
+        return dict(access='ref', keys=list(args))
+    elif name == 'project':
+        source = _describe(step.source)
+        source.update(_access(graphdb, step.source, first))
+        out = dict(source=source, aggregate=spec(step.aggregate)[0])
+        kind, _, kwargs = spec(step.source)
+        if kind == 'select' and args[0] in kwargs:
+            out['access'] = None
+        else:
+            out.update(access='index-only', prefix=[args[0]])
+        return out
+    elif name == 'get':
+        return dict(access='get')
+    elif name in ('to_msgpack', 'to_ndjson'):
+        return dict(access='get', decode=False)
+    elif name == 'link':
+        return dict(access='write')
+    elif name in ('sort', 'unique') and kwargs:
+        # items past the budget are spilled to temporary files
+        return dict(access=None, spill=kwargs.get('budget'))
+    elif name == 'spilled_group_count':
+        return dict(access=None, spill=args[0] if args else kwargs['budget'])
+    else:
+        return dict(access=None)
+
+
+def explain(graphdb, steps, first=True):
+    """Return a list describing how each step of the query is executed"""
+    out = list()
+    for step in plan(steps, first):
+        description = _describe(step)
+        description.update(_access(graphdb, step, first))
+        out.append(description)
+        first = False
+    return out
+
+
+class _Tracker(object):
+    """Charge time and unpacked bytes to the step being executed"""
+
+    def __init__(self, counter, outside):
+        self.counter = counter
+        self.stack = [outside]
+        self.last = time()
+        self.unpacked = counter['unpacked']
+
+    def _charge(self):
+        now = time()
+        unpacked = self.counter['unpacked']
+        stat = self.stack[-1]
+        stat['time'] += now - self.last
+        stat['bytes'] += unpacked - self.unpacked
+        self.last = now
+        self.unpacked = unpacked
+
+    def enter(self, stat):
+        self._charge()
+        self.stack.append(stat)
+
+    def leave(self):
+        self._charge()
+        self.stack.pop()
+
+    def call(self, method):
+        self.stack[-1]['calls'][method] += 1
+
+
+class _Probe(object):
+    """Iterator counting and timing the items produced by a step"""
+
+    def __init__(self, iterator, stat, tracker):
+        self.iterator = iter(iterator)
+        self.stat = stat
+        self.tracker = tracker
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.tracker.enter(self.stat)
+        try:
+            item = next(self.iterator)
+        finally:
+            self.tracker.leave()
+        self.stat['rows_out'] += 1
+        return item
+
+
+class _CountingStorage(object):
+
+    def __init__(self, storage, tracker):
+        self._storage = storage
+        self._tracker = tracker
+
+    def __getattr__(self, name):
+        method = getattr(self._storage, name)
+        if name not in STORAGE_METHODS:
+            return method
+
+        def counted(*args, **kwargs):
+            self._tracker.call(name)
+            return method(*args, **kwargs)
+        return counted
+
+
+class _Profiled(AjguDB):
+    """Copy of ``graphdb`` whose storage calls are counted by ``tracker``,
+    queries running at the same time on ``graphdb`` are not counted"""
+
+    def __init__(self, graphdb, tracker):
+        self._tuples = _CountingStorage(graphdb._tuples, tracker)
+        self._metrics = graphdb._metrics
+        self._cache = None
+        self._indices_version = graphdb._indices_version
+        # indices read the storage of their database
+        self._indices = dict()
+        for name, index in graphdb._indices.items():
+            index = copy(index)
+            index._graphdb = self
+            self._indices[name] = index
+
+
+def _stat(description=None):
+    out = dict(description or dict())
+    out.update(
+        rows_in=0,
+        rows_out=0,
+        time=0.0,
+        bytes=0,
+        calls=Counter(dict((name, 0) for name in STORAGE_METHODS)),
+    )
+    return out
+
+
+def profile(graphdb, steps, iterator=None, paths=None):
+    """Execute the query and return its result with per step statistics,
+    ``paths`` is the same as the option of ``query``"""
+    if paths is None:
+        paths = tracks(steps)
+    first = iterator is None
+    iterator = prepare(iterator, paths)
+
+    previous = packing.stats
+    counter = packing.stats = Counter(previous or dict())
+    outside = _stat()
+    tracker = _Tracker(counter, outside)
+    graphdb = _Profiled(graphdb, tracker)
+    stats = list()
+    start = time()
+    try:
+        rows = len(iterator) if isinstance(iterator, list) else None
+        steps = plan(steps, first)
+        descriptions = explain(graphdb, steps, first)
+        for step, description in zip(steps, descriptions):
+            stat = _stat(description)
+            stats.append(stat)
+            tracker.enter(stat)
+            try:
+                iterator = step(graphdb, iterator)
+                if first and not paths and hasattr(iterator, 'next'):
+                    iterator = _compact(iterator)
+                first = False
+                if isinstance(iterator, list):
+                    # step consumed its input, but its output is ready
+                    stat['rows_out'] = len(iterator)
+                elif hasattr(iterator, 'next'):
+                    iterator = _Probe(iterator, stat, tracker)
+                else:
+                    stat['rows_out'] = 1
+            finally:
+                tracker.leave()
+        if isinstance(iterator, _Probe):
+            iterator = list(iterator)
+    finally:
+        packing.stats = previous
+        if previous is not None:
+            previous.update(
+                packed=counter['packed'] - previous['packed'],
+                unpacked=counter['unpacked'] - previous['unpacked'],
+            )
+    for stat in stats:
+        stat['rows_in'] = rows
+        rows = stat['rows_out']
+        stat['calls'] = dict(stat['calls'])
+    outside['calls'] = dict(outside['calls'])
+    return dict(
+        result=iterator,
+        time=time() - start,
+        steps=stats,
+        outside=outside,
+    )
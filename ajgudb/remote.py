@@ -0,0 +1,404 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Share a storage between several processes.
+
+``StorageServer`` owns the storage and listens on a unix socket.
+``RemoteStorage`` is a storage class that forwards every call to the
+server, so that several processes can use the same database::
+
+    db = AjguDB(path, storage_class=RemoteStorage)
+
+Every message is a msgpack list of ``[method, args]`` calls, the server
+replies with the list of ``[error, result]`` of those calls. Several calls
+can be sent in one round trip using ``RemoteStorage.pipeline()``.
+"""
+import os
+import socket
+from threading import Lock
+from types import GeneratorType
+from contextlib import contextmanager
+from SocketServer import ThreadingMixIn
+from SocketServer import UnixStreamServer
+from SocketServer import BaseRequestHandler
+
+from msgpack import Packer
+from msgpack import Unpacker
+
+from .ajgudb import AjguDB
+from .ajgudb import Base
+from .gremlin import GremlinResult
+from .gremlin import from_spec
+from .gremlin import query
+from .gremlin import spec
+from .leveldb import LevelDBStorage
+from .packing import pack
+from .degree import increment
+from .unique import taken
+from .utils import AjguDBException
+
+
+BUFFER_SIZE = 2**16
+
+METHODS = (
+    'ref', 'get', 'get_packed', 'add', 'update', 'delete', 'delete_many',
+    'query', 'query_many',
+)
+
+
+def socket_path(path):
+    """Return the address of the server serving the database at ``path``"""
+    return os.path.join(path, 'ajgudb.sock')
+
+
+def _plain(value):
+    """Convert gremlin results to something that msgpack can serialize"""
+    if isinstance(value, GremlinResult):
+        return _plain(value.value)
+    elif isinstance(value, Base):
+        return value.uid
+    elif isinstance(value, dict):
+        return dict((key, _plain(other)) for key, other in value.items())
+    elif isinstance(value, (list, tuple, GeneratorType)):
+        return [_plain(other) for other in value]
+    elif hasattr(value, 'next'):
+        return [_plain(other) for other in value]
+    else:
+        return value
+
+
+class StorageServer(ThreadingMixIn, UnixStreamServer):
+    """Serve the database at ``path`` over a unix socket"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, path, storage_class=LevelDBStorage, address=None,
+        compression=None,
+    ):
+        self.graphdb = AjguDB(path, storage_class, compression=compression)
+        self.address = address or socket_path(path)
+        # storages are not thread safe, calls are serialized
+        self.lock = Lock()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        UnixStreamServer.__init__(self, self.address, _Handler)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.graphdb.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def call(self, method, args):
+        try:
+            if method == 'uid':
+                result = self.graphdb._uid(*args)
+            elif method == 'execute':
+                result = self.execute(*args)
+            elif method == 'add_unique':
+                result = self.add_unique(*args)
+            elif method == 'increment':
+                result = self.increment(*args)
+            elif method == 'keyspace':
+                name, operation, args, kwargs = args
+                keyspace = self.graphdb._tuples.keyspace(name)
+                result = getattr(keyspace, operation)(*args, **kwargs)
+                if operation == 'iterator':
+                    result = list(result)
+            elif method in ('add', 'update'):
+                uid, properties = args
+                getattr(self.graphdb._tuples, method)(uid, **properties)
+                result = None
+            elif method in METHODS:
+                result = getattr(self.graphdb._tuples, method)(*args)
+                if method in ('query', 'query_many'):
+                    result = list(result)
+            else:
+                raise AjguDBException('unknown method %s' % method)
+        except Exception as exc:
+            return [True, '%s: %s' % (type(exc).__name__, exc)]
+        else:
+            return [False, result]
+
+    def add_unique(self, elements, keys):
+        """Add the ``(uid, properties)`` of ``elements`` and their rows of
+        the unique ``keys`` unless one of their values is taken, then
+        return it, see ``unique.taken``. It runs under the lock, clients
+        can't create two elements with the same value"""
+        tuples = self.graphdb._tuples
+        rows = tuples.keyspace('unique')
+        out = taken(rows, keys, elements)
+        if out is not None:
+            return out
+        tuples.add_many(elements)
+        for uid, properties in elements:
+            for key in keys:
+                if key in properties:
+                    rows.put(pack(key, properties[key]), pack(uid))
+        return None
+
+    def increment(self, name, deltas):
+        """Add the ``(key, delta)`` of ``deltas`` to the counters of the
+        keyspace ``name``. It runs under the lock, concurrent increments
+        are not lost, see ``degree.increment``"""
+        keyspace = self.graphdb._tuples.keyspace(name)
+        increment(keyspace, [tuple(delta) for delta in deltas])
+
+    def execute(self, specs, uid=None):
+        steps = [from_spec(*description) for description in specs]
+        iterator = None if uid is None else GremlinResult(uid, None, None)
+        return _plain(query(*steps)(self.graphdb, iterator))
+
+
+class _Handler(BaseRequestHandler):
+
+    def handle(self):
+        packer = Packer(use_bin_type=True)
+        unpacker = Unpacker(encoding='utf-8')
+        while True:
+            data = self.request.recv(BUFFER_SIZE)
+            if not data:
+                break
+            unpacker.feed(data)
+            for calls in unpacker:
+                with self.server.lock:
+                    out = [self.server.call(*call) for call in calls]
+                self.request.sendall(packer.pack(out))
+
+
+class _Connection(object):
+
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.packer = Packer(use_bin_type=True)
+        self.unpacker = Unpacker(encoding='utf-8')
+
+    def close(self):
+        self.socket.close()
+
+    def send(self, calls):
+        self.socket.sendall(self.packer.pack(calls))
+        while True:
+            for out in self.unpacker:
+                return out
+            data = self.socket.recv(BUFFER_SIZE)
+            if not data:
+                raise AjguDBException('connection closed by the server')
+            self.unpacker.feed(data)
+
+
+class Pending(object):
+    """Result of a call done inside a ``RemoteStorage.pipeline()``"""
+
+    def __init__(self):
+        self._done = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._done:
+            raise AjguDBException('the pipeline is not executed yet')
+        return self._value
+
+
+class Pipeline(object):
+    """Queue storage calls to send them in one round trip"""
+
+    def __init__(self):
+        self.calls = list()
+        self.pendings = list()
+
+    def _call(self, method, *args):
+        pending = Pending()
+        self.calls.append((method, args))
+        self.pendings.append(pending)
+        return pending
+
+    def ref(self, uid, key):
+        return self._call('ref', uid, key)
+
+    def get(self, uid):
+        return self._call('get', uid)
+
+    def query(self, key, value=''):
+        return self._call('query', key, value)
+
+    def add(self, uid, **properties):
+        return self._call('add', uid, properties)
+
+    def update(self, uid, **properties):
+        return self._call('update', uid, properties)
+
+    def delete(self, uid):
+        return self._call('delete', uid)
+
+
+class RemoteKeyspace(object):
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+    def _call(self, method, *args, **kwargs):
+        return self.storage._call('keyspace', self.name, method, args, kwargs)
+
+    def get(self, key):
+        return self._call('get', key)
+
+    def put(self, key, value):
+        self._call('put', key, value)
+
+    def delete(self, key):
+        self._call('delete', key)
+
+    def iterator(self, start=None, stop=None, prefix=None):
+        out = self._call('iterator', start=start, stop=stop, prefix=prefix)
+        return iter(out)
+
+
+class RemoteStorage(object):
+    """Storage client of a ``StorageServer``"""
+
+    def __init__(self, path, pool_size=8):
+        self.address = socket_path(path)
+        self.pool_size = pool_size
+        self._connections = list()
+
+    @contextmanager
+    def connection(self):
+        if self._connections:
+            connection = self._connections.pop()
+        else:
+            connection = _Connection(self.address)
+        try:
+            yield connection
+        except:
+            # the connection might be in an unknown state
+            connection.close()
+            raise
+        else:
+            if len(self._connections) < self.pool_size:
+                self._connections.append(connection)
+            else:
+                connection.close()
+
+    def close(self):
+        while self._connections:
+            self._connections.pop().close()
+
+    def _send(self, calls):
+        with self.connection() as connection:
+            out = connection.send(calls)
+        results = list()
+        for error, result in out:
+            if error:
+                raise AjguDBException(result)
+            results.append(result)
+        return results
+
+    def _call(self, method, *args):
+        return self._send([(method, args)])[0]
+
+    @contextmanager
+    def pipeline(self):
+        """Send every call done on the pipeline in one round trip::
+
+            with storage.pipeline() as pipeline:
+                name = pipeline.ref(uid, 'name')
+            print(name.value)
+        """
+        pipeline = Pipeline()
+        yield pipeline
+        if pipeline.calls:
+            results = self._send(pipeline.calls)
+            for pending, result in zip(pipeline.pendings, results):
+                pending._value = result
+                pending._done = True
+
+    def uid(self, count=1):
+        return self._call('uid', count)
+
+    def keyspace(self, name):
+        return RemoteKeyspace(self, name)
+
+    def ref(self, uid, key):
+        return self._call('ref', uid, key)
+
+    def get(self, uid):
+        return self._call('get', uid)
+
+    def get_packed(self, uid):
+        return [tuple(row) for row in self._call('get_packed', uid)]
+
+    def get_many(self, uids):
+        return self._send([('get', (uid,)) for uid in uids])
+
+    def ref_many(self, pairs):
+        return self._send([('ref', pair) for pair in pairs])
+
+    def add(self, uid, **properties):
+        self._call('add', uid, properties)
+
+    def add_many(self, elements):
+        self._send([('add', element) for element in elements])
+
+    def add_unique(self, elements, keys):
+        """Add ``elements`` unless one of the values of the unique ``keys``
+        is taken, see ``StorageServer.add_unique``"""
+        return self._call('add_unique', elements, keys)
+
+    def increment(self, name, deltas):
+        """Add the ``(key, delta)`` of ``deltas`` to the counters of the
+        keyspace ``name``, see ``StorageServer.increment``"""
+        self._call('increment', name, deltas)
+
+    def delete(self, uid):
+        self._call('delete', uid)
+
+    def delete_many(self, uids):
+        self._call('delete_many', uids)
+
+    def update(self, uid, **properties):
+        self._call('update', uid, properties)
+
+    def query(self, key, value=''):
+        return iter(self._call('query', key, value))
+
+    def query_many(self, key, values):
+        return iter(self._call('query_many', key, list(values)))
+
+    def execute(self, specs, uid=None):
+        return self._call('execute', specs, uid)
+
+
+def ship(graphdb, *steps):
+    """Same as ``AjguDB.query`` but the pipeline is executed by the server.
+
+    Only steps whose arguments can be serialized with msgpack can be
+    shipped eg. ``filter(predicate)`` can not. ``Vertex`` and ``Edge``
+    are returned as uid."""
+    specs = [spec(step) for step in steps]
+
+    def run(iterator=None):
+        if isinstance(iterator, Base):
+            iterator = iterator.uid
+        elif isinstance(iterator, GremlinResult):
+            iterator = iterator.value
+        return graphdb._tuples.execute(specs, iterator)
+    return run
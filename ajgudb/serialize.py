@@ -0,0 +1,93 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Serialization of elements straight from the packed values of the
+storage.
+
+Elements are written one by one as maps of their uid, stored as ``_uid``,
+and of their stored properties including ``_meta_type`` and, for edges,
+``_meta_start`` and ``_meta_end``. No ``Vertex`` or ``Edge`` is built.
+msgpack values are copied as is and strings are copied without being
+decoded.
+"""
+import json
+
+from msgpack import Packer
+
+from packing import unpack_value
+
+
+UID = '_uid'
+
+
+def _rows(graphdb, uid, fields):
+    """Return ``(key, packed value)`` of the element ``uid``, when
+    ``fields`` is not ``None`` only those keys are returned in that order
+    and missing values are ``None``"""
+    rows = graphdb._tuples.get_packed(uid)
+    if fields is None:
+        return rows
+    rows = dict(rows)
+    return [(field, rows.get(field)) for field in fields]
+
+
+def _msgpack(packer, packed):
+    if packed is None:
+        return packer.pack(None)
+    kind = packed[0]
+    if kind == '4':
+        # it's stored with msgpack
+        return packed[9:]
+    elif kind in '23':
+        # str and unicode are both written as utf-8 raw strings
+        return packer.pack(packed[1:-1])
+    return packer.pack(unpack_value(packed))
+
+
+def write_msgpack(graphdb, iterator, stream, fields=None):
+    """Write the elements of ``iterator`` to ``stream`` as msgpack maps,
+    return the number of elements written"""
+    packer = Packer(encoding='utf-8')
+    count = 0
+    for item in iterator:
+        rows = _rows(graphdb, item.value, fields)
+        chunks = [
+            packer.pack_map_header(len(rows) + 1),
+            packer.pack(UID),
+            packer.pack(item.value),
+        ]
+        for key, packed in rows:
+            chunks.append(packer.pack(key))
+            chunks.append(_msgpack(packer, packed))
+        stream.write(''.join(chunks))
+        count += 1
+    return count
+
+
+def write_ndjson(graphdb, iterator, stream, fields=None):
+    """Write the elements of ``iterator`` to ``stream`` as JSON objects,
+    one per line, return the number of elements written"""
+    count = 0
+    for item in iterator:
+        rows = _rows(graphdb, item.value, fields)
+        members = ['"%s": %d' % (UID, item.value)]
+        for key, packed in rows:
+            value = None if packed is None else unpack_value(packed)
+            members.append('%s: %s' % (json.dumps(key), json.dumps(value)))
+        stream.write('{%s}\n' % ', '.join(members))
+        count += 1
+    return count
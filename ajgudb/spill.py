@@ -0,0 +1,161 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""External sort of ``(key, value)`` pairs of bytes and of objects.
+
+Pairs are buffered in memory until they reach the memory budget, then the
+buffer is sorted and written to a run file. Sorted pairs are the k-way
+merge of the runs and of the last buffer. ``Spool`` does the same with
+picklable objects sorted by their natural order, its budget is a number of
+objects since their size in memory is not known.
+"""
+import os
+import struct
+from cPickle import HIGHEST_PROTOCOL
+from cPickle import Pickler
+from cPickle import Unpickler
+from heapq import merge
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+# bytes
+BUDGET = 64 * 2**20
+
+HEADER = struct.Struct('>II')
+
+
+def _write(path, pairs):
+    with open(path, 'wb') as f:
+        for key, value in pairs:
+            f.write(HEADER.pack(len(key), len(value)))
+            f.write(key)
+            f.write(value)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if not header:
+                break
+            size, length = HEADER.unpack(header)
+            yield f.read(size), f.read(length)
+
+
+def _dump(path, objects):
+    with open(path, 'wb') as f:
+        pickler = Pickler(f, HIGHEST_PROTOCOL)
+        for obj in objects:
+            pickler.dump(obj)
+            # objects are not shared between dumps
+            pickler.clear_memo()
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        unpickler = Unpickler(f)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                break
+
+
+class Reverse(object):
+    """Wrap ``value`` so that it sorts in reverse order"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class Runs(object):
+    """Sort ``(key, value)`` pairs using at most ``budget`` bytes of
+    memory, runs are written in ``directory`` or a temporary directory"""
+
+    def __init__(self, budget=BUDGET, directory=None):
+        self.budget = budget
+        self._parent = directory
+        self._directory = None
+        self._buffer = list()
+        self._size = 0
+        self.runs = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    _write = staticmethod(_write)
+    _read = staticmethod(_read)
+
+    def add(self, key, value=''):
+        self._buffer.append((key, value))
+        # the overhead of a tuple and two strings is about 100 bytes
+        self._size += len(key) + len(value) + 100
+        if self._size >= self.budget:
+            self.spill()
+
+    def spill(self):
+        """Write the buffer to a new run"""
+        if not self._buffer:
+            return
+        if self._directory is None:
+            self._directory = mkdtemp(prefix='ajgudb-', dir=self._parent)
+        self._buffer.sort()
+        path = os.path.join(self._directory, '%d.run' % len(self.runs))
+        self._write(path, self._buffer)
+        self.runs.append(path)
+        self._buffer = list()
+        self._size = 0
+
+    def __iter__(self):
+        """Iterate pairs sorted by key"""
+        self._buffer.sort()
+        iterators = [self._read(path) for path in self.runs]
+        iterators.append(iter(self._buffer))
+        return merge(*iterators)
+
+    def close(self):
+        self._buffer = list()
+        self.runs = list()
+        if self._directory is not None:
+            rmtree(self._directory)
+            self._directory = None
+
+
+class Spool(Runs):
+    """Sort picklable objects keeping at most ``budget`` of them in
+    memory, runs are written in ``directory`` or a temporary directory"""
+
+    _write = staticmethod(_dump)
+    _read = staticmethod(_load)
+
+    def add(self, obj):
+        self._buffer.append(obj)
+        if len(self._buffer) >= self.budget:
+            self.spill()
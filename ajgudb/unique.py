@@ -0,0 +1,167 @@
+# AjuDB - leveldb powered graph database
+# Copyright (C) 2015 Amirouche Boubekki <amirouche@hypermove.net>
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301  USA
+"""Unique key index.
+
+Rows are stored in the ``unique`` keyspace as ``(key, value) -> uid`` so
+that the element with a given value is found with a single point lookup.
+A bloom filter of the values is kept in memory to answer most lookups of
+missing values without reading the storage, which is the common case of
+``get_or_create`` during bulk loads.
+
+With ``RemoteStorage`` the values are checked and the elements written by
+a single call to the server under its lock, see ``taken`` and
+``StorageServer.add_unique``, so that two clients can't both create an
+element with the same value.
+"""
+import struct
+from hashlib import md5
+from math import log
+
+from packing import pack
+from packing import unpack_value
+from utils import AjguDBException
+
+
+class Bloom(object):
+    """Bloom filter of ``capacity`` strings with ``error`` false positive
+    rate"""
+
+    def __init__(self, capacity, error=0.01):
+        self.capacity = capacity
+        self.size = int(-capacity * log(error) / log(2) ** 2) + 1
+        self.hashes = max(1, int(round(float(self.size) / capacity * log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, string):
+        a, b = struct.unpack('>QQ', md5(string).digest())
+        return [(a + index * b) % self.size for index in range(self.hashes)]
+
+    def add(self, string):
+        for position in self._positions(string):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, string):
+        for position in self._positions(string):
+            if not self.bits[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+
+def taken(rows, keys, elements):
+    """Return the ``[key, value, uid]`` of the first value of one of
+    ``keys`` of the ``(uid, properties)`` of ``elements`` that belongs to
+    another element according to the ``unique`` keyspace ``rows`` or to
+    ``elements`` themselves, or ``None``"""
+    uids = dict()
+    for uid, properties in elements:
+        for key in keys:
+            try:
+                value = properties[key]
+            except KeyError:
+                continue
+            row = pack(key, value)
+            if row in uids:
+                other = uids[row]
+            else:
+                other = rows.get(row)
+                other = None if other is None else unpack_value(other)
+            if other is not None and other != uid:
+                return [key, value, other]
+            uids[row] = uid
+    return None
+
+
+class UniqueIndex(object):
+
+    def __init__(self, graphdb, key):
+        self._graphdb = graphdb
+        self._rows = graphdb._tuples.keyspace('unique')
+        self.key = key
+        # the filter only knows about values written by this process
+        self._shared = hasattr(graphdb._tuples, 'uid')
+        self._bloom = None
+
+    def _filter(self):
+        if self._shared:
+            return None
+        if self._bloom is None or self._bloom.count > self._bloom.capacity:
+            count = self._bloom.count if self._bloom else 0
+            bloom = Bloom(max(2 * count, 1024))
+            for key, _ in self._rows.iterator(prefix=pack(self.key)):
+                bloom.add(key)
+            self._bloom = bloom
+        return self._bloom
+
+    def lookup(self, value):
+        """Return the uid of the element with ``value`` or ``None``"""
+        key = pack(self.key, value)
+        bloom = self._filter()
+        if bloom is not None and key not in bloom:
+            return None
+        uid = self._rows.get(key)
+        return None if uid is None else unpack_value(uid)
+
+    def check(self, elements):
+        """Raise ``AjguDBException`` if writing ``(uid, properties)`` of
+        ``elements`` would break the constraint"""
+        uids = dict()
+        for uid, properties in elements:
+            try:
+                value = properties[self.key]
+            except KeyError:
+                continue
+            key = pack(value)
+            other = uids[key] if key in uids else self.lookup(value)
+            if other is not None and other != uid:
+                message = '%s %r already exists' % (self.key, value)
+                raise AjguDBException(message)
+            uids[key] = uid
+
+    def add(self, uid, properties):
+        try:
+            value = properties[self.key]
+        except KeyError:
+            return
+        key = pack(self.key, value)
+        self._rows.put(key, pack(uid))
+        if self._bloom is not None:
+            self._bloom.add(key)
+
+    def delete(self, uid, properties):
+        try:
+            value = properties[self.key]
+        except KeyError:
+            return
+        if self.lookup(value) == uid:
+            self._rows.delete(pack(self.key, value))
+
+    def backfill(self):
+        tuples = self._graphdb._tuples
+        # the index is sorted by value, duplicates are next to each other,
+        # nothing is written unless every value is unique
+        records = iter(tuples.query(self.key))
+        previous = next(records, None)
+        for record in records:
+            if previous[1] == record[1]:
+                message = '%s %r is not unique' % (self.key, record[1])
+                raise AjguDBException(message)
+            previous = record
+        for _, value, uid in tuples.query(self.key):
+            self.add(uid, {self.key: value})
@@ -19,3 +19,12 @@
 
 class AjguDBException(Exception):
     pass
+
+
+class ReadOnly(object):
+    """Mixin of storage snapshots, writes raise ``AjguDBException``"""
+
+    def _read_only(self, *args, **kwargs):
+        raise AjguDBException('snapshots are read only')
+
+    add = add_many = ingest = update = delete = delete_many = _read_only
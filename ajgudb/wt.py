@@ -17,28 +17,129 @@
 # MA  02110-1301  USA
 from contextlib import contextmanager
 
+from wiredtiger import WiredTigerError
 from wiredtiger import wiredtiger_open
 
+from blobs import THRESHOLD
+from blobs import indexed
+from blobs import is_packed_reference
+from blobs import is_reference
+from blobs import reference
+from compression import check
 from packing import pack
-from packing import unpack
+from packing import unpack_tuple
+from packing import unpack_value
+from spill import BUDGET
+from spill import Runs
+from utils import AjguDBException
+from utils import ReadOnly
 
 
 WT_NOT_FOUND = -31803
 
+# library of the block compressor extension, found by the dynamic loader
+EXTENSION = 'libwiredtiger_%s.so'
+
+
+class WiredTigerKeyspace(object):
+    """Ordered key/value store with a subset of plyvel's API"""
+
+    def __init__(self, session, uri, create=True):
+        self.session = session
+        self.uri = uri
+        if create:
+            self.session.create(uri, 'key_format=u,value_format=u')
+        self._cursors = list()
+
+    @contextmanager
+    def cursor(self):
+        if self._cursors:
+            cursor = self._cursors.pop()
+        else:
+            cursor = self.session.open_cursor(self.uri)
+        try:
+            yield cursor
+        finally:
+            cursor.reset()
+            self._cursors.append(cursor)
+
+    def get(self, key):
+        with self.cursor() as cursor:
+            cursor.set_key(key)
+            if cursor.search() != WT_NOT_FOUND:
+                return cursor.get_value()
+
+    def put(self, key, value):
+        with self.cursor() as cursor:
+            cursor.set_key(key)
+            cursor.set_value(value)
+            cursor.insert()
+
+    def delete(self, key):
+        with self.cursor() as cursor:
+            cursor.set_key(key)
+            if cursor.search() != WT_NOT_FOUND:
+                cursor.remove()
+
+    def iterator(self, start=None, stop=None, prefix=None):
+        if prefix is not None:
+            start = prefix
+        with self.cursor() as cursor:
+            if start:
+                cursor.set_key(start)
+                code = cursor.search_near()
+                if code == WT_NOT_FOUND:
+                    return
+                if code == -1:
+                    if cursor.next() == WT_NOT_FOUND:
+                        return
+            elif cursor.next() == WT_NOT_FOUND:
+                return
+            while True:
+                key = cursor.get_key()
+                if prefix is not None and not key.startswith(prefix):
+                    break
+                if stop is not None and key >= stop:
+                    break
+                yield key, cursor.get_value()
+                if cursor.next() == WT_NOT_FOUND:
+                    break
+
 
 class WiredTigerStorage(object):
-    """Generic database"""
+    """Generic database.
 
-    def __init__(self, path):
-        self.wiredtiger = wiredtiger_open(path, 'create,cache_size=6GB')
+    The index is built by WiredTiger on the value column, values can't be
+    compressed one by one. Instead ``compression`` is the block compressor
+    of the tuples table eg. ``zlib``, ``lz4`` or ``zstd`` when WiredTiger is
+    built with it. It's only taken into account when the table is created,
+    a compressed database must be opened with the same ``compression`` so
+    that the extension is loaded."""
+
+    def __init__(self, path, compression=None):
+        check(compression, python=False)
+        config = 'create,cache_size=6GB'
+        if compression is not None:
+            config += ',extensions=[%s]' % (EXTENSION % compression)
+        try:
+            self.wiredtiger = wiredtiger_open(path, config)
+        except WiredTigerError as exc:
+            if compression is None:
+                raise
+            message = 'codec %s is not available: %s' % (compression, exc)
+            raise AjguDBException(message)
         self.session = self.wiredtiger.open_session()
-        self.session.create(
-            'table:tuples',
-            'key_format=QS,value_format=u,columns=(i,k,v)'
-        )
+        config = 'key_format=QS,value_format=u,columns=(i,k,v)'
+        if compression is not None:
+            config += ',block_compressor=%s' % compression
+        self.session.create('table:tuples', config)
         self.session.create('index:tuples:index', 'columns=(k,v,i)')
         self._index_cursors = list()
         self._tuples_cursors = list()
+        self._keyspaces = dict()
+        # there is no per value compression
+        self.compressor = None
+        self.blobs = self.keyspace('blobs')
 
     @contextmanager
     def tuples(self):
@@ -64,18 +165,61 @@ class WiredTigerStorage(object):
             cursor.reset()
             self._index_cursors.append(cursor)
 
+    @contextmanager
+    def _transaction(self):
+        """Run the block in a transaction of the session, it's rolled back
+        if anything goes wrong"""
+        self.session.begin_transaction()
+        try:
+            yield
+        except:
+            self.session.rollback_transaction()
+            raise
+        else:
+            self.session.commit_transaction()
+
     def close(self):
         self.wiredtiger.close()
 
+    def snapshot(self):
+        """Return a read only view of the database as of now"""
+        return WiredTigerSnapshot(self)
+
+    def keyspace(self, name):
+        """Return the ordered key/value store called ``name``"""
+        try:
+            return self._keyspaces[name]
+        except KeyError:
+            uri = 'table:keyspace_%s' % name
+            keyspace = WiredTigerKeyspace(self.session, uri)
+            self._keyspaces[name] = keyspace
+            return keyspace
+
+    def _packed(self, uid, key, data):
+        """Return the packed value of the tuple ``(uid, key)`` stored as
+        ``data``"""
+        if is_packed_reference(data):
+            return self.blobs.get(pack(uid, key))
+        return data
+
+    def _value(self, uid, key, data):
+        """Return the value of the tuple ``(uid, key)`` stored as ``data``"""
+        return unpack_value(self._packed(uid, key, data))
+
     def ref(self, uid, key):
         with self.tuples() as cursor:
             cursor.set_key(uid, key)
             if cursor.search() != WT_NOT_FOUND:
-                value = cursor.get_value()
-                value = unpack(value)[0]
-                return value
+                return self._value(uid, key, cursor.get_value())
 
     def get(self, uid):
+        return dict(
+            (key, unpack_value(packed)) for key, packed in self.get_packed(uid)
+        )
+
+    def get_packed(self, uid):
+        """Return the list of ``(key, packed value)`` of ``uid``, values
+        are not decoded"""
         def __get():
             with self.tuples() as cursor:
                 cursor.set_key(uid, '')
@@ -89,22 +233,68 @@ class WiredTigerStorage(object):
                     other, key = cursor.get_key()
                     value = cursor.get_value()
                     if other == uid:
-                        value = unpack(value)[0]
-                        yield key, value
+                        yield key, self._packed(uid, key, value)
                         if cursor.next() == WT_NOT_FOUND:
                             break
                     else:
                         break
-        tuples = dict(__get())
-        return tuples
+        return list(__get())
 
     def add(self, uid, **properties):
         with self.tuples() as cursor:
             for key, value in properties.items():
+                packed = pack(value)
+                if len(packed) > THRESHOLD:
+                    self.blobs.put(pack(uid, key), packed)
+                    # the index is built on the reference
+                    packed = pack(reference(packed))
                 cursor.set_key(uid, key)
-                cursor.set_value(pack(value))
+                cursor.set_value(packed)
                 cursor.insert()
 
+    def add_many(self, elements):
+        """Add every ``(uid, properties)`` of ``elements`` in one
+        transaction"""
+        with self._transaction():
+            for uid, properties in elements:
+                self.add(uid, **properties)
+
+    def _bulk(self, uri):
+        try:
+            # bulk cursors can only be opened on empty objects
+            return self.session.open_cursor(uri, None, 'bulk')
+        except WiredTigerError:
+            return self.session.open_cursor(uri)
+
+    def ingest(self, elements, budget=BUDGET):
+        """Add every ``(uid, properties)`` of ``elements``. Rows are sorted
+        on disk and inserted in key order. Blobs are loaded with a bulk
+        cursor when their table is empty, WiredTiger does not support bulk
+        load of tables with an index like the tuples table"""
+        with Runs(budget) as runs:
+            for uid, properties in elements:
+                for key, value in properties.items():
+                    packed = pack(value)
+                    if len(packed) > THRESHOLD:
+                        runs.add('b' + pack(uid, key), packed)
+                        packed = pack(reference(packed))
+                    runs.add('t' + pack(uid, key), packed)
+            # blobs rows sort first, references are never dangling
+            blobs = self._bulk(self.blobs.uri)
+            try:
+                with self.tuples() as tuples:
+                    for key, value in runs:
+                        if key[0] == 'b':
+                            blobs.set_key(key[1:])
+                            blobs.set_value(value)
+                            blobs.insert()
+                        else:
+                            tuples.set_key(*unpack_tuple(key[1:]))
+                            tuples.set_value(value)
+                            tuples.insert()
+            finally:
+                blobs.close()
+
     def delete(self, uid):
         with self.tuples() as cursor:
             cursor.set_key(uid, '')
@@ -113,20 +303,29 @@ class WiredTigerStorage(object):
             while True:
                 other, key = cursor.get_key()
                 if other == uid:
+                    if is_reference(unpack_value(cursor.get_value())):
+                        self.blobs.delete(pack(uid, key))
                     cursor.remove()
                     if cursor.next() == WT_NOT_FOUND:
                         break
                 else:
                     break
 
+    def delete_many(self, uids):
+        """Delete every element of ``uids`` in one transaction"""
+        with self._transaction():
+            for uid in uids:
+                self.delete(uid)
+
     def update(self, uid, **properties):
         self.delete(uid)
         self.add(uid, **properties)
 
     def query(self, key, value=''):
         with self.index() as cursor:
-            match = (key, value) if value else (key,)
-            cursor.set_key(key, pack(value), 0)
+            # values of other types than str sort before the empty string
+            match = pack(indexed(value)) if value else ''
+            cursor.set_key(key, match, 0)
             code = cursor.search_near()
             if code == WT_NOT_FOUND:
                 return
@@ -135,17 +334,77 @@ class WiredTigerStorage(object):
                     return
 
             while True:
-                key, value, uid = cursor.get_key()
-                value = unpack(value)[0]
-                other = (key, value)
-                ok = reduce(
-                    lambda previous, x: (cmp(*x) == 0) and previous,
-                    zip(match, other),
-                    True
-                )
-                if ok:
-                    yield [key, value, uid]
+                other, packed, uid = cursor.get_key()
+                # values are compared packed, they are only decoded when
+                # the row matches
+                if other == key and (not value or packed == match):
+                    other = (other, unpack_value(packed))
+                    if is_reference(other[1]):
+                        other = (other[0], self.ref(uid, other[0]))
+                    if not value or other[1] == value:
+                        # otherwise it's a hash collision
+                        yield [other[0], other[1], uid]
                     if cursor.next() == WT_NOT_FOUND:
                         break
                 else:
                     break
+
+    def query_many(self, key, values):
+        """Iterate the index rows of ``key`` and every value of ``values``
+        in the order of ``values``. A single cursor moves forward when
+        values are sorted"""
+        with self.index() as cursor:
+            for value in values:
+                match = pack(indexed(value))
+                cursor.set_key(key, match, 0)
+                code = cursor.search_near()
+                if code == WT_NOT_FOUND:
+                    continue
+                if code == -1 and cursor.next() == WT_NOT_FOUND:
+                    continue
+                while True:
+                    other, packed, uid = cursor.get_key()
+                    if other != key or packed != match:
+                        break
+                    other = unpack_value(packed)
+                    if is_reference(other):
+                        other = self.ref(uid, key)
+                    if other == value:
+                        # otherwise it's a hash collision
+                        yield [key, other, uid]
+                    if cursor.next() == WT_NOT_FOUND:
+                        break
+
+
+class WiredTigerSnapshot(ReadOnly, WiredTigerStorage):
+    """Read only view of ``storage`` using a read transaction of its own
+    session"""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.wiredtiger = storage.wiredtiger
+        self.session = storage.wiredtiger.open_session()
+        self.session.begin_transaction('isolation=snapshot')
+        self._index_cursors = list()
+        self._tuples_cursors = list()
+        self._keyspaces = dict()
+        self.compressor = None
+        self.blobs = self.keyspace('blobs')
+        # the snapshot is taken by the first read of the transaction, not
+        # by begin_transaction, writes done before it would be visible
+        with self.tuples() as cursor:
+            cursor.next()
+
+    def close(self):
+        self.session.rollback_transaction()
+        self.session.close()
+
+    def keyspace(self, name):
+        try:
+            return self._keyspaces[name]
+        except KeyError:
+            # tables are created outside of the transaction
+            uri = self._storage.keyspace(name).uri
+            keyspace = WiredTigerKeyspace(self.session, uri, create=False)
+            self._keyspaces[name] = keyspace
+            return keyspace
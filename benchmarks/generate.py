@@ -0,0 +1,79 @@
+"""Deterministic synthetic graph generator.
+
+The graph looks like a StackExchange dump: users ask and answer posts that
+are tagged. Degrees follow a power law so that a few users and tags are
+hubs like in the real data.
+"""
+from bisect import bisect
+from random import Random
+
+
+WORDS = (
+    'graph database python vertex edge query index storage leveldb bsddb '
+    'wiredtiger tuple space key value order scan traversal gremlin cache '
+    'disk memory batch transaction cursor iterator schema property label'
+).split()
+
+
+class PowerLaw(object):
+    """Pick indices with power law distributed probabilities"""
+
+    def __init__(self, random, size, alpha=1.5):
+        self.random = random
+        self.cumulative = list()
+        total = 0
+        for _ in range(size):
+            total += random.paretovariate(alpha)
+            self.cumulative.append(total)
+
+    def pick(self):
+        value = self.random.random() * self.cumulative[-1]
+        return bisect(self.cumulative, value)
+
+
+def _text(random, minimum, maximum):
+    size = random.randint(minimum, maximum)
+    return ' '.join(random.choice(WORDS) for _ in range(size))
+
+
+def generate(size, seed=42):
+    """Return ``(vertices, edges)`` of a graph with about ``size`` vertices.
+
+    ``vertices`` is a list of properties dict, ``edges`` is a list of
+    ``(start, end, properties)`` where ``start`` and ``end`` are indices in
+    ``vertices``."""
+    random = Random(seed)
+    users = max(1, size // 4)
+    tags = max(1, size // 50)
+    posts = max(1, size - users - tags)
+
+    vertices = list()
+    for index in range(users):
+        vertices.append(dict(
+            kind='user',
+            handle='user%d' % index,
+            reputation=int(random.paretovariate(1.2) * 10),
+            created='2015-%02d-%02d' % (
+                random.randint(1, 12), random.randint(1, 28)
+            ),
+        ))
+    for index in range(tags):
+        vertices.append(dict(kind='tag', name='tag%d' % index))
+    for index in range(posts):
+        vertices.append(dict(
+            kind='post',
+            title=_text(random, 4, 12),
+            body=_text(random, 20, 200),
+            score=random.randint(-5, 100),
+        ))
+
+    authors = PowerLaw(random, users)
+    labels = PowerLaw(random, tags)
+    edges = list()
+    for post in range(users + tags, len(vertices)):
+        label = 'asked' if random.random() < 0.4 else 'answered'
+        edges.append((authors.pick(), post, dict(label=label)))
+        for _ in range(random.randint(1, 3)):
+            tag = users + labels.pick()
+            edges.append((post, tag, dict(label='tagged')))
+    return vertices, edges
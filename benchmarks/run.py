@@ -0,0 +1,199 @@
+"""Benchmark the storage backends.
+
+    python -m benchmarks.run --storage leveldb --size 10000 --output out.json
+    python -m benchmarks.run --storage leveldb --compare out.json
+
+Results are written as json, ``--compare`` exits with an error when an
+operation is slower than the previous run by more than ``--threshold``.
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from ajgudb import AjguDB
+from ajgudb.ajgudb import Vertex
+from ajgudb.cli import STORAGES
+from ajgudb.cli import storage_class
+from ajgudb.gremlin import count
+from ajgudb.gremlin import end
+from ajgudb.gremlin import outgoings
+from ajgudb.gremlin import select
+
+from benchmarks.generate import generate
+
+
+BATCH = 1000
+
+
+class Timer(object):
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.operations = 0
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time() - self.start
+        self.results[self.name] = dict(
+            seconds=seconds,
+            operations=self.operations,
+            rate=self.operations / seconds if seconds else None,
+        )
+
+
+def benchmark(storage, size, seed, samples):
+    vertices, edges = generate(size, seed)
+    random = Random(seed)
+    results = dict()
+    path = mkdtemp(prefix='ajgudb-benchmark-')
+    db = AjguDB(path, storage_class(storage))
+    try:
+        with Timer(results, 'load') as timer:
+            elements = list()
+            for offset in range(0, len(vertices), BATCH):
+                batch = vertices[offset:offset + BATCH]
+                uid = db._uid(len(batch))
+                rows = list()
+                for index, properties in enumerate(batch):
+                    elements.append(Vertex(db, uid + index, properties))
+                    properties = dict(properties, _meta_type='vertex')
+                    rows.append((uid + index, properties))
+                db._add_many(rows)
+            for offset in range(0, len(edges), BATCH):
+                db.link_many(
+                    (elements[start].uid, elements[end_].uid, properties)
+                    for start, end_, properties in edges[offset:offset + BATCH]
+                )
+            timer.operations = len(vertices) + len(edges)
+
+        sample = [random.choice(elements) for _ in range(samples)]
+
+        with Timer(results, 'get') as timer:
+            for element in sample:
+                db.get(element.uid)
+            timer.operations = len(sample)
+
+        with Timer(results, 'select') as timer:
+            for element in sample:
+                if element['kind'] == 'user':
+                    query = select(kind='user', handle=element['handle'])
+                elif element['kind'] == 'tag':
+                    query = select(name=element['name'])
+                else:
+                    query = select(score=element['score'])
+                db.query(query, count)()
+            timer.operations = len(sample)
+
+        # traversals count the number of vertices reached
+        with Timer(results, 'one-hop') as timer:
+            query = db.query(outgoings, end, count)
+            for element in sample:
+                timer.operations += query(element)
+
+        with Timer(results, 'two-hop') as timer:
+            query = db.query(outgoings, end, outgoings, end, count)
+            for element in sample:
+                timer.operations += query(element)
+
+        with Timer(results, 'update') as timer:
+            for element in sample:
+                element['benchmark'] = True
+                element.save()
+            timer.operations = len(sample)
+
+        with Timer(results, 'delete') as timer:
+            deleted = set()
+            for element in sample:
+                if element.uid not in deleted:
+                    deleted.add(element.uid)
+                    db.get(element.uid).delete()
+            timer.operations = len(deleted)
+    finally:
+        db.close()
+        rmtree(path)
+    return results
+
+
+def compare(previous, current, threshold):
+    """Print the ratio of rates on stderr, stdout is kept for the json
+    output, and return ``True`` on regression"""
+    regression = False
+    for storage, results in sorted(current['storages'].items()):
+        for name, result in sorted(results.items()):
+            try:
+                other = previous['storages'][storage][name]['rate']
+            except KeyError:
+                continue
+            if not (other and result['rate']):
+                continue
+            ratio = result['rate'] / other
+            flag = ''
+            if ratio < 1 - threshold:
+                regression = True
+                flag = ' REGRESSION'
+            sys.stderr.write('%-12s %-8s %10.1f ops/s %6.2fx%s\n' % (
+                storage, name, result['rate'], ratio, flag
+            ))
+    return regression
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='benchmarks.run')
+    parser.add_argument(
+        '--storage', action='append', choices=sorted(STORAGES.keys()),
+        help='can be repeated, default: every backend that can be imported',
+    )
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='json file of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    storages = args.storage
+    if not storages:
+        storages = list()
+        for storage in sorted(STORAGES.keys()):
+            try:
+                storage_class(storage)
+            except ImportError:
+                continue
+            storages.append(storage)
+
+    out = dict(
+        size=args.size,
+        seed=args.seed,
+        samples=args.samples,
+        python=sys.version.split()[0],
+        storages=dict(),
+    )
+    for storage in storages:
+        out['storages'][storage] = benchmark(
+            storage, args.size, args.seed, args.samples
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+    else:
+        json.dump(out, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(previous, out, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
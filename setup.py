@@ -16,13 +16,20 @@ setup(
     url='https://github.com/amirouche/ajgudb',
     description='Graph Database for everyday',
     long_description=read('README.rst'),
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     zip_safe=False,
     license='LGPLv2.1 or later',
     install_requires=[
         'plyvel',
         'msgpack-python',
     ],
+    extras_require={
+        # ajgudb.aio under python 2
+        'async': ['trollius', 'futures'],
+    },
+    entry_points={
+        'console_scripts': ['ajgudb=ajgudb.cli:main'],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
@@ -1,19 +1,46 @@
 #!/usr/bin/env python
+import json
 import os
+from collections import Counter
 from shutil import rmtree
+from threading import Thread
+from StringIO import StringIO
 from unittest import TestCase
+from unittest import skipIf
 from time import sleep
 
+from msgpack import Unpacker
+
 from ajgudb import AjguDB
+from ajgudb import packing
 from ajgudb.packing import pack
 from ajgudb.packing import unpack
+from ajgudb.packing import unpack_index
+from ajgudb.packing import unpack_tuple
+from ajgudb.packing import unpack_value
 
 from ajgudb.utils import AjguDBException
+from ajgudb.compression import available
 from ajgudb.bsddb import BSDDBStorage
 from ajgudb.leveldb import LevelDBStorage
 from ajgudb.wt import WiredTigerStorage
+from ajgudb.remote import RemoteStorage
+from ajgudb.remote import StorageServer
+from ajgudb.remote import ship
+from ajgudb.importer import Importer
+from ajgudb.spill import Runs
+from ajgudb.spill import Spool
+from ajgudb.unique import Bloom
+from ajgudb.cli import main
 from ajgudb.gremlin import *  # noqa
 
+try:
+    from ajgudb.aio import asyncio
+    from ajgudb.aio import AsyncAjguDB
+    from ajgudb.aio import StopAsyncIteration
+except ImportError:
+    AsyncAjguDB = None
+
 
 class TestPacking(TestCase):
 
@@ -52,6 +79,20 @@ class TestPacking(TestCase):
         unpacked = unpack(packed)
         self.assertEqual(unpacked, [123, 'foobar', 3.14, dict(a='b')])
 
+    def test_unpack_value(self):
+        self.assertEqual(unpack_value(pack(3.14, 'foobar')), 3.14)
+
+    def test_unpack_tuple(self):
+        self.assertEqual(unpack_tuple(pack(42, 'foobar')), [42, 'foobar'])
+        self.assertEqual(unpack_tuple(pack(42, u'foobar')), [42, u'foobar'])
+
+    def test_unpack_index(self):
+        for value in ('foobar', u'foobar', 42, 3.14, [1, 2], ''):
+            packed = pack('key', value, 42)
+            self.assertEqual(unpack_index(packed), ['key', value, 42])
+        packed = pack(u'key', 'foobar', 42)
+        self.assertEqual(unpack_index(packed), [u'key', 'foobar', 42])
+
 
 class TestLevelDBTupleSpace(TestCase):
 
@@ -92,6 +133,23 @@ class TestLevelDBTupleSpace(TestCase):
         out = list(self.tuplespace.query('key'))
         self.assertEqual(out, [])
 
+    def test_keyspace(self):
+        keyspace = self.tuplespace.keyspace('test')
+        keyspace.put(pack('b'), 'two')
+        keyspace.put(pack('a', 1), 'one')
+        keyspace.put(pack('a', 2), 'three')
+        self.assertEqual(keyspace.get(pack('b')), 'two')
+        self.assertIsNone(keyspace.get(pack('c')))
+        out = [value for _, value in keyspace.iterator(prefix=pack('a'))]
+        self.assertEqual(out, ['one', 'three'])
+        keyspace.delete(pack('a', 1))
+        keyspace.delete(pack('a', 1))
+        out = [value for _, value in keyspace.iterator()]
+        self.assertEqual(out, ['three', 'two'])
+        stop = pack('b')
+        out = [value for _, value in keyspace.iterator(stop=stop)]
+        self.assertEqual(out, ['three'])
+
 
 class TestWiredTigerTupleSpace(TestLevelDBTupleSpace):
 
@@ -117,6 +175,26 @@ class DatabaseTestCase(TestCase):
         rmtree('/tmp/ajgudb')
 
 
+class RemoteTestCase(TestCase):
+
+    def setUp(self):
+        os.makedirs('/tmp/ajgudb')
+        self.server = StorageServer('/tmp/ajgudb', LevelDBStorage)
+        self.thread = Thread(
+            target=self.server.serve_forever,
+            kwargs=dict(poll_interval=0.01),
+        )
+        self.thread.start()
+        self.graph = AjguDB('/tmp/ajgudb', RemoteStorage)
+
+    def tearDown(self):
+        self.graph.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        rmtree('/tmp/ajgudb')
+
+
 class BaseTestGraphDatabase(object):
 
     def test_create_vertex(self):
@@ -243,6 +321,46 @@ class BaseTestGraphDatabase(object):
         end = self.graph.get(end.uid)
         self.assertEquals(len(list(end.incomings())), 0)
 
+    def test_link_many(self):
+        start = self.graph.vertex()
+        ends = [self.graph.vertex() for _ in range(3)]
+        links = [
+            (start, ends[0], dict(weight=1)),
+            (start.uid, ends[1].uid, None),
+            (ends[2], start, dict()),
+        ]
+        one, two, three = self.graph.link_many(links)
+        self.assertEqual(one['weight'], 1)
+        self.assertEqual(self.graph.get(one.uid).end(), ends[0])
+        self.assertEqual(self.graph.get(two.uid).start(), start)
+        self.assertEqual(self.graph.get(three.uid).end(), start)
+        self.assertEqual(two.uid, one.uid + 1)
+        self.assertEqual(len(list(start.outgoings())), 2)
+        self.assertEqual(self.graph.link_many([]), [])
+
+    def test_delete_many(self):
+        hub = self.graph.vertex(label='hub')
+        others = [self.graph.vertex(label='other') for _ in range(5)]
+        for other in others:
+            hub.link(other)
+            other.link(hub)
+        hub.link(hub)
+        self.graph.delete_many([hub.uid, others[0].uid], chunk=3)
+        self.assertRaises(AjguDBException, self.graph.get, hub.uid)
+        self.assertRaises(AjguDBException, self.graph.get, others[0].uid)
+        self.assertEqual(self.graph.query(edges, count)(), 0)
+        self.assertEqual(self.graph.query(vertices, count)(), 4)
+
+    def test_delete_many_with_index(self):
+        self.graph.create_index('label', 'name')
+        start = self.graph.vertex(label='user', name='start')
+        start.link(self.graph.vertex(label='user', name='end'), name='edge')
+        start.delete()
+        query = self.graph.query(select(label='user', name='start'), count)
+        self.assertEqual(query(), 0)
+        query = self.graph.query(select(label='user', name='end'), count)
+        self.assertEqual(query(), 1)
+
 
 class TestBSDDDBGraphDatabase(BaseTestGraphDatabase, DatabaseTestCase):
 
@@ -259,6 +377,92 @@ class TestLevelDBGraphDatabase(BaseTestGraphDatabase, DatabaseTestCase):
     storage_class = LevelDBStorage
 
 
+class TestRemoteGraphDatabase(BaseTestGraphDatabase, RemoteTestCase):
+
+    def test_pipeline(self):
+        one = self.graph.vertex(label='one')
+        two = self.graph.vertex(label='two')
+        with self.graph._tuples.pipeline() as pipeline:
+            first = pipeline.ref(one.uid, 'label')
+            second = pipeline.get(two.uid)
+        self.assertEqual(first.value, 'one')
+        self.assertEqual(second.value, dict(_meta_type='vertex', label='two'))
+
+    def test_get_many(self):
+        one = self.graph.vertex(label='one')
+        two = self.graph.vertex(label='two')
+        out = self.graph._tuples.get_many([one.uid, two.uid])
+        self.assertEqual([x['label'] for x in out], ['one', 'two'])
+
+    def test_ship(self):
+        seed = self.graph.vertex(label='seed')
+        seed.link(self.graph.vertex(label='one'), label='ok')
+        seed.link(self.graph.vertex(label='two'), label='ok')
+        seed.link(self.graph.vertex(label='one'), label='ko')
+        query = ship(self.graph, outgoings, select(label='ok'), count)
+        self.assertEqual(query(seed), 2)
+        query = ship(self.graph, select(label='seed'), get)
+        self.assertEqual(query(), [seed.uid])
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        os.makedirs('/tmp/ajgudb')
+        self.graph = AjguDB('/tmp/ajgudb', LevelDBStorage, metrics=True)
+
+    def tearDown(self):
+        self.graph.close()
+        rmtree('/tmp/ajgudb')
+
+    def test_metrics(self):
+        seed = self.graph.vertex(label='seed', name='one')
+        seed.link(self.graph.vertex())
+        self.graph.query(outgoings, end, get)(seed)
+        metrics = self.graph.metrics()
+        self.assertEqual(metrics['calls']['query'], 1)
+        self.assertEqual(metrics['calls']['ref'], 1)
+        self.assertEqual(metrics['scanned'], 1)
+        self.assertEqual(metrics['latency']['query']['count'], 1)
+        self.assertTrue(metrics['unpacked'] > 0)
+        batch = metrics['batch']
+        # the seed vertex and the edge are written with three tuples
+        self.assertEqual(batch['buckets'][2], [4, batch['buckets'][1][1] + 2])
+
+    def test_packing_scoped(self):
+        self.graph.vertex(label='seed')
+        packed = self.graph.metrics()['packed']
+        self.assertTrue(packed > 0)
+        self.assertIsNone(packing.stats)
+        other = AjguDB('/tmp/ajgudb-other', LevelDBStorage, metrics=True)
+        try:
+            other.vertex(label='seed')
+            self.assertTrue(other.metrics()['packed'] > 0)
+        finally:
+            other.close()
+            rmtree('/tmp/ajgudb-other')
+        self.assertEqual(self.graph.metrics()['packed'], packed)
+
+    def test_metrics_disabled(self):
+        graph = AjguDB('/tmp/ajgudb-disabled')
+        try:
+            self.assertRaises(AjguDBException, graph.metrics)
+        finally:
+            graph.close()
+            rmtree('/tmp/ajgudb-disabled')
+
+    def test_export_metrics(self):
+        self.graph.vertex(label='seed')
+        out = list()
+        self.graph.export_metrics(out.append)
+        text = out[0]
+        self.assertIn('ajgudb_storage_calls_total{method="add"} 2', text)
+        self.assertIn(
+            'ajgudb_storage_latency_seconds_bucket{le="+Inf",method="add"} 2',
+            text,
+        )
+
+
 class BaseTestGremlin(object):
 
     def test_graph_one(self):
@@ -314,6 +518,24 @@ class BaseTestGremlin(object):
         query = self.graph.query(outgoings, end, outgoings, count)
         self.assertEqual(query(seed), 2)
 
+    def test_outgoings_many(self):
+        seeds = [self.graph.vertex() for _ in range(3)]
+        for seed in seeds:
+            seed.link(self.graph.vertex(), index=seed.uid)
+        seeds.reverse()
+        uids = [seed.uid for seed in seeds + seeds[:1]]
+        items = [GremlinResult(uid, None, None) for uid in uids]
+        query = self.graph.query(outgoings, key('index'), value)
+        self.assertEqual(list(query(items)), sorted(uids))
+        query = self.graph.query(outgoings(ordered=True), key('index'), value)
+        self.assertEqual(list(query(items)), uids)
+
+    def test_outgoings_spec(self):
+        step = outgoings(ordered=True)
+        self.assertEqual(spec(step), ('outgoings', (), dict(ordered=True)))
+        self.assertEqual(spec(from_spec(*spec(step))), spec(step))
+        self.assertEqual(spec(outgoings), ('outgoings', None, None))
+
     def test_incomings(self):
         seed = self.graph.vertex()
         other = self.graph.vertex()
@@ -343,6 +565,32 @@ class BaseTestGremlin(object):
         out = out[0]
         self.assertEqual(out, [seed, link, other])
 
+    def test_compact(self):
+        seed = self.graph.vertex()
+        other = self.graph.vertex()
+        seed.link(other)
+        out = list(self.graph.query(outgoings, end)(seed))
+        self.assertEqual(out, [GremlinResult(other.uid, None, None)])
+        self.assertIs(type(out[0]), Compact)
+        out = list(self.graph.query(vertices, outgoings, end)())
+        self.assertIs(type(out[0]), Compact)
+        out = self.graph.query(outgoings, end, back, start, value)(seed)
+        self.assertEqual(out, [seed.uid])
+
+    def test_paths_option(self):
+        seed = self.graph.vertex()
+        link = seed.link(self.graph.vertex())
+
+        def parent(graphdb, item):
+            return item.parent.value
+
+        query = self.graph.query(outgoings, end, each(parent), paths=True)
+        self.assertEqual(next(query(seed)).value, link.uid)
+        out = self.graph.profile(outgoings, end, paths=True)(seed)
+        self.assertIsNot(type(out['result'][0]), Compact)
+        out = self.graph.profile(outgoings, end)(seed)
+        self.assertIs(type(out['result'][0]), Compact)
+
     def test_incomings_three(self):
         seed = self.graph.vertex()
         other = self.graph.vertex()
@@ -372,6 +620,1189 @@ class BaseTestGremlin(object):
         query = self.graph.query(outgoings, end, key('value'), unique, value)
         self.assertEqual(query(seed), [1])
 
+    def test_spilled_sort(self):
+        values = [(index % 5, index) for index in reversed(range(20))]
+        items = [GremlinResult(x, None, None) for x in values]
+        query = self.graph.query(sort(budget=3), value)
+        self.assertEqual(list(query(items)), sorted(values))
+        query = self.graph.query(
+            sort(key=lambda g, x: x.value[0], reverse=True, budget=3),
+            value,
+        )
+        expected = sorted(values, key=lambda x: x[0], reverse=True)
+        self.assertEqual(list(query(items)), expected)
+
+    def test_spilled_unique(self):
+        values = [3, 1, 3, 2, 4, 1, 5, 2, 6, 5]
+        items = [GremlinResult(x, None, None) for x in values]
+        query = self.graph.query(unique(budget=2), value)
+        self.assertEqual(list(query(items)), [3, 1, 2, 4, 5, 6])
+
+    def test_spilled_group_count(self):
+        values = ['a', 'b', 'c', 'a', 'd', 'b', 'a', None]
+        items = [GremlinResult(x, None, None) for x in values]
+        query = self.graph.query(spilled_group_count(2))
+        out = list(query(items))
+        self.assertEqual(out, sorted(Counter(values).items()))
+        step = from_spec(*spec(spilled_group_count(budget=2)))
+        self.assertEqual(list(step(self.graph, items)), out)
+        query = self.graph.query(group_count)
+        self.assertEqual(next(query(items)), Counter(values))
+
+    def test_link(self):
+        for _ in range(3):
+            self.graph.vertex(label='tag')
+        query = self.graph.query(select(label='tag'), link(label='hub'))
+        hub = next(query())
+        self.assertEqual(hub['label'], 'hub')
+        self.assertEqual(self.graph.query(outgoings, count)(hub), 3)
+        next(query())
+        self.assertEqual(self.graph.query(outgoings, count)(hub), 6)
+
+    def test_group_count_index_only(self):
+        self.graph.vertex(tag='python')
+        self.graph.vertex(tag='python')
+        self.graph.vertex(tag=u'scheme')
+        self.graph.vertex(tag=42)
+        seed = self.graph.vertex()
+        seed.link(self.graph.vertex(), tag='python')
+        query = self.graph.query(vertices, key('tag'), group_count)
+        out = next(query())
+        expected = {'python': 2, u'scheme': 1, 42: 1, None: 2}
+        self.assertEqual(out, expected)
+
+    def test_value_index_only(self):
+        self.graph.vertex(kind='post', title='second')
+        self.graph.vertex(kind='post', title='first')
+        self.graph.vertex(kind='post')
+        self.graph.vertex(kind='page', title='other')
+        query = self.graph.query(select(kind='post'), key('title'), value)
+        self.assertEqual(query(), ['second', 'first', None])
+        query = self.graph.query(select(kind='post'), key('kind'), value)
+        self.assertEqual(query(), ['post', 'post', 'post'])
+
+
+class BaseTestFullText(object):
+
+    def test_search(self):
+        self.graph.create_fulltext_index('title')
+        one = self.graph.vertex(title=u'Building a Python graph database')
+        two = self.graph.vertex(title='python graph of graph')
+        self.graph.vertex(title='Something else')
+        query = self.graph.query(search('title', 'graph PYTHON'), get)
+        self.assertEqual(query(), [one, two])
+        query = self.graph.query(search('title', 'database else', 'or'), count)
+        self.assertEqual(query(), 2)
+        query = self.graph.query(search('title', 'graph', rank=True), get)
+        self.assertEqual(query(), [two, one])
+
+    def test_search_mode(self):
+        self.graph.create_fulltext_index('title')
+        seed = self.graph.vertex(title='python')
+        with self.assertRaises(AjguDBException):
+            self.graph.query(search('title', 'python', 'xor'), count)()
+        query = self.graph.query(search('title', 'python', 'xor'), count)
+        with self.assertRaises(AjguDBException):
+            query(seed)
+
+    def test_search_backfill_and_update(self):
+        one = self.graph.vertex(title=u'caf\xe9 society')
+        self.graph.create_fulltext_index('title')
+        query = self.graph.query(search('title', 'cafe'), get)
+        self.assertEqual(query(), [one])
+        one['title'] = 'tea society'
+        one.save()
+        self.assertEqual(query(), [])
+        query = self.graph.query(search('title', 'tea'), get)
+        self.assertEqual(query(), [one])
+        one.delete()
+        self.assertEqual(query(), [])
+
+    def test_search_filter(self):
+        self.graph.create_fulltext_index('title')
+        seed = self.graph.vertex()
+        seed.link(self.graph.vertex(title='python'))
+        seed.link(self.graph.vertex(title='scheme'))
+        query = self.graph.query(outgoings, end, search('title', 'scheme'))
+        self.assertEqual(len(list(query(seed))), 1)
+
+    def test_index_persisted(self):
+        self.graph.create_fulltext_index('title')
+        self.graph.close()
+        self.graph = AjguDB('/tmp/ajgudb', self.storage_class)
+        one = self.graph.vertex(title='python')
+        query = self.graph.query(search('title', 'python'), get)
+        self.assertEqual(query(), [one])
+
+
+class TestBSDDBFullText(BaseTestFullText, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBFullText(BaseTestFullText, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerFullText(BaseTestFullText, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class BaseTestGeo(object):
+
+    def setUp(self):
+        super(BaseTestGeo, self).setUp()
+        self.paris = self.graph.vertex(name='paris', lat=48.8566, lon=2.3522)
+        self.versailles = self.graph.vertex(
+            name='versailles', lat=48.8049, lon=2.1204
+        )
+        self.london = self.graph.vertex(name='london', lat=51.5074, lon=-0.1278)
+        self.fiji = self.graph.vertex(name='fiji', lat=-17.7134, lon=178.065)
+        self.graph.create_geo_index('location')
+
+    def test_within(self):
+        query = self.graph.query(within('location', 48.85, 2.35, 5000), get)
+        self.assertEqual(query(), [self.paris])
+        query = self.graph.query(within('location', 48.85, 2.35, 20000), get)
+        self.assertEqual(set(query()), set([self.paris, self.versailles]))
+        query = self.graph.query(within('location', 50, 1, 400000), count)
+        self.assertEqual(query(), 3)
+
+    def test_within_antimeridian(self):
+        query = self.graph.query(within('location', -17.7, -179.9, 300000), get)
+        self.assertEqual(query(), [self.fiji])
+
+    def test_bbox(self):
+        query = self.graph.query(bbox('location', 48, 2, 49, 3), get)
+        self.assertEqual(set(query()), set([self.paris, self.versailles]))
+        query = self.graph.query(bbox('location', -20, 170, -10, -170), get)
+        self.assertEqual(query(), [self.fiji])
+
+    def test_within_filter(self):
+        seed = self.graph.vertex()
+        seed.link(self.paris)
+        seed.link(self.london)
+        query = self.graph.query(
+            outgoings, end, within('location', 51.5, 0, 20000), get
+        )
+        self.assertEqual(query(seed), [self.london])
+
+    def test_update(self):
+        self.paris['lat'] = 40.7128
+        self.paris['lon'] = -74.0060
+        self.paris.save()
+        query = self.graph.query(within('location', 48.85, 2.35, 5000), get)
+        self.assertEqual(query(), [])
+        query = self.graph.query(within('location', 40.7, -74, 5000), get)
+        self.assertEqual(query(), [self.paris])
+
+
+class TestBSDDBGeo(BaseTestGeo, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBGeo(BaseTestGeo, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerGeo(BaseTestGeo, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+TEXT = ' '.join(['the quick brown fox jumps over the lazy dog'] * 10)
+
+
+class BaseTestCompression(object):
+
+    def reopen(self, compression):
+        self.graph.close()
+        self.graph = AjguDB(
+            '/tmp/ajgudb', self.storage_class, compression=compression
+        )
+
+    def raw(self, uid, key):
+        return self.graph._tuples.tuples.get(pack(uid, key))
+
+    def test_zlib(self):
+        self.reopen('zlib')
+        vertex = self.graph.vertex(text=TEXT, short='short')
+        self.assertEqual(self.raw(vertex.uid, 'text')[0], 'z')
+        self.assertTrue(len(self.raw(vertex.uid, 'text')) < len(TEXT))
+        self.assertEqual(self.raw(vertex.uid, 'short'), pack('short'))
+        self.assertEqual(self.graph.get(vertex.uid), vertex)
+        self.assertEqual(self.graph.get(vertex.uid)['text'], TEXT)
+        query = self.graph.query(select(text=TEXT), key('short'), value)
+        self.assertEqual(query(), ['short'])
+        vertex.delete()
+        self.assertEqual(self.graph.query(select(text=TEXT), count)(), 0)
+
+    def test_mixed_codecs(self):
+        old = self.graph.vertex(text=TEXT)
+        self.reopen('zlib')
+        new = self.graph.vertex(text=TEXT)
+        self.assertEqual(self.graph.get(old.uid)['text'], TEXT)
+        self.reopen(None)
+        self.assertEqual(self.graph.get(new.uid)['text'], TEXT)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(AjguDBException):
+            self.reopen('snappy')
+        self.graph = AjguDB('/tmp/ajgudb', self.storage_class)
+
+    @skipIf(not available('lz4'), 'lz4 is not installed')
+    def test_lz4(self):
+        self.reopen('lz4')
+        vertex = self.graph.vertex(text=TEXT)
+        self.assertEqual(self.raw(vertex.uid, 'text')[0], 'l')
+        self.assertEqual(self.graph.get(vertex.uid)['text'], TEXT)
+
+    @skipIf(not available('zstd'), 'zstandard is not installed')
+    def test_zstd_dictionary(self):
+        self.reopen('zstd')
+        for index in range(500):
+            text = u'user %s likes %s graph databases' % (index, index * 7)
+            self.graph.vertex(bio=text + u' and lives in city %s' % index)
+        vertex = self.graph.vertex(bio=TEXT)
+        self.assertEqual(self.raw(vertex.uid, 'bio')[0], 's')
+        self.graph.train_dictionary('bio', size=1024)
+        other = self.graph.vertex(bio=TEXT)
+        self.assertEqual(self.raw(other.uid, 'bio')[0], 'd')
+        self.reopen(None)
+        self.assertEqual(self.graph.get(vertex.uid)['bio'], TEXT)
+        self.assertEqual(self.graph.get(other.uid)['bio'], TEXT)
+
+
+class TestBSDDBCompression(BaseTestCompression, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBCompression(BaseTestCompression, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerCompression(TestCase):
+
+    def setUp(self):
+        # the table is compressed when it's created
+        os.makedirs('/tmp/ajgudb')
+
+    def tearDown(self):
+        rmtree('/tmp/ajgudb')
+
+    def open(self, compression):
+        return AjguDB(
+            '/tmp/ajgudb', WiredTigerStorage, compression=compression
+        )
+
+    def test_zlib(self):
+        graph = self.open('zlib')
+        try:
+            vertex = graph.vertex(text=TEXT)
+        finally:
+            graph.close()
+        graph = self.open('zlib')
+        try:
+            self.assertEqual(graph.get(vertex.uid)['text'], TEXT)
+            query = graph.query(select(text=TEXT), count)
+            self.assertEqual(query(), 1)
+        finally:
+            graph.close()
+
+    def test_unknown_codec(self):
+        with self.assertRaises(AjguDBException):
+            self.open('snappy')
+
+
+LARGE = 'x' * 2000
+
+
+class BaseTestBlobs(object):
+
+    def blob(self, uid, key):
+        return self.graph._tuples.blobs.get(pack(uid, key))
+
+    def test_large_value(self):
+        vertex = self.graph.vertex(text=LARGE, other=LARGE + 'y')
+        self.assertIsNotNone(self.blob(vertex.uid, 'text'))
+        self.assertEqual(self.graph.get(vertex.uid)['text'], LARGE)
+        self.assertEqual(self.graph._tuples.ref(vertex.uid, 'text'), LARGE)
+        query = self.graph.query(select(text=LARGE), get)
+        self.assertEqual(query(), [vertex])
+        query = self.graph.query(select(text=LARGE + 'x'), get)
+        self.assertEqual(query(), [])
+        query = self.graph.query(vertices, key('other'), value)
+        self.assertEqual(query(), [LARGE + 'y'])
+
+    def test_update_and_delete(self):
+        vertex = self.graph.vertex(text=LARGE)
+        vertex['text'] = 'small'
+        vertex.save()
+        self.assertIsNone(self.blob(vertex.uid, 'text'))
+        self.assertEqual(self.graph.query(select(text=LARGE), count)(), 0)
+        vertex['text'] = LARGE
+        vertex.save()
+        vertex.delete()
+        self.assertIsNone(self.blob(vertex.uid, 'text'))
+        self.assertEqual(self.graph.query(select(text=LARGE), count)(), 0)
+
+
+class TestBSDDBBlobs(BaseTestBlobs, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBBlobs(BaseTestBlobs, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerBlobs(BaseTestBlobs, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class BaseTestCompositeIndex(object):
+
+    def test_select(self):
+        self.graph.vertex(kind='user', handle='amz3')
+        self.graph.create_index('kind', 'handle')
+        user = self.graph.vertex(kind='user', handle='zaza', age=0)
+        self.graph.vertex(kind='post', handle='zaza')
+        query = self.graph.query(select(kind='user', handle='zaza'), get)
+        self.assertEqual(query(), [user])
+        query = self.graph.query(select(kind='user', handle='amz3'), count)
+        self.assertEqual(query(), 1)
+        query = self.graph.query(select(handle='zaza', kind='user', age=0))
+        self.assertEqual(len(list(query())), 1)
+        query = self.graph.query(select(handle='zaza', kind='user', age=1))
+        self.assertEqual(len(list(query())), 0)
+
+    def test_explain(self):
+        self.graph.create_index('kind', 'handle')
+        steps = select(kind='user', handle='zaza', age=0)
+        out = self.graph.explain(steps)()[0]
+        self.assertEqual(out['access'], 'composite')
+        self.assertEqual(out['prefix'], ['user', 'zaza'])
+        self.assertEqual(out['filter'], ['age'])
+
+    def test_update_and_delete(self):
+        self.graph.create_index('kind', 'handle')
+        user = self.graph.vertex(kind='user', handle='zaza')
+        user['handle'] = 'amz3'
+        user.save()
+        query = self.graph.query(select(kind='user', handle='zaza'), count)
+        self.assertEqual(query(), 0)
+        query = self.graph.query(select(kind='user', handle='amz3'), get)
+        self.assertEqual(query(), [user])
+        user.delete()
+        self.assertEqual(query(), [])
+
+
+class TestBSDDBCompositeIndex(BaseTestCompositeIndex, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBCompositeIndex(BaseTestCompositeIndex, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerCompositeIndex(BaseTestCompositeIndex, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class BaseTestUnique(object):
+
+    def test_unique(self):
+        self.graph.vertex(email='a@example.com')
+        self.graph.unique('email')
+        with self.assertRaises(AjguDBException):
+            self.graph.vertex(email='a@example.com')
+        other = self.graph.vertex(email='b@example.com')
+        other['email'] = 'a@example.com'
+        with self.assertRaises(AjguDBException):
+            other.save()
+        query = self.graph.query(select(email='a@example.com'), count)
+        self.assertEqual(query(), 1)
+
+    def test_unique_backfill(self):
+        self.graph.vertex(email='a@example.com')
+        self.graph.vertex(email='a@example.com')
+        with self.assertRaises(AjguDBException):
+            self.graph.unique('email')
+
+    def test_update_and_delete(self):
+        self.graph.unique('email')
+        user = self.graph.vertex(email='a@example.com')
+        user['email'] = 'b@example.com'
+        user.save()
+        self.graph.vertex(email='a@example.com')
+        user.delete()
+        self.graph.vertex(email='b@example.com')
+
+    def test_add_many(self):
+        self.graph.unique('email')
+        uid = self.graph._uid(2)
+        elements = [
+            (uid, dict(_meta_type='vertex', email='a@example.com')),
+            (uid + 1, dict(_meta_type='vertex', email='a@example.com')),
+        ]
+        with self.assertRaises(AjguDBException):
+            self.graph._add_many(elements)
+
+    def test_get_or_create(self):
+        self.graph.unique('email')
+        user = self.graph.get_or_create(
+            email='a@example.com', defaults=dict(name='amz3'),
+        )
+        self.assertEqual(user['name'], 'amz3')
+        other = self.graph.get_or_create(email='a@example.com')
+        self.assertEqual(other, user)
+        self.assertEqual(other['name'], 'amz3')
+        with self.assertRaises(AjguDBException):
+            self.graph.get_or_create(email='a@example.com', name='zaza')
+
+
+class TestBSDDBUnique(BaseTestUnique, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBUnique(BaseTestUnique, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerUnique(BaseTestUnique, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteUnique(BaseTestUnique, RemoteTestCase):
+
+    def test_get_or_create_race(self):
+        self.graph.unique('email')
+        other = AjguDB('/tmp/ajgudb', RemoteStorage)
+        user = other.get_or_create(email='a@example.com')
+        other.close()
+        # the other client wrote it after the lookup
+        index = self.graph._unique_index(['email'])
+        index.lookup = lambda value: None
+        self.assertEqual(self.graph.get_or_create(email='a@example.com'), user)
+        with self.assertRaises(AjguDBException):
+            self.graph.vertex(email='a@example.com')
+        query = self.graph.query(select(email='a@example.com'), count)
+        self.assertEqual(query(), 1)
+
+    def test_declared_by_other_client(self):
+        other = AjguDB('/tmp/ajgudb', RemoteStorage)
+        self.graph.unique('email')
+        self.graph.create_index('kind', 'handle')
+        user = other.vertex(kind='user', handle='zaza', email='a@example.com')
+        with self.assertRaises(AjguDBException):
+            other.vertex(email='a@example.com')
+        other.close()
+        query = self.graph.query(select(kind='user', handle='zaza'), get)
+        self.assertEqual(query(), [user])
+
+
+class BaseTestDegree(object):
+
+    def _graph(self):
+        hub = self.graph.vertex(label='hub')
+        others = [self.graph.vertex(label='other') for _ in range(4)]
+        for other in others:
+            hub.link(other)
+        others[0].link(hub)
+        return hub, others
+
+    def test_degree(self):
+        hub, others = self._graph()
+        self.graph.create_degree_index()
+        self.assertEqual(hub.degree('out'), 4)
+        self.assertEqual(hub.degree('in'), 1)
+        self.assertEqual(hub.degree(), 5)
+        self.graph.link_many([(others[1], hub, None), (others[2], hub, None)])
+        self.assertEqual(hub.degree('in'), 3)
+        edge = others[3].link(hub)
+        edge['weight'] = 1
+        edge.save()
+        self.assertEqual(hub.degree('in'), 4)
+        edge.delete()
+        self.assertEqual(hub.degree('in'), 3)
+        others[0].delete()
+        self.assertEqual(hub.degree('out'), 3)
+        self.assertEqual(hub.degree('in'), 2)
+        self.assertEqual(others[0].degree(), 0)
+
+    def test_rebuild(self):
+        hub, others = self._graph()
+        self.graph.create_degree_index()
+        rows = self.graph._tuples.keyspace('degree')
+        rows.put(pack(hub.uid, 'out'), pack(42))
+        rows.put(pack(others[1].uid, 'out'), pack(1))
+        self.graph.rebuild_degree_index()
+        self.assertEqual(hub.degree('out'), 4)
+        self.assertEqual(others[1].degree('out'), 0)
+        self.assertEqual(others[0].degree(), 2)
+
+    def test_degree_without_index(self):
+        hub, others = self._graph()
+        self.assertEqual(hub.degree('out'), 4)
+        self.assertEqual(hub.degree('in'), 1)
+        self.assertEqual(others[1].degree(), 1)
+        with self.assertRaises(AjguDBException):
+            hub.degree('sideways')
+
+    def test_degree_step(self):
+        hub, _ = self._graph()
+        self.graph.create_degree_index()
+        query = self.graph.query(select(label='other'), degree('in'), value)
+        self.assertEqual(query(), [1, 1, 1, 1])
+        self.assertEqual(self.graph.query(degree(), value)(hub), [5])
+
+    def test_max_degree(self):
+        hub, others = self._graph()
+        query = self.graph.query(
+            select(label='other'), incomings, start, outgoings(max_degree=3),
+            count,
+        )
+        self.assertEqual(query(), 0)
+        query = self.graph.query(
+            select(label='hub'), outgoings, end, outgoings(max_degree=3),
+            end, value,
+        )
+        self.assertEqual(query(), [hub.uid])
+        self.graph.create_degree_index()
+        self.assertEqual(query(), [hub.uid])
+
+
+class TestBSDDBDegree(BaseTestDegree, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBDegree(BaseTestDegree, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerDegree(BaseTestDegree, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteDegree(BaseTestDegree, RemoteTestCase):
+
+    def test_concurrent_clients(self):
+        hub = self.graph.vertex(label='hub')
+        self.graph.create_degree_index()
+        clients = [AjguDB('/tmp/ajgudb', RemoteStorage) for _ in range(4)]
+
+        def link(client):
+            for _ in range(25):
+                client.vertex().link(hub.uid)
+
+        threads = [Thread(target=link, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for client in clients:
+            client.close()
+        self.assertEqual(hub.degree('in'), 100)
+
+
+class BaseTestLabel(object):
+
+    def _graph(self):
+        user = self.graph.vertex(name='user')
+        question = self.graph.vertex(name='question')
+        answered = user.link(question, label='answered')
+        user.link(question, label='viewed')
+        user.link(self.graph.vertex(name='other'), label='viewed')
+        user.link(question)
+        return user, question, answered
+
+    def _check(self):
+        user, question, answered = self._graph()
+        query = self.graph.query(outgoings(label='answered'), get)
+        self.assertEqual(query(user), [answered])
+        query = self.graph.query(outgoings(label='viewed'), count)
+        self.assertEqual(query(user), 2)
+        query = self.graph.query(incomings(label='viewed'), start, get)
+        self.assertEqual(query(question), [user])
+        answered['label'] = 'viewed'
+        answered.save()
+        query = self.graph.query(outgoings(label='viewed'), count)
+        self.assertEqual(query(user), 3)
+        question.delete()
+        self.assertEqual(query(user), 1)
+
+    def test_label(self):
+        self.graph.create_label_index()
+        self._check()
+
+    def test_label_without_index(self):
+        self._check()
+
+    def test_label_backfill(self):
+        user, question, answered = self._graph()
+        self.graph.create_label_index()
+        query = self.graph.query(outgoings(label='answered'), get)
+        self.assertEqual(query(user), [answered])
+        query = self.graph.query(outgoings(label='viewed', max_degree=1))
+        self.assertEqual(list(query(user)), [])
+
+
+class TestBSDDBLabel(BaseTestLabel, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBLabel(BaseTestLabel, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerLabel(BaseTestLabel, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteLabel(BaseTestLabel, RemoteTestCase):
+
+    pass
+
+
+class BaseTestSerialize(object):
+
+    def _graph(self):
+        seed = self.graph.vertex(name=u'amz\xe9', tags=['a', 'b'], age=3)
+        other = self.graph.vertex(name='zaza', text='x' * 2000)
+        link = seed.link(other, weight=1.5)
+        return seed, other, link
+
+    def test_to_msgpack(self):
+        seed, other, link = self._graph()
+        stream = StringIO()
+        query = self.graph.query(vertices, to_msgpack(stream))
+        self.assertEqual(query(), 2)
+        unpacker = Unpacker(encoding='utf-8')
+        unpacker.feed(stream.getvalue())
+        rows = sorted(unpacker, key=lambda row: row['_uid'])
+        expected = dict(seed, _uid=seed.uid, _meta_type='vertex')
+        self.assertEqual(rows[0], expected)
+        self.assertEqual(rows[1]['text'], 'x' * 2000)
+        stream = StringIO()
+        query = self.graph.query(outgoings, to_msgpack(stream, ['weight']))
+        self.assertEqual(query(seed), 1)
+        rows = list(Unpacker(StringIO(stream.getvalue()), encoding='utf-8'))
+        self.assertEqual(rows, [dict(_uid=link.uid, weight=1.5)])
+
+    def test_to_ndjson(self):
+        seed, other, link = self._graph()
+        stream = StringIO()
+        fields = ['name', 'age', 'missing']
+        query = self.graph.query(select(name='zaza'), to_ndjson(stream))
+        self.assertEqual(query(), 1)
+        row = json.loads(stream.getvalue())
+        self.assertEqual(row['text'], 'x' * 2000)
+        stream = StringIO()
+        query = self.graph.query(vertices, to_ndjson(stream, fields))
+        self.assertEqual(query(), 2)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(
+            lines[0], '{"_uid": %d, "name": "amz\\u00e9", "age": 3, '
+            '"missing": null}' % seed.uid,
+        )
+
+
+class TestBSDDBSerialize(BaseTestSerialize, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBSerialize(BaseTestSerialize, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerSerialize(BaseTestSerialize, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteSerialize(BaseTestSerialize, RemoteTestCase):
+
+    pass
+
+
+class TestBloom(TestCase):
+
+    def test_bloom(self):
+        bloom = Bloom(1000)
+        for index in range(1000):
+            bloom.add(pack(index))
+        for index in range(1000):
+            self.assertIn(pack(index), bloom)
+        misses = sum(pack(index) in bloom for index in range(1000, 11000))
+        self.assertLess(misses, 300)
+
+
+class BaseTestSnapshot(object):
+
+    def test_snapshot(self):
+        user = self.graph.vertex(name='amz3')
+        with self.graph.snapshot() as snapshot:
+            self.graph.vertex(name='zaza')
+            user['name'] = 'amirouche'
+            user.save()
+            self.assertEqual(snapshot.get(user.uid)['name'], 'amz3')
+            query = snapshot.query(vertices, key('name'), value)
+            self.assertEqual(list(query()), ['amz3'])
+            query = snapshot.query(select(name='amz3'), count)
+            self.assertEqual(query(), 1)
+            user.delete()
+            self.assertEqual(snapshot.get(user.uid)['name'], 'amz3')
+        query = self.graph.query(vertices, key('name'), value)
+        self.assertEqual(list(query()), ['zaza'])
+
+    def test_snapshot_index(self):
+        self.graph.create_index('kind', 'name')
+        self.graph.vertex(kind='user', name='amz3')
+        with self.graph.snapshot() as snapshot:
+            self.graph.vertex(kind='user', name='zaza')
+            query = snapshot.query(select(kind='user', name='zaza'), count)
+            self.assertEqual(query(), 0)
+            query = self.graph.query(select(kind='user', name='zaza'), count)
+            self.assertEqual(query(), 1)
+
+    def test_snapshot_before_read(self):
+        user = self.graph.vertex(name='amz3')
+        with self.graph.snapshot() as snapshot:
+            # nothing is read from the snapshot before the write
+            self.graph.vertex(name='zaza')
+            query = snapshot.query(vertices, count)
+            self.assertEqual(query(), 1)
+            self.assertEqual(snapshot.get(user.uid)['name'], 'amz3')
+
+    def test_snapshot_read_only(self):
+        user = self.graph.vertex(name='amz3')
+        self.graph.create_index('kind', 'name')
+        with self.graph.snapshot() as snapshot:
+            with self.assertRaises(AjguDBException):
+                snapshot.vertex(name='amz3')
+            element = snapshot.get(user.uid)
+            element['kind'] = 'user'
+            with self.assertRaises(AjguDBException):
+                element.save()
+            with self.assertRaises(AjguDBException):
+                element.delete()
+            with self.assertRaises(AjguDBException):
+                snapshot.create_index('kind', 'age')
+
+
+class TestBSDDBSnapshot(BaseTestSnapshot, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBSnapshot(BaseTestSnapshot, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerSnapshot(BaseTestSnapshot, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteSnapshot(RemoteTestCase):
+
+    def test_snapshot(self):
+        with self.assertRaises(AjguDBException):
+            with self.graph.snapshot():
+                pass
+
+
+class BaseTestCache(object):
+
+    def setUp(self):
+        super(BaseTestCache, self).setUp()
+        self.graph.close()
+        self.graph = AjguDB('/tmp/ajgudb', self.storage_class, cache=2)
+        self.cache = self.graph._cache
+
+    def test_hit(self):
+        self.graph.vertex(kind='post', tag='python')
+        query = self.graph.query(select(kind='post'), count)
+        self.assertEqual(query(), 1)
+        self.assertEqual(query(), 1)
+        self.assertEqual(self.cache.hits, 1)
+        query = self.graph.query(vertices, key('tag'), group_count)
+        self.assertEqual(next(query()), dict(python=1))
+        self.assertEqual(next(query()), dict(python=1))
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_invalidation(self):
+        post = self.graph.vertex(kind='post')
+        query = self.graph.query(select(kind='post'), count)
+        self.assertEqual(query(), 1)
+        self.graph.vertex(kind='post')
+        self.assertEqual(query(), 2)
+        post['title'] = 'first'
+        post.save()
+        self.assertEqual(query(), 2)
+        post.delete()
+        self.assertEqual(query(), 1)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_unrelated_write(self):
+        self.graph.vertex(kind='post')
+        query = self.graph.query(select(kind='post'), count)
+        self.assertEqual(query(), 1)
+        self.graph._tuples.add(self.graph._uid(), other='value')
+        self.assertEqual(query(), 1)
+        self.assertEqual(self.cache.hits, 1)
+        get_all = self.graph.query(select(kind='post'), get)
+        get_all()
+        self.graph._tuples.add(self.graph._uid(), other='value')
+        get_all()
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_sort_key(self):
+        seed = self.graph.vertex()
+        two = self.graph.vertex(name=2)
+        three = self.graph.vertex(name=3)
+        seed.link(two)
+        seed.link(three)
+
+        def name(graphdb, item):
+            return graphdb._tuples.ref(item.value, 'name')
+
+        query = self.graph.query(outgoings, end, sort(key=name), value)
+        self.assertEqual(query(seed), [two.uid, three.uid])
+        three['name'] = 1
+        three.save()
+        self.assertEqual(query(seed), [three.uid, two.uid])
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_copy(self):
+        self.graph.vertex(kind='post')
+        query = self.graph.query(select(kind='post'), get)
+        query()[0]['kind'] = 'mutated'
+        self.assertEqual(query()[0]['kind'], 'post')
+        query()[0]['kind'] = 'mutated'
+        self.assertEqual(query()[0]['kind'], 'post')
+        query = self.graph.query(vertices, key('kind'), group_count)
+        next(query())['post'] += 1
+        self.assertEqual(next(query()), dict(post=1))
+        self.assertEqual(self.cache.hits, 4)
+
+    def test_limit(self):
+        self.cache.limit = 2
+        for _ in range(3):
+            self.graph.vertex(kind='post')
+        query = self.graph.query(select(kind='post'), value)
+        self.assertEqual(len(query()), 3)
+        query = self.graph.query(select(kind='post'))
+        self.assertEqual(len(list(query())), 3)
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def test_input(self):
+        seed = self.graph.vertex()
+        other = self.graph.vertex()
+        seed.link(other)
+        query = self.graph.query(outgoings, end, value)
+        self.assertEqual(list(query(seed)), [other.uid])
+        self.assertEqual(list(query(other)), [])
+        self.assertEqual(list(query(seed)), [other.uid])
+        self.assertEqual(self.cache.hits, 1)
+        other.link(seed)
+        self.assertEqual(list(query(other)), [seed.uid])
+
+    def test_eviction(self):
+        for kind in ('post', 'page', 'post', 'link', 'page'):
+            self.graph.query(select(kind=kind), count)()
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(len(self.cache._entries), 2)
+
+    def test_not_cached(self):
+        query = self.graph.query(select(kind='post'), count, cache=False)
+        query()
+        query()
+        self.graph.query(select(kind='tag'), link(kind='hub'))()
+        self.assertEqual(self.cache.misses, 0)
+
+
+class TestLevelDBCache(BaseTestCache, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerCache(BaseTestCache, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestRemoteCache(RemoteTestCase):
+
+    def test_cache(self):
+        with self.assertRaises(AjguDBException):
+            AjguDB('/tmp/ajgudb', RemoteStorage, cache=2)
+
+
+class TestImporter(DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+    def setUp(self):
+        super(TestImporter, self).setUp()
+        self.vertices = '/tmp/ajgudb/vertices.csv'
+        with open(self.vertices, 'w') as f:
+            f.write('id,name,city\n')
+            f.write('a,amirouche,paris\n')
+            f.write('b,zaza,"lyon, france"\n')
+            f.write('c,hypermove,paris\n')
+        self.edges = '/tmp/ajgudb/edges.jsonl'
+        with open(self.edges, 'w') as f:
+            f.write('{"start": "a", "end": "b", "label": "knows"}\n')
+            f.write('{"start": "a", "end": "c", "label": "knows"}\n')
+            f.write('{"start": "a", "end": "z", "label": "knows"}\n')
+
+    def run_import(self, workers, **options):
+        importer = Importer(
+            self.graph, workers=workers, batch=2, output=None, **options
+        )
+        imported = importer.run([self.vertices], [self.edges])
+        self.assertEqual(imported, 5)
+        self.assertEqual(importer.skipped, 1)
+        amirouche = self.graph.get(importer.uid('a'))
+        self.assertEqual(amirouche['name'], 'amirouche')
+        self.assertNotIn('id', amirouche)
+        query = self.graph.query(outgoings, end, key('name'), value)
+        self.assertEqual(sorted(query(amirouche)), ['hypermove', 'zaza'])
+        query = self.graph.query(select(city='lyon, france'), count)
+        self.assertEqual(query(), 1)
+
+    def test_import(self):
+        self.run_import(1)
+
+    def test_import_with_pool(self):
+        self.run_import(2)
+
+    def test_import_sorted(self):
+        self.run_import(1, sort=True, budget=1000)
+
+    def test_uid_block(self):
+        first = self.graph._uid(10)
+        self.assertEqual(self.graph._uid(), first + 10)
+
+
+class TestSpill(TestCase):
+
+    def test_runs(self):
+        keys = [pack(value) for value in range(100)]
+        with Runs(budget=1000) as runs:
+            for key in reversed(keys):
+                runs.add(key, 'value')
+            self.assertTrue(len(runs.runs) > 1)
+            out = list(runs)
+        self.assertEqual(out, [(key, 'value') for key in keys])
+        self.assertEqual(runs.runs, [])
+
+    def test_spool(self):
+        values = [(index % 7, u'value', [index]) for index in range(100)]
+        with Spool(budget=10) as spool:
+            for value in values:
+                spool.add(value)
+            self.assertEqual(len(spool.runs), 10)
+            out = list(spool)
+        self.assertEqual(out, sorted(values))
+
+
+class BaseTestIngest(object):
+
+    def test_ingest(self):
+        self.graph.create_index('kind', 'name')
+        uid = self.graph._uid(100)
+        elements = [
+            (uid + index, dict(_meta_type='vertex', kind='user', name=index))
+            for index in reversed(range(100))
+        ]
+        elements.append((uid + 100, dict(_meta_type='vertex', text=LARGE)))
+        self.graph._ingest(iter(elements), budget=2000)
+        self.assertEqual(self.graph.get(uid)['name'], 0)
+        self.assertEqual(self.graph.get(uid + 100)['text'], LARGE)
+        query = self.graph.query(select(kind='user'), count)
+        self.assertEqual(query(), 100)
+        query = self.graph.query(select(kind='user', name=42), value)
+        self.assertEqual(query(), [uid + 42])
+        query = self.graph.query(select(text=LARGE), value)
+        self.assertEqual(query(), [uid + 100])
+
+
+class TestBSDDBIngest(BaseTestIngest, DatabaseTestCase):
+
+    storage_class = BSDDBStorage
+
+
+class TestLevelDBIngest(BaseTestIngest, DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+
+class TestWiredTigerIngest(BaseTestIngest, DatabaseTestCase):
+
+    storage_class = WiredTigerStorage
+
+
+class TestCommandLineImport(TestCase):
+
+    def setUp(self):
+        os.makedirs('/tmp/ajgudb-import')
+
+    def tearDown(self):
+        rmtree('/tmp/ajgudb-import')
+
+    def test_import(self):
+        source = '/tmp/ajgudb-import/vertices.jsonl'
+        with open(source, 'w') as f:
+            f.write('{"id": 1, "name": "one"}\n{"id": 2, "name": "two"}\n')
+        path = '/tmp/ajgudb-import/db'
+        main(['import', path, '--vertices', source, '--workers', '1'])
+        graph = AjguDB(path)
+        try:
+            query = graph.query(vertices, key('name'), value)
+            self.assertEqual(sorted(query()), [u'one', u'two'])
+        finally:
+            graph.close()
+
+
+class TestLevelDBProfiling(DatabaseTestCase):
+
+    storage_class = LevelDBStorage
+
+    def test_explain(self):
+        out = self.graph.explain(select(label='seed'), outgoings, end, get)()
+        self.assertEqual(
+            [(x['step'], x['access']) for x in out],
+            [
+                ('select', 'index'),
+                ('outgoings', 'adjacency'),
+                ('end', 'ref'),
+                ('get', 'get'),
+            ]
+        )
+        self.assertEqual(out[0]['prefix'], ['label', 'seed'])
+
+    def test_explain_degree(self):
+        steps = (vertices, outgoings(max_degree=10), degree('in'))
+        out = self.graph.explain(*steps)()
+        self.assertEqual(out[1]['guard'], 'adjacency')
+        self.assertEqual(out[2]['access'], 'adjacency')
+        self.graph.create_degree_index()
+        out = self.graph.explain(*steps)()
+        self.assertEqual(out[1]['guard'], 'counter')
+        self.assertEqual(out[2]['access'], 'counter')
+
+    def test_explain_label(self):
+        out = self.graph.explain(outgoings(label='answered'))()
+        self.assertEqual(out[0]['access'], 'adjacency')
+        self.assertEqual(out[0]['filter'], ['label'])
+        self.graph.create_label_index()
+        out = self.graph.explain(outgoings(label='answered'))()
+        self.assertEqual(out[0]['access'], 'label')
+        self.assertEqual(out[0]['prefix'], ['_meta_start', 'answered'])
+
+    def test_explain_spill(self):
+        out = self.graph.explain(vertices, sort(budget=10), unique)()
+        self.assertEqual(out[1]['spill'], 10)
+        self.assertNotIn('spill', out[2])
+        out = self.graph.explain(vertices, spilled_group_count(5))()
+        self.assertEqual(out[1]['spill'], 5)
+
+    def test_explain_with_input(self):
+        out = self.graph.explain(select(label='seed'))(self.graph.vertex())
+        self.assertEqual(out[0]['access'], 'ref')
+
+    def test_profile(self):
+        seed = self.graph.vertex(label='seed')
+        for _ in range(3):
+            seed.link(self.graph.vertex(label='other'))
+        out = self.graph.profile(outgoings, end, get)(seed)
+        self.assertEqual(len(out['result']), 3)
+        outgoings_, end_, get_ = out['steps']
+        self.assertEqual(outgoings_['rows_in'], 1)
+        self.assertEqual(outgoings_['rows_out'], 3)
+        self.assertEqual(outgoings_['calls']['query_many'], 1)
+        self.assertEqual(end_['calls']['ref'], 3)
+        self.assertEqual(get_['calls']['get'], 3)
+        self.assertEqual(get_['rows_out'], 3)
+        self.assertTrue(get_['bytes'] > 0)
+
+    def test_profile_shared(self):
+        seed = self.graph.vertex(label='seed')
+        seed.link(self.graph.vertex(label='other'))
+        storage = self.graph._tuples
+
+        def predicate(graphdb, item):
+            # another query of the same database runs meanwhile
+            self.assertIs(self.graph._tuples, storage)
+            self.graph.query(outgoings, end, get)(seed)
+            return True
+
+        out = self.graph.profile(outgoings, filter(predicate), end)(seed)
+        self.assertEqual(len(out['result']), 1)
+        self.assertEqual(out['steps'][0]['calls']['query_many'], 1)
+        # calls of the other query are not counted
+        self.assertEqual(sum(out['steps'][1]['calls'].values()), 0)
+
+    def test_explain_index_only(self):
+        out = self.graph.explain(vertices, key('tag'), group_count)()
+        self.assertEqual(len(out), 1)
+        self.assertEqual(out[0]['step'], 'project')
+        self.assertEqual(out[0]['access'], 'index-only')
+        self.assertEqual(out[0]['prefix'], ['tag'])
+        self.assertEqual(out[0]['source']['step'], 'vertices')
+        self.assertEqual(out[0]['aggregate'], 'group_count')
+
+    def test_profile_index_only(self):
+        for tag in ('a', 'b', 'a'):
+            self.graph.vertex(kind='post', tag=tag)
+        out = self.graph.profile(vertices, key('tag'), value)()
+        self.assertEqual(out['result'], ['a', 'b', 'a'])
+        self.assertEqual(out['steps'][0]['calls']['ref'], 0)
+        self.assertEqual(out['steps'][0]['calls']['query'], 2)
+
+    def test_profile_selective_source(self):
+        for _ in range(10):
+            self.graph.vertex(tag='other')
+        self.graph.vertex(handle='needle', tag='python')
+        query = self.graph.profile(select(handle='needle'), key('tag'), value)
+        out = query()
+        self.assertEqual(out['result'], ['python'])
+        self.assertEqual(len(out['steps']), 3)
+        self.assertEqual(out['steps'][1]['calls']['ref'], 1)
+
+    def test_profile_count(self):
+        self.graph.vertex(label='one')
+        self.graph.vertex(label='one')
+        out = self.graph.profile(select(label='one'), count)()
+        self.assertEqual(out['result'], 2)
+        self.assertEqual(out['steps'][0]['rows_out'], 2)
+        self.assertEqual(out['steps'][1]['rows_in'], 2)
+
 
 class TestBSDDDBGremlin(BaseTestGremlin, DatabaseTestCase):
 
@@ -386,3 +1817,83 @@ class TestLevelDBGremlin(BaseTestGremlin, DatabaseTestCase):
 class TestWiredTigerGremlin(BaseTestGremlin, DatabaseTestCase):
 
     storage_class = WiredTigerStorage
+
+
+class TestRemoteGremlin(BaseTestGremlin, RemoteTestCase):
+    pass
+
+
+@skipIf(AsyncAjguDB is None, 'asyncio is not available')
+class TestAsyncAjguDB(TestCase):
+
+    def setUp(self):
+        os.makedirs('/tmp/ajgudb')
+        self.loop = asyncio.new_event_loop()
+        self.graph = AsyncAjguDB('/tmp/ajgudb', loop=self.loop)
+
+    def tearDown(self):
+        self.wait(self.graph.close())
+        self.loop.close()
+        rmtree('/tmp/ajgudb')
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_vertex_and_get(self):
+        vertex = self.wait(self.graph.vertex(label='test'))
+        self.assertEqual(self.wait(self.graph.get(vertex.uid)), vertex)
+
+    def test_get_not_found(self):
+        self.assertRaises(AjguDBException, self.wait, self.graph.get(42))
+
+    def test_get_coalesced(self):
+        one = self.wait(self.graph.vertex(label='one'))
+        two = self.wait(self.graph.vertex(label='two'))
+        calls = list()
+        get_many = self.graph._graphdb.get_many
+
+        def spy(uids):
+            calls.append(uids)
+            return get_many(uids)
+
+        self.graph._graphdb.get_many = spy
+        futures = [
+            self.graph.get(one.uid),
+            self.graph.get(two.uid),
+            self.graph.get(one.uid),
+        ]
+        out = self.wait(asyncio.gather(*futures, loop=self.loop))
+        self.assertEqual(out, [one, two, one])
+        self.assertEqual(len(calls), 1)
+
+    def test_query(self):
+        seed = self.wait(self.graph.vertex(label='seed'))
+        for _ in range(3):
+            other = self.wait(self.graph.vertex())
+            self.wait(self.graph.link(seed, other))
+        query = self.graph.query(outgoings, count)
+        self.assertEqual(self.wait(query(seed)), 3)
+
+    def test_query_cache(self):
+        self.wait(self.graph.close())
+        self.graph = AsyncAjguDB('/tmp/ajgudb', loop=self.loop, cache=2)
+        self.wait(self.graph.vertex(label='test'))
+        query = self.graph.query(select(label='test'), count)
+        self.assertEqual(self.wait(query()), 1)
+        self.assertEqual(self.wait(query()), 1)
+        self.assertEqual(self.graph._graphdb._cache.hits, 1)
+        query = self.graph.query(select(label='test'), count, cache=False)
+        self.assertEqual(self.wait(query()), 1)
+        self.assertEqual(self.graph._graphdb._cache.hits, 1)
+
+    def test_aquery(self):
+        for index in range(250):
+            self.wait(self.graph.vertex(label='test', index=index))
+        iterator = self.graph.aquery(select(label='test'), key('index'), value)
+        out = list()
+        while True:
+            try:
+                out.append(self.wait(iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(sorted(out), list(range(250)))